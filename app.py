@@ -1,23 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, g, jsonify, send_from_directory, Response, stream_with_context
 from routes.user_routes import user_bp
 from routes.cart_routes import cart_bp
 from routes.order_routes import order_bp
 from routes.product_routes import product_bp
 from routes.auth_routes import auth_bp
-from utils.db import get_db
-from utils.redis_client import get_redis_client
+from utils.db import get_db, get_pool_stats
+from utils.redis_client import get_redis_client, get_redis_pool_stats
 from models.product import Product
-from models.cart import Cart
-from models.payment import Payment
+from models.catalog_cache import get_product_model
+from models.cart import get_cart_model
+from models.payment import Payment, NOT_FOUND, ALREADY_PAID
 from models.order import Order
 from models.invoice import Invoice
-from decorator.decorators import admin_required
-from werkzeug.utils import secure_filename
+from models.audit_log import AuditLog
+from models.analytics import SalesAnalytics, PAYMENT_METHODS
+from decorator.decorators import admin_required, login_required
+from utils.current_user import get_current_user, get_current_user_id
+from utils.indexes import ensure_indexes
+from utils.page_cache import cached_page, cached_fragment, page_key
+from utils.tasks import audit_writer
+from utils.images import save_upload, resolve_variant
+from utils.product_import import iter_import, detect_format, FORMATS
+from utils.serializer import dumps
+from utils.export import export_chunks, export_filename, ExportError
+from utils import metrics
 import os
+import tempfile
 from bson import json_util, ObjectId
 from datetime import datetime, timedelta
 
-secret_key = os.urandom(24)
+#Con SECRET_KEY la cookie de sesion sirve tambien en async_app.py (y entre reinicios)
+secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
 
 app = Flask(__name__)
 app.secret_key = secret_key  #Para usar sesiones en Flask
@@ -29,85 +42,139 @@ app.register_blueprint(order_bp, url_prefix='/api')
 app.register_blueprint(product_bp, url_prefix='/api')
 app.register_blueprint(auth_bp, url_prefix='/auth')
 
+#Metricas por request y /metrics (utils/metrics.py)
+if metrics.METRICS_ENABLED:
+    metrics.init_app(app)
+
 #Configuramos la carpeta de subida
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+#Las variantes de imagenes con nombre por hash no cambian nunca
+IMAGE_MAX_AGE = 31536000
+IMAGE_FALLBACK_MAX_AGE = 300
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+#URL de una imagen del producto en el tamaño que necesita el template
+#(thumb, card o detail). Sirve tanto para 'uploads/x.png' como para '/uploads/x.png'
+@app.template_global()
+def image_url(path, variant='detail'):
+    return url_for('product_image', variant=variant, filename=os.path.basename(path))
+
+#Parametros de paginacion que vienen en la URL (?after=...&before=...&per_page=...)
+def page_args():
+    return {
+        "after": request.args.get('after'),
+        "before": request.args.get('before'),
+        "per_page": request.args.get('per_page', type=int)
+    }
+
 def get_cart_count():
-    if 'token' not in session:
+    user_id = get_current_user_id()
+    if not user_id:
         return 0
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
-    db = get_db()
-    cart_model = Cart(db)
-    cart_id = f"{user_id}"
-    items = cart_model.get_cart(cart_id)
-    if items:
-        return sum(item["quantity"] for item in items)
-    return 0
+
+    #Se lee una vez por request y de Redis en los dos backends: con Redis es el GET
+    #de cart:<id>:count y con Mongo el HGET de cart:<id>:badge, que guardan las
+    #operaciones del carrito con la cantidad que devuelven (ver models/cart.py).
+    #Guardada en la sesion quedaba vieja con otras pestañas o con la API del carrito
+    if 'cart_count' not in g:
+        db = get_db()
+        cart_model = get_cart_model(db)
+        cart_id = f"{user_id}"
+        g.cart_count = cart_model.get_cart_count(cart_id)
+    return g.cart_count
 
 @app.context_processor
 def inject_user_role():
-    if 'token' not in session:
+    user = get_current_user()
+    if not user:
         return dict(user_role=None)
     
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
-    user_role = redis_client.hget(f"user:{user_id}", "role").decode('utf-8')
-    
-    return dict(user_role=user_role)
+    return dict(user_role=user.get('role'))
 
 @app.context_processor
 def inject_cart_count():
     return dict(cart_count=get_cart_count())
 
+#Imagenes de productos. Si la variante todavia no se genero (o la imagen es de
+#antes de usar nombres por hash) se manda el original con un cache corto
+@app.route('/media/<variant>/<filename>')
+def product_image(variant, filename):
+    folder, name, immutable = resolve_variant(filename, variant)
+    response = send_from_directory(folder, name)
+    if immutable:
+        response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = f'public, max-age={IMAGE_FALLBACK_MAX_AGE}'
+    return response
+
 @app.route('/')
 def index():
-    db = get_db()
-    product_model = Product(db)
-    products = product_model.get_active_products()  
-    return render_template('home.html', products=products)
+    def render():
+        db = get_db()
+        product_model = get_product_model(db)
+        #En el home solo se muestran los 3 destacados
+        products = product_model.get_active_products_page(per_page=3)["items"]
+        return render_template('home.html', products=products)
+    return cached_page(render)
 
 #Pantalla donde se muestran todos los articulos subidos
 @app.route('/products')
 def products_page():
-    db = get_db()
-    product_model = Product(db)
-    products = product_model.get_active_products()
-    return render_template('products.html', products=products)
+    def render():
+        db = get_db()
+        product_model = get_product_model(db)
+        page = product_model.get_active_products_page(**page_args())
+        product_grid = cached_fragment(f"grid:{page_key()}",
+                                       lambda: render_template('_product_grid.html', products=page["items"]))
+        return render_template('products.html', product_grid=product_grid, page=page)
+    return cached_page(render)
 
 #Detalle del producto 
 @app.route('/product/<product_id>')
 def product_detail(product_id):
     db = get_db()
-    product_model = Product(db)
+    product_model = get_product_model(db)
     product = product_model.get_product(product_id)
     if not product:
         return "Product not found", 404
-    return render_template('product_detail.html', product=product)
+
+    def render():
+        product_body = cached_fragment(f"detail:{product_id}",
+                                       lambda: render_template('_product_detail_body.html', product=product))
+        return render_template('product_detail.html', product=product, product_body=product_body)
+    return cached_page(render)
 
 #Busca el producto desde la pantalla home
 @app.route('/search')
 def search():
-    query = request.args.get('q')
-    db = get_db()
-    product_model = Product(db)
-    products = list(product_model.collection.find({"name": {"$regex": query, "$options": "i"}}))
-    return render_template('products.html', products=products)
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return redirect(url_for('products_page'))
+    page_number = request.args.get('page', 1, type=int)
+
+    def render():
+        db = get_db()
+        product_model = get_product_model(db)
+        products, has_next = product_model.search_products(query, page_number)
+        product_grid = cached_fragment(f"grid:{page_key()}",
+                                       lambda: render_template('_product_grid.html', products=products))
+        return render_template('products.html', product_grid=product_grid, query=query,
+                               page_number=page_number, has_next=has_next)
+    return cached_page(render)
 
 #Panel de control para el ADMIN
 @app.route('/admin/products')
 @admin_required
 def admin_products_page():
     db = get_db()
-    product_model = Product(db)
-    products = product_model.get_active_products_admin()
-    return render_template('admin_products.html', products=products)
+    product_model = get_product_model(db)
+    page = product_model.get_active_products_admin_page(**page_args(), raw=True)
+    return render_template('admin_products.html', products=page["items"], page=page)
 
 @app.route('/admin/add_product', methods=['GET', 'POST'])
 @admin_required
@@ -122,14 +189,13 @@ def add_product():
         if 'image_files' in request.files:
             for file in request.files.getlist('image_files'):
                 if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    images.append(f'/uploads/{filename}')
+                    image = save_upload(file, file.filename.rsplit('.', 1)[1])
+                    if image not in images:
+                        images.append(image)
 
         #Creo un nuevo producto
         db = get_db()
-        product_model = Product(db)
+        product_model = get_product_model(db)
         product_data = {
             "productId": str(ObjectId()),
             "name": name,
@@ -142,28 +208,70 @@ def add_product():
         product_model.add_product(product_data)
 
         #Registramos las acciones en auditoría
-        user_id = get_redis_client().get(f"session:{session['token']}").decode('utf-8')
+        user_id = get_current_user_id()
         log_audit("create", product_data["productId"], user_id, f"Product '{name}' created")
 
         return redirect(url_for('admin_products_page'))
 
     return render_template('add_product.html')
 
+#Importacion masiva de productos (CSV o NDJSON). La respuesta es NDJSON: una
+#linea de progreso por lote y al final el resumen con los errores por fila
+@app.route('/admin/import_products', methods=['GET', 'POST'])
+@admin_required
+def import_products_page():
+    if request.method == 'GET':
+        return render_template('import_products.html')
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({"error": "Falta el archivo"}), 400
+    fmt = request.form.get('format') or detect_format(file.filename)
+    if fmt not in FORMATS:
+        return jsonify({"error": f"Formato desconocido: {fmt}"}), 400
+
+    user_id = get_current_user_id()
+    product_model = get_product_model(get_db())
+
+    def audit(details):
+        audit_writer.log("import", None, user_id, details)
+
+    #El archivo subido se cierra al terminar el request, la respuesta lee una copia
+    with tempfile.NamedTemporaryFile(suffix=f'.{fmt}', delete=False) as tmp:
+        file.save(tmp)
+
+    def generate():
+        try:
+            with open(tmp.name, 'rb') as f:
+                for summary in iter_import(f, fmt, product_model, audit):
+                    if summary["done"]:
+                        yield dumps(summary) + b"\n"
+                    else:
+                        yield dumps({key: value for key, value in summary.items() if key != "errors"}) + b"\n"
+        finally:
+            os.remove(tmp.name)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/admin/edit_product/<product_id>', methods=['GET', 'POST'])
 @admin_required
 
 #El usuario con rol ADMIN puede editar los productos
 def edit_product(product_id):
     db = get_db()
-    product_model = Product(db)
+    product_model = get_product_model(db)
+    #El producto se lee sin cache: el stock tiene que ser el actual
+    current_product = Product(db)
     
     if request.method == 'POST':
-        product = product_model.get_product(product_id)
+        product = current_product.get_product(product_id)
         
         name = request.form['name']
         price = float(request.form['price'])
         description = request.form['description']
         stock = int(request.form['stock'])
+        #Stock que se mostro en el formulario: se aplica la diferencia que hizo el admin
+        original_stock = int(request.form.get('original_stock', product['stock']))
         images = product['images']
 
         changes = []
@@ -171,35 +279,33 @@ def edit_product(product_id):
             changes.append({"field": "name", "old": product["name"], "new": name})
         if price != product["price"]:
             changes.append({"field": "price", "old": product["price"], "new": price})
-        if stock != product["stock"]:
-            changes.append({"field": "stock", "old": product["stock"], "new": stock})
+        if stock != original_stock:
+            changes.append({"field": "stock", "old": original_stock, "new": stock})
         if description != product["description"]:
             changes.append({"field": "description", "old": product["description"], "new": description})
         
         if 'image_files' in request.files:
             for file in request.files.getlist('image_files'):
                 if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file.save(file_path)
-                    images.append(f'uploads/{filename}')  #Agregamos la nueva imagen a la lista
+                    image = save_upload(file, file.filename.rsplit('.', 1)[1])
+                    if image not in images:  #Si la misma imagen ya estaba no se repite
+                        images.append(image)  #Agregamos la nueva imagen a la lista
 
         product_data = {
             "name": name,
             "price": price,
             "description": description,
-            "stock": stock,
             "images": images
         }
-        product_model.update_product(product_id, product_data)
+        product_model.update_product(product_id, product_data, stock - original_stock)
 
         #Aca se registra la acción en auditoría
-        user_id = get_redis_client().get(f"session:{session['token']}").decode('utf-8')
+        user_id = get_current_user_id()
         log_audit("edit", product_id, user_id, f"Product '{name}' updated", changes)
 
         return redirect(url_for('admin_products_page'))
 
-    product = product_model.get_product(product_id)
+    product = current_product.get_product(product_id)
     return render_template('edit_product.html', product= product)
 
 @app.route('/admin/delete_product/<product_id>', methods=['POST'])
@@ -208,30 +314,21 @@ def edit_product(product_id):
 #El usuario con rol ADMIN puede borrar los productos
 def delete_product(product_id):
     db = get_db()
-    product_model = Product(db)
-    product = product_model.get_product(product_id)
+    product_model = get_product_model(db)
+    product = Product(db).get_product(product_id)
 
     if product:
         product_model.delete_product(product_id)
 
         #Se registra la acción en auditoría
-        user_id = get_redis_client().get(f"session:{session['token']}").decode('utf-8')
+        user_id = get_current_user_id()
         log_audit("delete", product_id, user_id, f"Product '{product['name']}' deleted")
 
     return redirect(url_for('admin_products_page'))
 
-#Función para registrarlo en auditoría
+#Función para registrarlo en auditoría (se junta en un buffer y se guarda de a lotes)
 def log_audit(action, product_id, user_id, details, changes=None):
-    db = get_db()
-    audit_log = {
-        "action": action,
-        "product_id": product_id,
-        "user_id": user_id,
-        "timestamp": datetime.utcnow(),
-        "details": details,
-        "changes": changes  #Aca mostramos los cambios
-    }
-    db.audit_logs.insert_one(audit_log)
+    audit_writer.log(action, product_id, user_id, details, changes)
 
 @app.route('/admin/audit_logs')
 @admin_required
@@ -239,31 +336,32 @@ def log_audit(action, product_id, user_id, details, changes=None):
 #El usuario con rol ADMIN puede ver lo que ocurre en la Auditoria
 def view_audit_logs():
     db = get_db()
-    audit_logs = list(db.audit_logs.find().sort("timestamp", -1))
-    return render_template('admin_audit_logs.html', audit_logs=audit_logs)
+    filters = {
+        "user_id": request.args.get('user_id') or None,
+        "action": request.args.get('action') or None
+    }
+    page = AuditLog(db).get_logs_page(**page_args(), **filters)
+    return render_template('admin_audit_logs.html', audit_logs=page["items"], page=page, filters=filters)
 
 @app.route('/admin/audit_logs/<product_id>')
 @admin_required
 def view_product_audit_logs(product_id):
     db = get_db()
-    audit_logs = list(db.audit_logs.find({"product_id": product_id}).sort("timestamp", -1))
+    page = AuditLog(db).get_logs_page(product_id, **page_args())
     product = db.products.find_one({"productId": product_id})
-    return render_template('product_audit_logs.html', audit_logs=audit_logs, product=product)
+    return render_template('product_audit_logs.html', audit_logs=page["items"], product=product, page=page)
 
 #El usuario puede agregar cosa a su carrito
 @app.route('/add_to_cart', methods=['POST'])
+@login_required
 def add_to_cart():
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
+    user_id = get_current_user_id()
     product_id = request.form['product_id']
     product_name = request.form['name']
     quantity = int(request.form['quantity'])
 
     db = get_db()
-    cart_model = Cart(db)
+    cart_model = get_cart_model(db)
     cart_id = f"{user_id}"
     cart_model.add_to_cart(cart_id, product_id, quantity, product_name)
     
@@ -271,14 +369,11 @@ def add_to_cart():
 
 #El usuario puede ver su carrito
 @app.route('/cart')
+@login_required
 def view_cart():
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
+    user_id = get_current_user_id()
     db = get_db()
-    cart_model = Cart(db)
+    cart_model = get_cart_model(db)
     cart_id = f"{user_id}"
     items = cart_model.get_cart(cart_id)
     return render_template('cart.html', items=items)
@@ -286,16 +381,14 @@ def view_cart():
 
 #El usuario puede actualizar su carrito
 @app.route('/update_cart', methods=['POST'])
+@login_required
 def update_cart():
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
+    user_id = get_current_user_id()
     product_id = request.form['product_id']
     quantity = int(request.form['quantity'])
 
     db = get_db()
-    cart_model = Cart(db)
+    cart_model = get_cart_model(db)
     cart_id = f"{user_id}"
     cart_model.update_cart_quantity(cart_id, product_id, quantity)
     
@@ -303,25 +396,20 @@ def update_cart():
 
 #El usuario puede eliminar productos de su carrito
 @app.route('/remove_from_cart/<product_id>', methods=['POST'])
+@login_required
 def remove_from_cart(product_id):
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
+    user_id = get_current_user_id()
     db = get_db()
-    cart_model = Cart(db)
+    cart_model = get_cart_model(db)
     cart_id = f"{user_id}"
     cart_model.remove_from_cart(cart_id, product_id)
     return redirect(url_for('view_cart'))
 
 #El checkout me muestra todo lo que tiene el carrito con su precio y demas
 @app.route('/checkout/<order_number>', methods=['GET'])
+@login_required
 def checkout(order_number):
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
+    user_id = get_current_user_id()
     db = get_db()
     
     order_model = Order(db)
@@ -330,101 +418,53 @@ def checkout(order_number):
     if not order:
         return "Order not found", 404
 
-    #Se obtienen los detalles del producto
-    product_model = Product(db)
+    #Se obtienen los detalles de todos los productos en una sola consulta
+    product_model = get_product_model(db)
+    products = product_model.get_products(item['productId'] for item in order['items'])
     detailed_items = []
+    total = 0
     for item in order['items']:
-        product = product_model.get_product(item['productId'])
+        #Si el producto ya no existe se usan los datos guardados en la orden
+        product = products.get(item['productId'], item)
         item_details = {
             "name": product['name'],
             "price": product['price'],
             "quantity": item['quantity']
         }
         detailed_items.append(item_details)
+        total += item['quantity'] * product['price']
 
-    total = sum(item['quantity'] * get_product_price(item['productId'], db) for item in order['items'])
     return render_template('checkout.html', items=detailed_items, total=total, order_number=order_number)
 
-#Trae el precio del producto
-def get_product_price(product_id, db):
-    product_model = Product(db)
-    product = product_model.get_product(product_id)
-    return product['price']
-
 #Pantalla de error en caso de que estes en el carrito y un producto no tenga mas stock 
 @app.route('/error')
 def error():
-    return render_template('error.html')
+    return render_template('error.html', products=request.args.getlist('product'))
 
 #Proceso de pago 
 @app.route('/process_payment/<order_number>', methods=['POST'])
+@login_required
 def process_payment(order_number):
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
-
-    user_name = redis_client.hget(f"user:{user_id}", "name").decode('utf-8')
-    user_address = redis_client.hget(f"user:{user_id}", "address").decode('utf-8')
-
-    payment_method = request.form['payment_method']
-    installments = request.form.get('installments', '1')
-    iva_value = float(request.form.get('iva_value', 0))
-    final_total = float(request.form.get('final_total', 0))
-    total_fee = float(request.form.get('credit_fee_amount', 0))
+    user = get_current_user()
+    if request.form.get('payment_method') not in PAYMENT_METHODS:
+        return "Invalid payment method", 400
+
+    details = {
+        "payment_method": request.form['payment_method'],
+        "installments": int(request.form.get('installments', '1')),
+        "iva": float(request.form.get('iva_value', 0)),
+        "final_total": float(request.form.get('final_total', 0)),
+        "total_fee": float(request.form.get('credit_fee_amount', 0)),
+        "iva_condition": request.form.get('iva_condition')
+    }
 
+    #Pago, factura y estado de la orden se guardan juntos (ver Payment.commit_payment)
     db = get_db()
-    payment_model = Payment(db)
-    order_model = Order(db)
-    product_model = Product(db)
-    invoice_model = Invoice(db) 
-    iva_condition = request.form.get('iva_condition')  
-
-    order = order_model.get_order(order_number)
-    if not order:
+    status, payment_info, invoice_id = Payment(db).commit_payment(order_number, user, details)
+    if status == NOT_FOUND:
         return "Order not found", 404
-
-    total = order['total']
-
-    payment_info = {
-        "user_id": user_id,
-        "payment_method": payment_method,
-        "installments": int(installments),
-        "total": total,
-        "final_total": final_total,
-        "total_fee": total_fee,
-        "items": order['items'],
-        "order_number": int(order_number),
-        "iva": iva_value
-    }
-
-    invoice_number = invoice_model.get_next_invoice_number()
-
-    invoice_info = {
-        "invoice_number": invoice_number,
-        "user_id": user_id,
-        "name": user_name,
-        "address": user_address,
-        "payment_method": payment_method,
-        "installments": int(installments),
-        "total_fee": total_fee,
-        "total": total,
-        "final_total": final_total,
-        "items": order['items'],
-        "order_number": int(order_number),
-        "iva": iva_value,
-        "iva_condition": iva_condition,
-        "date": datetime.utcnow()
-    }
-
-    #Utiliza el modelo Payment para guardar la información del pago
-    payment_model.insert_payment(payment_info)
-
-    #Actualiza el estado de la orden a "Pagado"
-    order_model.update_order_status(int(order_number), "Pagado")
-
-    invoice_id = invoice_model.create_invoice(invoice_info)
+    if status == ALREADY_PAID:
+        return "Order already paid", 409
 
     #Establece un indicador de que el pago fue exitoso y guarda la info de pago en la sesión
     session['payment_completed'] = True
@@ -460,91 +500,124 @@ def payment_success():
     else:
         return redirect(url_for('index'))
 
+#Dashboard de ventas para el ADMIN, lee solo los resumenes de models/analytics.py
+@app.route('/admin/dashboard')
+@admin_required
+def admin_dashboard():
+    analytics = SalesAnalytics(get_db())
+    days = request.args.get('days', 30, type=int)
+    return render_template(
+        'admin_dashboard.html',
+        daily=analytics.get_daily(max(1, min(days, 365))),
+        top_products=analytics.get_top_products(),
+        summary=analytics.get_summary()
+    )
+
 #El usuario con rol ADMIN puede ver todas las ordenes
 @app.route('/admin/orders')
 @admin_required
 def view_all_orders():
     db = get_db()
     order_model = Order(db)
-    orders = order_model.get_all_orders()
-    return render_template('admin_orders.html', orders=orders)
+    page = order_model.get_all_orders_page(**page_args(), raw=True)
+    return render_template('admin_orders.html', orders=page["items"], page=page)
+
+#Exportacion para contabilidad: /admin/export/orders?format=csv&from=2024-01-01&to=2024-01-31&status=Pagado&gzip=1
+#Se manda a medida que se lee de Mongo, sin armar el archivo en memoria
+@app.route('/admin/export/<kind>')
+@admin_required
+def export_data(kind):
+    fmt = request.args.get('format', 'csv')
+    compress = request.args.get('gzip') == '1'
+    try:
+        chunks = export_chunks(get_db(), kind, fmt, request.args.get('from'), request.args.get('to'),
+                               request.args.get('status'), compress)
+    except ExportError as e:
+        return jsonify({"error": str(e)}), 400
+
+    mimetype = 'application/gzip' if compress else ('text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{export_filename(kind, fmt, compress)}"'
+    return response
 
 #Ordenes de los usuarios
 @app.route('/user/orders')
+@login_required
 def user_orders():
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
-    redis_client = get_redis_client()
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
+    user_id = get_current_user_id()
     
     db = get_db()
     order_model = Order(db)
     
     #Obtiene las ordenes del usuario
-    orders = order_model.get_orders_by_user(user_id)
+    page = order_model.get_orders_by_user_page(user_id, **page_args(), raw=True)
     
-    return render_template('user_orders.html', orders=orders)
+    return render_template('user_orders.html', orders=page["items"], page=page)
 
 #Se crean las ordenes
 @app.route('/create_order', methods=['POST'])
+@login_required
 def create_order():
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
     redis_client = get_redis_client()
     db = get_db()
 
-    user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
-    user_name = redis_client.hget(f"user:{user_id}", "name").decode('utf-8')
-    user_address = redis_client.hget(f"user:{user_id}", "address").decode('utf-8')
+    user = get_current_user()
+    user_id = user['user_id']
+    user_name = user.get('name')
+    user_address = user.get('address')
 
-    order_number = redis_client.incr('order_number')
-    print(order_number)
-
-    cart_model = Cart(db)
+    cart_model = get_cart_model(db)
     order_model = Order(db)
-    product_model = Product(db)
+    product_model = get_product_model(db)
 
-    cart_model = Cart(db)
     cart_id = f"{user_id}"
     items = cart_model.get_cart(cart_id)
-    total = sum(item['quantity'] * get_product_price(item['productId'], db) for item in items)
+    products = product_model.get_products(str(item["productId"]) for item in items)
+    total = 0
 
     #Maneja los casos donde no hay suficiente stock
     for item in items:
         item["productId"] = str(item["productId"])
-        product = product_model.get_product(item["productId"])        
-        if product["stock"] < item["quantity"]:
-            return redirect(url_for('error'))
+        product = products.get(item["productId"])
+        if not product or product.get("isDeleted") or product["stock"] < item["quantity"]:
+            return redirect(url_for('error', product=[item.get("name", item["productId"])]))
 
-        item_price = get_product_price(item["productId"], db)
-        item["price"] = item_price
+        item["price"] = product["price"]
+        total += item["quantity"] * item["price"]
 
-    for item in items:
-        product_model.decrement_stock(item["productId"], item["quantity"])
-
-    order_info = {
-        "order_number": order_number,
-        "user_id": user_id,
-        "name": user_name,
-        "address": user_address,
-        "items": items,
-        "total": total,
-        "status": "Pendiente de pago"
-    }
+    #Descuenta el stock de todos los productos juntos, si alguno no alcanza no se descuenta nada
+    failed = product_model.reserve_stock(items)
+    if failed:
+        names = [products[product_id]["name"] for product_id in failed if product_id in products]
+        return redirect(url_for('error', product=names))
+
+    #El numero de orden se pide recien con el stock reservado, asi las ordenes
+    #rechazadas no gastan numeros. Si algo falla despues se devuelve el stock
+    try:
+        order_number = redis_client.incr('order_number')
+        order_info = {
+            "order_number": order_number,
+            "user_id": user_id,
+            "name": user_name,
+            "address": user_address,
+            "items": items,
+            "total": total,
+            "status": "Pendiente de pago",
+            "date": datetime.utcnow()
+        }
         # Utilizar el modelo Order para guardar la información de la orden
-    order_model.insert_order(order_info)
+        order_model.insert_order(order_info)
+    except Exception:
+        product_model.release_stock(items)
+        raise
     cart_model.update_cart(cart_id, {"items": []})
     
     return redirect(url_for('view_order_details', order_id=order_number))
 
 #Te lleva a ver todas las ordenes que tuvo el usuario en la pagina web solo si tenes ROL CLIENT
 @app.route('/order/<order_id>') 
+@login_required
 def view_order_details(order_id):
-    if 'token' not in session:
-        return redirect(url_for('auth.login'))
-    
     db = get_db()
     order_model = Order(db)
     order = order_model.get_order(order_id)
@@ -583,5 +656,14 @@ def test_redis():
     except Exception as e:
         return str(e)
 
+#Estadisticas de los pools de conexiones de este worker. Solo para admins, como
+#/metrics (que ademas las exporta) no tiene que quedar publico
+@app.route('/test_pools')
+@admin_required
+def test_pools():
+    return jsonify({"mongo": get_pool_stats(), "redis": get_redis_pool_stats()})
+
 if __name__ == '__main__':
+    #En produccion correr "python utils/indexes.py" en cada deploy
+    ensure_indexes(get_db())
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,244 @@
+import asyncio
+import os
+from quart import Quart, render_template, request, redirect, url_for, session, g, Response
+from markupsafe import Markup
+from utils.async_db import get_async_db, get_async_redis, close_async_clients
+from utils.current_user import _decode_user
+from utils.serializer import dumps, parse_fields, field_projection, select_fields
+from utils.page_cache import PAGE_CACHE_ENABLED, TEMPLATES_HASH, page_key, _etag
+from models.async_models import get_async_product_model, async_catalog_cache, AsyncCart, AsyncOrder, AsyncUser
+
+#Modo async para las lecturas mas usadas (home, listado, detalle, busqueda y los
+#GET de /api). Se corre con un servidor ASGI al lado de la app WSGI (app.py), que
+#sigue atendiendo todo lo demas:
+#   hypercorn async_app:app --bind 0.0.0.0:8001 --workers 4
+#El proxy manda a este proceso solo los GET de esas rutas. Usa los mismos
+#templates, la misma cookie de sesion (SECRET_KEY tiene que ser el mismo en los
+#dos) y las mismas claves de cache del catalogo y de paginas en Redis
+
+app = Quart(__name__)
+app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
+
+#Rutas que atiende app.py. Se registran sin vista para que url_for funcione en los templates
+app.add_url_rule('/auth/logout', 'auth.logout', methods=['POST'])
+app.add_url_rule('/media/<variant>/<filename>', 'product_image')
+
+
+@app.template_global()
+def image_url(path, variant='detail'):
+    return url_for('product_image', variant=variant, filename=os.path.basename(path))
+
+
+def page_args():
+    return {
+        "after": request.args.get('after'),
+        "before": request.args.get('before'),
+        "per_page": request.args.get('per_page', type=int)
+    }
+
+
+#Misma logica que utils.current_user.get_current_user, con redis.asyncio
+async def load_current_user():
+    user = None
+    token = session.get('token')
+    if token:
+        redis_client = get_async_redis()
+        user_id = session.get('user_id')
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.get(f"session:{token}")
+        if user_id:
+            pipe.hgetall(f"user:{user_id}")
+        session_user, *user_data = await pipe.execute()
+        user_data = user_data[0] if user_data else None
+
+        if session_user is None:
+            #La sesion expiro en Redis, se limpia la cookie. Si no, base.html
+            #dibuja la barra con sesion y la pagina se guarda como anonima
+            _clear_session()
+        else:
+            session_user = session_user.decode('utf-8')
+            if session_user != user_id or not user_data:
+                user_data = await redis_client.hgetall(f"user:{session_user}")
+                session['user_id'] = session_user
+            if user_data:
+                user = _decode_user(session_user, user_data)
+            else:
+                _clear_session()
+    return user
+
+
+def _clear_session():
+    session.pop('token', None)
+    session.pop('user_id', None)
+
+
+#Usuario y cantidad del carrito para la barra de navegacion. La cantidad se lee
+#del carrito, como en app.py
+async def load_user_context():
+    user = await load_current_user()
+    cart_count = 0
+    if user:
+        cart_count = await AsyncCart(get_async_db()).get_cart_count(user["user_id"])
+    g.current_user = user
+    g.cart_count = cart_count
+
+
+@app.context_processor
+async def inject_user():
+    user = g.get('current_user')
+    return dict(user_role=user.get('role') if user else None, cart_count=g.get('cart_count', 0))
+
+
+#Misma logica que utils.page_cache.cached_fragment, con las mismas claves
+async def cached_fragment(key, render):
+    if not PAGE_CACHE_ENABLED:
+        return Markup(await render())
+    return Markup(await async_catalog_cache.get_or_load(f"fragment:{TEMPLATES_HASH}:{key}", render))
+
+
+#Misma logica que utils.page_cache.cached_page: para anonimos la pagina entera se
+#guarda con las mismas claves (page:...) que app.py, con sesion se renderiza y se
+#manda privada. En los dos casos con ETag y 304. Con sesion las consultas del
+#catalogo y las del usuario se hacen en paralelo. load devuelve None si no hay pagina
+async def render_page(template, load, **context):
+    data = None
+    if session.get('token'):
+        _, data = await asyncio.gather(load_user_context(), load())
+        if data is None:
+            return None
+    else:
+        g.current_user, g.cart_count = None, 0
+
+    async def render():
+        nonlocal data
+        if data is None:
+            data = await load()
+            if data is None:
+                return None
+        html = await render_template(template, **context, **data)
+        return {"html": html, "etag": _etag(html)}
+
+    if g.current_user or not PAGE_CACHE_ENABLED:
+        page = await render()
+    else:
+        page = await async_catalog_cache.get_or_load(
+            f"page:{TEMPLATES_HASH}:{page_key(request.path, request.args)}", render)
+    if page is None:
+        return None
+    if request.if_none_match.contains(page["etag"]):
+        response = Response("", status=304)
+    else:
+        response = Response(page["html"])
+    response.set_etag(page["etag"])
+    response.headers['Cache-Control'] = 'private, no-cache' if g.current_user else 'public, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+@app.route('/')
+async def index():
+    product_model = get_async_product_model(get_async_db())
+
+    async def load():
+        #En el home solo se muestran los 3 destacados
+        page = await product_model.get_active_products_page(per_page=3)
+        return {"products": page["items"]}
+    return await render_page('home.html', load)
+
+
+@app.route('/products')
+async def products_page():
+    product_model = get_async_product_model(get_async_db())
+
+    async def load():
+        page = await product_model.get_active_products_page(**page_args())
+        product_grid = await cached_fragment(f"grid:{page_key(request.path, request.args)}",
+                                             lambda: render_template('_product_grid.html', products=page["items"]))
+        return {"page": page, "product_grid": product_grid}
+    return await render_page('products.html', load)
+
+
+@app.route('/product/<product_id>')
+async def product_detail(product_id):
+    product_model = get_async_product_model(get_async_db())
+
+    async def load():
+        product = await product_model.get_product(product_id)
+        if not product:
+            return None
+        product_body = await cached_fragment(f"detail:{product_id}",
+                                             lambda: render_template('_product_detail_body.html', product=product))
+        return {"product": product, "product_body": product_body}
+    response = await render_page('product_detail.html', load)
+    if response is None:
+        return "Product not found", 404
+    return response
+
+
+@app.route('/search')
+async def search():
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return redirect(url_for('products_page'))
+    page_number = request.args.get('page', 1, type=int)
+    product_model = get_async_product_model(get_async_db())
+
+    async def load():
+        products, has_next = await product_model.search_products(query, page_number)
+        product_grid = await cached_fragment(f"grid:{page_key(request.path, request.args)}",
+                                             lambda: render_template('_product_grid.html', products=products))
+        return {"product_grid": product_grid, "has_next": has_next}
+    return await render_page('products.html', load, query=query, page_number=page_number)
+
+
+def json_response(value, status=200):
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+#GET de /api, con las mismas respuestas que los blueprints de routes/
+@app.route('/api/product/<product_id>')
+async def api_get_product(product_id):
+    product = await get_async_product_model(get_async_db()).get_product(product_id)
+    return json_response(select_fields(product, parse_fields(request.args.get('fields'))))
+
+
+@app.route('/api/products')
+async def api_get_all_products():
+    #Con ?fields=... solo se leen de Mongo los campos pedidos
+    fields = parse_fields(request.args.get('fields'))
+    page = await get_async_product_model(get_async_db()).get_all_products_page(
+        **page_args(), view=field_projection(fields) or "detail"
+    )
+    return json_response({
+        "products": [select_fields(product, fields) for product in page["items"]],
+        "next": page["next"],
+        "prev": page["prev"]
+    })
+
+
+@app.route('/api/user/<user_id>')
+async def api_get_user(user_id):
+    user = await AsyncUser(get_async_db()).get_user(user_id)
+    return json_response(select_fields(user, parse_fields(request.args.get('fields'))))
+
+
+@app.route('/api/cart/<cart_id>')
+async def api_get_cart(cart_id):
+    fields = parse_fields(request.args.get('fields'))
+    cart = await AsyncCart(get_async_db()).get_cart(cart_id)
+    return json_response([select_fields(item, fields) for item in cart])
+
+
+@app.route('/api/order/<order_id>')
+async def api_get_order(order_id):
+    order = await AsyncOrder(get_async_db()).get_order(order_id)
+    return json_response(select_fields(order, parse_fields(request.args.get('fields'))))
+
+
+@app.after_serving
+async def shutdown():
+    await close_async_clients()
+
+
+if __name__ == '__main__':
+    app.run(debug=True, port=8001)
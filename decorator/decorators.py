@@ -1,19 +1,24 @@
 from functools import wraps
-from flask import session, redirect, url_for, flash
-from utils.redis_client import get_redis_client
-from datetime import datetime, timedelta
+from flask import redirect, url_for, flash
+from utils.current_user import get_current_user
 
-def admin_required(f):
+def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'token' not in session:
+        if not get_current_user():
             return redirect(url_for('auth.login'))
 
-        redis_client = get_redis_client()
-        user_id = redis_client.get(f"session:{session['token']}").decode('utf-8')
-        user_role = redis_client.hget(f"user:{user_id}", "role").decode('utf-8')
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        user = get_current_user()
+        if not user:
+            return redirect(url_for('auth.login'))
 
-        if user_role != 'admin':
+        if user.get('role') != 'admin':
             flash("You do not have permission to access this page.", "danger")
             return redirect(url_for('index'))
 
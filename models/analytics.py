@@ -0,0 +1,258 @@
+import os
+from datetime import datetime
+from pymongo import DESCENDING, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from utils.db import get_db, supports_transactions
+from utils.jobs import deferrable
+
+#Resumenes de ventas ya agregados. Se actualizan con $inc cada vez que se crea
+#una orden, cambia su estado o se registra un pago, asi el dashboard no tiene
+#que recorrer orders ni payments. Todos los documentos son por dia y tienen
+#contadores simples (ningun dato del usuario se usa como nombre de campo):
+#  day          -> _id "day:<dia>": orders, ordered_total, payments, revenue
+#  product      -> _id "product:<dia>:<productId>": name, units, sales
+#  status       -> _id "status:<dia>:<estado>": count (+1 al entrar, -1 al salir)
+#  method       -> _id "method:<dia>:<metodo>": count, amount
+#  installments -> _id "installments:<dia>:<cuotas>": count
+#Cada evento (orden, pago, cambio de estado) tiene un id y se suma una sola vez
+#aunque el trabajo se reintente:
+#  - Con transacciones (replica set) el id se inserta en sales_rollup_events (es
+#    el _id, unico) en la misma transaccion que los $inc: si ya estaba, el evento
+#    ya se sumo. Los resumenes son solo contadores.
+#  - Sin transacciones cada documento guarda en "events" los ids que ya sumo y
+#    cada update tiene el filtro {"events": {"$ne": id}}, asi cada upsert es
+#    idempotente por si solo aunque el trabajo se corte a la mitad. La lista es
+#    por documento del dia, asi que crece con las ventas del dia
+ROLLUPS_COLLECTION = "sales_rollups"
+EVENTS_COLLECTION = "sales_rollup_events"
+#Cuanto se recuerdan los eventos ya sumados (indice TTL sobre created_at, ver
+#utils/indexes.py). Tiene que cubrir los reintentos de la cola y retry_dead
+ANALYTICS_EVENT_RETENTION_DAYS = int(os.environ.get("ANALYTICS_EVENT_RETENTION_DAYS", 30))
+
+#Medios de pago que acepta el checkout (templates/checkout.html)
+PAYMENT_METHODS = ("cash", "credit", "debit")
+
+#Las lecturas no necesitan la lista de eventos (sin transacciones)
+READ_PROJECTION = {"events": 0}
+
+
+#Se usa para abortar la transaccion cuando el evento ya se sumo
+class _AlreadyApplied(Exception):
+    pass
+
+def _day(date):
+    return (date or datetime.utcnow()).strftime("%Y-%m-%d")
+
+
+#Un documento a actualizar: (_id, $inc, $set). _apply arma el UpdateOne
+def _op(_id, inc, fields):
+    return _id, inc, fields
+
+
+def _day_op(day, inc):
+    return _op(f"day:{day}", inc, {"kind": "day", "day": day})
+
+
+def _status_op(day, status, amount):
+    return _op(f"status:{day}:{status}", {"count": amount}, {"kind": "status", "day": day, "status": status})
+
+
+class SalesAnalytics:
+    def __init__(self, db):
+        self.collection = db[ROLLUPS_COLLECTION]
+        self.events = db[EVENTS_COLLECTION]
+
+    #Aplica las operaciones de un evento si todavia no se sumo. Devuelve False si ya estaba
+    def _apply(self, event_id, ops):
+        client = self.collection.database.client
+        if supports_transactions(client):
+            return self._apply_in_transaction(client, event_id, ops)
+        return self._apply_guarded(event_id, ops)
+
+    #La marca y los $inc se guardan juntos: o se sumo todo o no se sumo nada
+    def _apply_in_transaction(self, client, event_id, ops):
+        updates = [UpdateOne({"_id": _id}, {"$inc": inc, "$set": fields}, upsert=True)
+                   for _id, inc, fields in ops]
+
+        def apply(session):
+            try:
+                self.events.insert_one({"_id": event_id, "created_at": datetime.utcnow()}, session=session)
+            except DuplicateKeyError:
+                raise _AlreadyApplied()
+            self.collection.bulk_write(updates, ordered=False, session=session)
+
+        try:
+            with client.start_session() as session:
+                session.with_transaction(apply)
+        except _AlreadyApplied:
+            return False
+        return True
+
+    #Si el documento ya tiene el evento el filtro no coincide y el upsert choca con
+    #el _id existente (clave duplicada): ese documento ya estaba sumado
+    def _apply_guarded(self, event_id, ops):
+        updates = [UpdateOne({"_id": _id, "events": {"$ne": event_id}},
+                             {"$inc": inc, "$set": fields, "$addToSet": {"events": event_id}}, upsert=True)
+                   for _id, inc, fields in ops]
+        try:
+            self.collection.bulk_write(updates, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            return len(errors) < len(updates)
+        return True
+
+    def record_order(self, order_info):
+        day = _day(order_info.get("date"))
+        event_id = f"order:{order_info['order_number']}"
+        ops = [
+            _day_op(day, {"orders": 1, "ordered_total": order_info["total"]}),
+            _status_op(day, order_info["status"], 1),
+        ]
+        for item in order_info["items"]:
+            ops.append(_op(
+                f"product:{day}:{item['productId']}",
+                {"units": item["quantity"], "sales": item["quantity"] * item["price"]},
+                {"kind": "product", "day": day, "productId": str(item["productId"]), "name": item.get("name")}
+            ))
+        self._apply(event_id, ops)
+
+    def record_status_change(self, order_number, old_status, new_status, changed_at=None):
+        if old_status == new_status:
+            return
+        changed_at = changed_at or datetime.utcnow()
+        day = _day(changed_at)
+        event_id = f"status:{order_number}:{changed_at.isoformat()}"
+        ops = [_status_op(day, new_status, 1)]
+        if old_status:
+            ops.append(_status_op(day, old_status, -1))
+        self._apply(event_id, ops)
+
+    def record_payment(self, payment_info):
+        day = _day(payment_info.get("date"))
+        event_id = f"payment:{payment_info['order_number']}"
+        method = payment_info["payment_method"]
+        if method not in PAYMENT_METHODS:
+            method = "other"
+        installments = int(payment_info.get("installments") or 1)
+        self._apply(event_id, [
+            _day_op(day, {"payments": 1, "revenue": payment_info["total"]}),
+            _op(f"method:{day}:{method}", {"count": 1, "amount": payment_info["total"]},
+                {"kind": "method", "day": day, "method": method}),
+            _op(f"installments:{day}:{installments}", {"count": 1},
+                {"kind": "installments", "day": day, "installments": installments}),
+        ])
+
+    #Lecturas del dashboard, solo tocan sales_rollups
+    def get_daily(self, days=30):
+        rows = list(self.collection.find({"kind": "day"}, READ_PROJECTION).sort("day", DESCENDING).limit(days))
+        rows.reverse()
+        return rows
+
+    def get_top_products(self, limit=10):
+        return list(self.collection.aggregate([
+            {"$match": {"kind": "product"}},
+            {"$group": {"_id": "$productId", "name": {"$last": "$name"},
+                        "units": {"$sum": "$units"}, "sales": {"$sum": "$sales"}}},
+            {"$sort": {"units": -1}},
+            {"$limit": limit},
+        ]))
+
+    def get_summary(self):
+        summary = {"status": {}, "methods": {}, "installments": {}}
+        for row in self.collection.aggregate([
+            {"$match": {"kind": {"$in": ["status", "method", "installments"]}}},
+            {"$group": {"_id": {"kind": "$kind", "key": {"$ifNull": ["$status", {"$ifNull": ["$method", "$installments"]}]}},
+                        "count": {"$sum": "$count"}, "amount": {"$sum": "$amount"}}},
+        ]):
+            kind, key = row["_id"]["kind"], row["_id"]["key"]
+            if kind == "status":
+                if row["count"]:
+                    summary["status"][key] = row["count"]
+            elif kind == "method":
+                summary["methods"][key] = {"count": row["count"], "amount": row["amount"]}
+            else:
+                summary["installments"][str(key)] = row["count"]
+        return summary
+
+    #Recalcula todo desde orders y payments con agregaciones (para la primera vez,
+    #si los contadores se desfasaron o para pasar del formato anterior). Los
+    #estados se cuentan en el dia de la orden. Conviene correrlo fuera del horario de ventas
+    def backfill(self, db):
+        #Las ordenes y pagos viejos no tienen fecha, se usa la de creacion del _id
+        day = {"$dateToString": {"format": "%Y-%m-%d", "date": {"$ifNull": ["$date", {"$toDate": "$_id"}]}}}
+        docs = {}
+
+        for row in db.orders.aggregate([
+            {"$group": {"_id": day, "orders": {"$sum": 1}, "ordered_total": {"$sum": "$total"}}}
+        ]):
+            docs[f"day:{row['_id']}"] = {"kind": "day", "day": row["_id"], "orders": row["orders"],
+                                         "ordered_total": row["ordered_total"], "payments": 0, "revenue": 0}
+
+        for row in db.payments.aggregate([
+            {"$group": {"_id": day, "payments": {"$sum": 1}, "revenue": {"$sum": "$total"}}}
+        ]):
+            doc = docs.setdefault(f"day:{row['_id']}", {"kind": "day", "day": row["_id"], "orders": 0, "ordered_total": 0})
+            doc.update(payments=row["payments"], revenue=row["revenue"])
+
+        for row in db.orders.aggregate([
+            {"$unwind": "$items"},
+            {"$group": {
+                "_id": {"day": day, "productId": "$items.productId"},
+                "name": {"$last": "$items.name"},
+                "units": {"$sum": "$items.quantity"},
+                "sales": {"$sum": {"$multiply": ["$items.quantity", "$items.price"]}},
+            }}
+        ]):
+            key = row["_id"]
+            docs[f"product:{key['day']}:{key['productId']}"] = {
+                "kind": "product", "day": key["day"], "productId": str(key["productId"]), "name": row["name"],
+                "units": row["units"], "sales": row["sales"]}
+
+        for row in db.orders.aggregate([{"$group": {"_id": {"day": day, "status": "$status"}, "count": {"$sum": 1}}}]):
+            key = row["_id"]
+            if key.get("status"):
+                docs[f"status:{key['day']}:{key['status']}"] = {"kind": "status", "day": key["day"],
+                                                                 "status": key["status"], "count": row["count"]}
+
+        for row in db.payments.aggregate([
+            {"$group": {"_id": {"day": day, "method": "$payment_method"}, "count": {"$sum": 1}, "amount": {"$sum": "$total"}}}
+        ]):
+            key = row["_id"]
+            method = key.get("method") if key.get("method") in PAYMENT_METHODS else "other"
+            doc = docs.setdefault(f"method:{key['day']}:{method}", {"kind": "method", "day": key["day"], "method": method,
+                                                                    "count": 0, "amount": 0})
+            doc["count"] += row["count"]
+            doc["amount"] += row["amount"]
+        for row in db.payments.aggregate([{"$group": {"_id": {"day": day, "installments": "$installments"}, "count": {"$sum": 1}}}]):
+            key = row["_id"]
+            installments = int(key.get("installments") or 1)
+            doc = docs.setdefault(f"installments:{key['day']}:{installments}", {
+                "kind": "installments", "day": key["day"], "installments": installments, "count": 0})
+            doc["count"] += row["count"]
+
+        #Los documentos se reemplazan enteros y sin transacciones pierden la lista
+        #"events": los trabajos que estaban en la cola (o se reintentan) pueden volver
+        #a sumar, conviene correrlo con la cola vacia
+        if docs:
+            self.collection.bulk_write([ReplaceOne({"_id": _id}, doc, upsert=True) for _id, doc in docs.items()])
+        self.collection.delete_many({"_id": {"$nin": list(docs)}})
+        return len(docs)
+
+
+#Se encolan desde Order y Payment, el request no espera la actualizacion
+@deferrable
+def record_order(order_info):
+    SalesAnalytics(get_db()).record_order(order_info)
+
+
+#changed_at identifica el cambio: los reintentos del trabajo traen el mismo valor
+@deferrable
+def record_status_change(order_number, old_status, new_status, changed_at=None):
+    SalesAnalytics(get_db()).record_status_change(order_number, old_status, new_status, changed_at)
+
+
+@deferrable
+def record_payment(payment_info):
+    SalesAnalytics(get_db()).record_payment(payment_info)
@@ -0,0 +1,233 @@
+import asyncio
+import copy
+import os
+import time
+import redis
+from bson import json_util
+from pymongo import ASCENDING, DESCENDING
+from models.product import PROJECTIONS, ORDER_PROJECTION, ACTIVE_FILTER, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
+from models.order import PROJECTIONS as ORDER_PROJECTIONS
+from models.cart import Cart, CART_BACKEND, CART_COUNT_TTL, COUNT_PROJECTION, REDIS_CART_TTL, _LOAD_SCRIPT, _STORE_COUNT_SCRIPT
+from models.catalog_cache import (LocalLRU, CATALOG_CACHE_ENABLED, CATALOG_LOCAL_SIZE, CATALOG_LOCAL_TTL,
+                                  CATALOG_LOAD_WAIT, CATALOG_REDIS_TTL, CATALOG_VERSION_CHECK, VERSION_KEY, _MISSING)
+from utils.async_db import get_async_redis
+from utils.pagination import async_keyset_page
+
+#Variantes async de los modelos para las lecturas del modo async (async_app.py).
+#Usan AsyncMongoClient y redis.asyncio, y las mismas proyecciones, filtros y
+#claves de cache que los modelos sincronicos, asi los dos modos comparten datos
+
+
+#Cache del catalogo para el modo async. Usa las mismas claves versionadas que
+#CatalogCache (models/catalog_cache.py), asi lo que carga un modo lo lee el otro.
+#Si varias tareas piden la misma clave a la vez se carga una sola vez, y entre
+#procesos (de los dos modos) la carga una sola con el mismo lock en Redis
+class AsyncCatalogCache:
+    def __init__(self, redis_client=None):
+        self._redis_client = redis_client
+        self.local = LocalLRU(CATALOG_LOCAL_SIZE, CATALOG_LOCAL_TTL)
+        self._version = None
+        self._version_checked_at = 0
+        self._loading = {}
+
+    @property
+    def redis_client(self):
+        return self._redis_client or get_async_redis()
+
+    async def version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked_at > CATALOG_VERSION_CHECK:
+            try:
+                self._version = int(await self.redis_client.get(VERSION_KEY) or 0)
+            except redis.RedisError:
+                self._version = self._version or 0
+            self._version_checked_at = now
+        return self._version
+
+    async def get_or_load(self, key, loader):
+        full_key = f"catalog:v{await self.version()}:{key}"
+        value = self.local.get(full_key)
+        if value is _MISSING:
+            task = self._loading.get(full_key)
+            if task is None:
+                task = asyncio.ensure_future(self._load_shared(full_key, loader))
+                self._loading[full_key] = task
+                task.add_done_callback(lambda _: self._loading.pop(full_key, None))
+            value = await asyncio.shield(task)
+            self.local.set(full_key, value)
+        return copy.deepcopy(value)
+
+    #Igual que CatalogCache._load_shared: busca en Redis; si no esta, un solo
+    #proceso la carga de Mongo y los demas esperan
+    async def _load_shared(self, full_key, loader):
+        try:
+            raw = await self.redis_client.get(full_key)
+            if raw is not None:
+                return json_util.loads(raw)
+            lock_key = f"{full_key}:lock"
+            if await self.redis_client.set(lock_key, os.getpid(), nx=True, ex=max(1, int(CATALOG_LOAD_WAIT * 2))):
+                try:
+                    value = await loader()
+                    await self.redis_client.set(full_key, json_util.dumps(value), ex=CATALOG_REDIS_TTL)
+                    return value
+                finally:
+                    await self.redis_client.delete(lock_key)
+
+            deadline = time.monotonic() + CATALOG_LOAD_WAIT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+                raw = await self.redis_client.get(full_key)
+                if raw is not None:
+                    return json_util.loads(raw)
+        except redis.RedisError:
+            pass
+        #Redis no responde o el otro proceso tardo demasiado, se carga directo
+        return await loader()
+
+
+async_catalog_cache = AsyncCatalogCache()
+
+
+class AsyncProduct:
+    def __init__(self, db, cache=None):
+        self.collection = db['products']
+        self.cache = cache
+
+    async def get_product(self, product_id):
+        return await self._cached(f"product:{product_id}",
+                                  lambda: self.collection.find_one({"productId": product_id}, PROJECTIONS["detail"]))
+
+    async def get_products(self, product_ids, projection=None):
+        product_ids = list(set(product_ids))
+        if not product_ids:
+            return {}
+        cursor = self.collection.find({"productId": {"$in": product_ids}}, projection or ORDER_PROJECTION)
+        return {product["productId"]: product async for product in cursor}
+
+    async def get_active_products_page(self, after=None, before=None, per_page=None, view="card"):
+        return await self._cached(
+            f"active:{view}:{after}:{before}:{per_page}",
+            lambda: async_keyset_page(self.collection, ACTIVE_FILTER, "_id", ASCENDING, after=after, before=before,
+                                      per_page=per_page, projection=self._projection(view))
+        )
+
+    async def get_all_products_page(self, after=None, before=None, per_page=None, view="detail"):
+        return await async_keyset_page(self.collection, {}, "_id", ASCENDING, after=after, before=before,
+                                       per_page=per_page, projection=self._projection(view))
+
+    #Misma busqueda que Product.search_products, con el indice de texto
+    async def search_products(self, query, page=1, per_page=SEARCH_PAGE_SIZE, view="card"):
+        async def load():
+            size = max(1, min(per_page, SEARCH_MAX_PAGE_SIZE))
+            skip = (max(page, 1) - 1) * size
+            text_filter = dict(ACTIVE_FILTER, **{"$text": {"$search": query}})
+            projection = dict(PROJECTIONS[view] or {}, score={"$meta": "textScore"})
+            products = await (self.collection.find(text_filter, projection)
+                              .sort([("score", {"$meta": "textScore"})])
+                              .skip(skip).limit(size + 1).to_list())
+            return products[:size], len(products) > size
+
+        return tuple(await self._cached(f"search:{view}:{query.lower()}:{page}:{per_page}", load))
+
+    def _projection(self, view):
+        return view if isinstance(view, dict) else PROJECTIONS[view]
+
+    async def _cached(self, key, loader):
+        if self.cache is None:
+            return await loader()
+        return await self.cache.get_or_load(key, loader)
+
+
+class AsyncCart:
+    def __init__(self, db, redis_client=None):
+        self.collection = db['carts']
+        self.redis_client = redis_client or get_async_redis()
+
+    def _keys(self, cart_id):
+        return [f"cart:{cart_id}:items", f"cart:{cart_id}:names", f"cart:{cart_id}:count"]
+
+    #Con el backend de Redis se lee de ahi, como RedisCart.get_cart: los cambios
+    #que todavia no se guardaron en Mongo solo estan en Redis (y no vencen hasta
+    #el flush). Si el carrito no esta cargado se carga desde Mongo con el mismo
+    #script y se vuelve a leer, por si una escritura lo cargo al mismo tiempo
+    async def get_cart(self, cart_id):
+        if CART_BACKEND != "redis":
+            return await self._get_mongo_items(cart_id)
+        for _ in range(2):
+            items_key, names_key, count_key = self._keys(cart_id)
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.hgetall(items_key)
+            pipe.hgetall(names_key)
+            pipe.exists(count_key)
+            quantities, names, loaded = await pipe.execute()
+            if loaded:
+                return [
+                    {
+                        "productId": product_id.decode('utf-8'),
+                        "quantity": int(quantity),
+                        "name": names.get(product_id, b"").decode('utf-8')
+                    }
+                    for product_id, quantity in quantities.items()
+                ]
+            await self._load_from_mongo(cart_id)
+        return await self._get_mongo_items(cart_id)
+
+    #Con el backend de Mongo se lee la cantidad guardada en Redis (cart:<id>:badge),
+    #como Cart.get_cart_count, y solo si no esta se cuenta en Mongo y se guarda
+    async def get_cart_count(self, cart_id):
+        if CART_BACKEND == "redis":
+            count = await self.redis_client.get(self._keys(cart_id)[2])
+            if count is None:
+                count = await self._load_from_mongo(cart_id)
+            return int(count)
+        count_key = f"cart:{cart_id}:badge"
+        count = await self.redis_client.hget(count_key, "count")
+        if count is not None:
+            return int(count)
+        cart = await self.collection.find_one({"cartId": cart_id}, COUNT_PROJECTION)
+        count = Cart._count_items(None, cart)
+        await self.redis_client.register_script(_STORE_COUNT_SCRIPT)(
+            keys=[count_key], args=[cart.get("version", 0) if cart else 0, count, CART_COUNT_TTL])
+        return count
+
+    async def _get_mongo_items(self, cart_id):
+        cart = await self.collection.find_one({"cartId": cart_id})
+        items = cart.get("items", []) if cart else []
+        for item in items:
+            item["productId"] = str(item["productId"])
+        return items
+
+    #Devuelve la cantidad que quedo en Redis (la de otra request si lo cargo antes)
+    async def _load_from_mongo(self, cart_id):
+        items = await self._get_mongo_items(cart_id)
+        args = [REDIS_CART_TTL, Cart._count_items(None, {"items": items})]
+        for item in items:
+            args += [item["productId"], item["quantity"], item.get("name", "")]
+        return await self.redis_client.register_script(_LOAD_SCRIPT)(keys=self._keys(cart_id), args=args)
+
+
+class AsyncOrder:
+    def __init__(self, db):
+        self.db = db
+
+    async def get_order(self, order_id):
+        return await self.db.orders.find_one({"order_number": int(order_id)})
+
+    async def get_orders_by_user_page(self, user_id, after=None, before=None, per_page=None, view="row"):
+        return await async_keyset_page(self.db.orders, {"user_id": user_id}, "order_number", DESCENDING,
+                                       after=after, before=before, per_page=per_page, unique=True,
+                                       projection=ORDER_PROJECTIONS[view])
+
+
+class AsyncUser:
+    def __init__(self, db):
+        self.collection = db['users']
+
+    async def get_user(self, user_id):
+        return await self.collection.find_one({"userId": user_id})
+
+
+def get_async_product_model(db):
+    if CATALOG_CACHE_ENABLED:
+        return AsyncProduct(db, async_catalog_cache)
+    return AsyncProduct(db)
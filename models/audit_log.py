@@ -0,0 +1,167 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+from utils.pagination import keyset_page
+
+#Cuanto se guardan los logs (despues Mongo los borra solo)
+AUDIT_RETENTION_DAYS = int(os.environ.get("AUDIT_RETENTION_DAYS", 365))
+#El buffer se guarda al llegar a AUDIT_BATCH_SIZE eventos o cada AUDIT_FLUSH_INTERVAL segundos
+AUDIT_BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", 500))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", 2))
+#Maximo de eventos en memoria si no se pueden guardar (ej. Mongo caido); al
+#pasarlo se descartan los mas viejos
+AUDIT_MAX_BUFFER = int(os.environ.get("AUDIT_MAX_BUFFER", 10000))
+
+AUDIT_COLLECTION = "audit_logs"
+DUPLICATE_KEY = 11000
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog:
+    def __init__(self, db):
+        self.collection = db[AUDIT_COLLECTION]
+
+    #timestamp es la hora de la accion, cuando el log se guarda despues (en un worker)
+    def insert_log(self, action, product_id, user_id, details, changes=None, timestamp=None):
+        return self.collection.insert_one(build_entry(action, product_id, user_id, details, changes, timestamp))
+
+    #Cada entrada trae su _id (build_entry): si se reintenta un lote que ya se
+    #guardo en parte, los repetidos fallan por clave duplicada y se ignoran
+    def insert_logs(self, entries):
+        if not entries:
+            return
+        try:
+            self.collection.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            if failed_entries(entries, e):
+                raise
+
+    #Logs del mas nuevo al mas viejo, de a una pagina. Se puede filtrar por
+    #producto, usuario y accion (cada filtro tiene su indice, ver utils/indexes.py)
+    def get_logs_page(self, product_id=None, after=None, before=None, per_page=None, user_id=None, action=None):
+        filters = {"product_id": product_id, "user_id": user_id, "action": action}
+        query = {field: value for field, value in filters.items() if value}
+        return keyset_page(self.collection, query, "timestamp", DESCENDING,
+                           after=after, before=before, per_page=per_page)
+
+
+def build_entry(action, product_id, user_id, details, changes=None, timestamp=None):
+    return {
+        "_id": ObjectId(),
+        "action": action,
+        "product_id": product_id,
+        "user_id": user_id,
+        "timestamp": timestamp or datetime.utcnow(),
+        "details": details,
+        "changes": changes  #Aca mostramos los cambios
+    }
+
+
+#audit_logs es una coleccion comun con un indice TTL sobre timestamp (Mongo borra
+#los logs vencidos). No se usa time-series: sin un metaField que agrupe los logs,
+#los filtros por producto, usuario o accion tienen que abrir todos los buckets.
+#Si ya existe como time-series (version anterior) solo se ajusta la retencion
+def ensure_audit_collection(db):
+    retention = AUDIT_RETENTION_DAYS * 86400
+    info = next(iter(db.list_collections(filter={"name": AUDIT_COLLECTION})), None)
+    if info and info.get("type") == "timeseries":
+        if info.get("options", {}).get("expireAfterSeconds") != retention:
+            db.command("collMod", AUDIT_COLLECTION, expireAfterSeconds=retention)
+        return "time-series"
+    try:
+        db[AUDIT_COLLECTION].create_index([("timestamp", ASCENDING)], name="timestamp_ttl", expireAfterSeconds=retention)
+    except OperationFailure:
+        #Cambio la retencion, se actualiza el indice existente
+        db.command("collMod", AUDIT_COLLECTION, index={"name": "timestamp_ttl", "expireAfterSeconds": retention})
+    return "ttl index"
+
+
+#Entradas de un insert_many(ordered=False) que no se guardaron (las demas si,
+#igual que las que ya estaban por un intento anterior)
+def failed_entries(entries, error):
+    return [entries[write_error["index"]] for write_error in error.details.get("writeErrors", [])
+            if write_error["code"] != DUPLICATE_KEY]
+
+
+#Junta los eventos de auditoria en memoria y los manda de a lotes a sink (una
+#funcion que recibe la lista). Se vacia al llenarse, cada AUDIT_FLUSH_INTERVAL
+#segundos desde un thread de fondo y al terminar el proceso. Si sink falla los
+#eventos se guardan para el proximo intento, hasta max_buffer
+class AuditWriter:
+    def __init__(self, sink, batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL,
+                 max_buffer=AUDIT_MAX_BUFFER):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self._flusher_pid = None
+        atexit.register(self.flush)
+
+    def log(self, action, product_id, user_id, details, changes=None):
+        self.add(build_entry(action, product_id, user_id, details, changes))
+
+    def add(self, entry):
+        self._ensure_flusher()
+        with self.lock:
+            self.buffer.append(entry)
+            self._trim()
+            full = len(self.buffer) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            try:
+                self.sink(chunk)
+            except BulkWriteError as e:
+                #El resto del lote se guardo, solo se reintentan los que fallaron
+                self._requeue(failed_entries(chunk, e) + batch[start + len(chunk):], e)
+                return
+            except Exception as e:
+                self._requeue(batch[start:], e)
+                return
+
+    def _requeue(self, entries, error):
+        if not entries:
+            return
+        logger.warning("No se pudieron guardar %d logs de auditoria: %s", len(entries), error)
+        with self.lock:
+            self.buffer[:0] = entries
+            self._trim()
+
+    #Con el lock tomado
+    def _trim(self):
+        excess = len(self.buffer) - self.max_buffer
+        if excess > 0:
+            del self.buffer[:excess]
+            self.dropped += excess
+            logger.error("Buffer de auditoria lleno, se descartaron %d logs (%d en total)", excess, self.dropped)
+
+    #Un thread por proceso (despues de un fork el del padre no existe)
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._run_flusher, name="audit-flusher", daemon=True).start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.buffer:
+                self.flush()
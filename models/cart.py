@@ -1,11 +1,61 @@
+import os
 from bson import ObjectId
+from pymongo import ReturnDocument
+from utils.redis_client import get_redis_client
+
+#Solo traemos las cantidades (y la version) para poder devolver el total de items del carrito
+COUNT_PROJECTION = {"_id": 0, "items.quantity": 1, "version": 1}
+
+#Con el backend de Mongo la cantidad de la barra de navegacion se guarda en Redis
+#(cart:<id>:badge) con la version del carrito, que cada cambio incrementa. Las
+#operaciones guardan la cantidad que devuelven y get_cart_count solo va a Mongo
+#si no esta. Se escribe solo si la version es mayor: una lectura vieja o un
+#cambio que termina despues no pisan uno mas nuevo. create_cart y delete_cart
+#borran la clave (la version vuelve a empezar); el TTL acota el caso en que una
+#lectura vieja se cruza con ellos
+CART_COUNT_TTL = int(os.environ.get("CART_COUNT_TTL", 3600))
+
+#ARGV: version, count, ttl
+_STORE_COUNT_SCRIPT = """
+local stored = tonumber(redis.call('HGET', KEYS[1], 'version'))
+if stored and stored >= tonumber(ARGV[1]) then return 0 end
+redis.call('HSET', KEYS[1], 'version', ARGV[1], 'count', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+#Piezas de los updates con pipeline de add_to_cart y update_cart_quantity
+_ITEMS = {"$ifNull": ["$items", []]}
+_NEXT_VERSION = {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+
+
+#En un pipeline los valores son expresiones: un string que empieza con $ se
+#leeria como un campo, esos van con $literal
+def _literal(value):
+    return {"$literal": value} if isinstance(value, str) and value.startswith("$") else value
+
+
+#Items del carrito con la cantidad del producto reemplazada por la expresion quantity
+def _map_quantity(product_id, quantity):
+    return {"$map": {"input": _ITEMS, "as": "item", "in": {"$cond": [
+        {"$eq": ["$$item.productId", product_id]},
+        {"productId": "$$item.productId", "quantity": quantity, "name": "$$item.name"},
+        "$$item",
+    ]}}}
+
 
 class Cart:
-    def __init__(self, db):
+    #Sin redis_client no se guarda la cantidad (RedisCart tiene su propio contador)
+    def __init__(self, db, redis_client=None):
         self.collection = db['carts']
+        self.redis_client = redis_client
+        if redis_client is not None:
+            self._store_count_script = redis_client.register_script(_STORE_COUNT_SCRIPT)
 
     def create_cart(self, cart_data):
-        return self.collection.insert_one(cart_data)
+        result = self.collection.insert_one(cart_data)
+        self._forget_count(cart_data.get("cartId"))
+        return result
 
     def get_cart(self, cart_id):
         cart = self.collection.find_one({"cartId": cart_id})
@@ -20,31 +70,276 @@ class Cart:
             # Devolver una lista vacía si no existe
             return []
 
+    def get_cart_count(self, cart_id):
+        if self.redis_client is not None:
+            count = self.redis_client.hget(self._count_key(cart_id), "count")
+            if count is not None:
+                return int(count)
+        return self._store_count(cart_id, self.collection.find_one({"cartId": cart_id}, COUNT_PROJECTION))
+
+    #La version la maneja el carrito, no se acepta en update_data
     def update_cart(self, cart_id, update_data):
-        return self.collection.update_one({"cartId": cart_id}, {"$set": update_data}, upsert=True)
+        update_data = {field: value for field, value in update_data.items() if field != "version"}
+        cart = self._update_and_count({"cartId": cart_id}, {"$set": update_data}, upsert=True)
+        return self._store_count(cart_id, cart)
 
     def delete_cart(self, cart_id):
-        return self.collection.delete_one({"cartId": cart_id})
+        result = self.collection.delete_one({"cartId": cart_id})
+        self._forget_count(cart_id)
+        return result
 
+    #Las operaciones del carrito se hacen en el servidor con un solo update atomico
+    #(un viaje a Mongo) y devuelven la cantidad total de items que quedo en el carrito.
+    #Si el producto ya esta se suma la cantidad; si no, se agrega al final. Con
+    #upsert el carrito se crea si no existe: si dos requests lo crean a la vez, Mongo
+    #reintenta el upsert que choca con el indice unico de cartId (utils/indexes.py)
     def add_to_cart(self, cart_id, product_id, quantity, product_name):
-        items = self.get_cart(cart_id)
-        for item in items:
-            if item["productId"] == product_id:
-                item["quantity"] += quantity
-                break
-        else:
-            items.append({"productId": product_id, "quantity": quantity, "name": product_name})
-        self.update_cart(cart_id, {"items": items})
+        product_id = _literal(product_id)
+        item = {"productId": product_id, "quantity": quantity, "name": _literal(product_name)}
+        cart = self._update_and_count({"cartId": cart_id}, [{"$set": {
+            "items": {"$cond": [
+                {"$in": [product_id, {"$map": {"input": _ITEMS, "as": "item", "in": "$$item.productId"}}]},
+                _map_quantity(product_id, {"$add": ["$$item.quantity", quantity]}),
+                {"$concatArrays": [_ITEMS, [item]]},
+            ]},
+            "version": _NEXT_VERSION,
+        }}], upsert=True)
+        return self._store_count(cart_id, cart)
 
     def remove_from_cart(self, cart_id, product_id):
-        items = self.get_cart(cart_id)
-        items = [item for item in items if item["productId"] != product_id]
-        self.update_cart(cart_id, {"items": items})
+        cart = self._update_and_count(
+            {"cartId": cart_id},
+            {"$pull": {"items": {"productId": product_id}}}
+        )
+        return self._store_count(cart_id, cart)
 
+    #Si el producto no esta en el carrito no cambia nada, pero igual devuelve la cantidad
     def update_cart_quantity(self, cart_id, product_id, quantity):
+        if quantity <= 0:
+            return self.remove_from_cart(cart_id, product_id)
+        cart = self._update_and_count({"cartId": cart_id}, [{"$set": {
+            "items": _map_quantity(_literal(product_id), quantity),
+            "version": _NEXT_VERSION,
+        }}])
+        return self._store_count(cart_id, cart)
+
+    #Todos los cambios incrementan la version del carrito (los updates con
+    #pipeline la incrementan ellos mismos con _NEXT_VERSION)
+    def _update_and_count(self, query, update, upsert=False):
+        if isinstance(update, dict):
+            update = dict(update, **{"$inc": dict(update.get("$inc", {}), version=1)})
+        return self.collection.find_one_and_update(
+            query, update,
+            projection=COUNT_PROJECTION,
+            upsert=upsert,
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _count_items(self, cart):
+        if not cart:
+            return 0
+        return sum(item.get("quantity", 0) for item in cart.get("items", []))
+
+    def _count_key(self, cart_id):
+        return f"cart:{cart_id}:badge"
+
+    #Guarda la cantidad del carrito en Redis (si la version es mas nueva) y la devuelve
+    def _store_count(self, cart_id, cart):
+        count = self._count_items(cart)
+        if self.redis_client is not None:
+            version = cart.get("version", 0) if cart else 0
+            self._store_count_script(keys=[self._count_key(cart_id)], args=[version, count, CART_COUNT_TTL])
+        return count
+
+    def _forget_count(self, cart_id):
+        if self.redis_client is not None and cart_id is not None:
+            self.redis_client.delete(self._count_key(cart_id))
+
+
+#Backend alternativo: el carrito vive en Redis y se guarda en Mongo cada tanto
+#(flush_dirty_carts) o cuando se hace el checkout
+CART_BACKEND = os.environ.get("CART_BACKEND", "mongo")
+REDIS_CART_TTL = int(os.environ.get("REDIS_CART_TTL", 7 * 24 * 3600))
+DIRTY_CARTS_KEY = "carts:dirty"
+
+#Un carrito con cambios que todavia no estan en Mongo (en carts:dirty) no vence:
+#los scripts que lo modifican le sacan el TTL y flush_cart se lo vuelve a poner
+#despues de guardarlo. Si no, podia vencer antes del flush y se perdian los cambios
+
+#Si el carrito no esta cargado en Redis devuelve -1 para que se cargue desde Mongo
+_ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then return -1 end
+redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[3])
+local count = redis.call('INCRBY', KEYS[3], ARGV[2])
+redis.call('PERSIST', KEYS[1])
+redis.call('PERSIST', KEYS[2])
+redis.call('PERSIST', KEYS[3])
+redis.call('SADD', KEYS[4], ARGV[4])
+return count
+"""
+
+#Cambia la cantidad de un producto (0 lo borra) y ajusta el contador con la diferencia
+_SET_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 0 then return -1 end
+local old = tonumber(redis.call('HGET', KEYS[1], ARGV[1])) or 0
+local quantity = tonumber(ARGV[2])
+if old == 0 then return tonumber(redis.call('GET', KEYS[3])) end
+if quantity <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], quantity)
+end
+local count = redis.call('INCRBY', KEYS[3], math.max(quantity, 0) - old)
+redis.call('PERSIST', KEYS[1])
+redis.call('PERSIST', KEYS[2])
+redis.call('PERSIST', KEYS[3])
+redis.call('SADD', KEYS[4], ARGV[3])
+return count
+"""
+
+#Despues de guardar el carrito en Mongo le vuelve a poner el TTL, salvo que haya
+#cambiado otra vez mientras tanto (volvio a carts:dirty). ARGV: ttl, cartId
+_SAVED_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[4], ARGV[2]) == 1 then return 0 end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return 1
+"""
+
+#Carga el carrito completo (si no estaba cargado ya). ARGV: ttl, count y despues productId, quantity, name
+_LOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then return tonumber(redis.call('GET', KEYS[3])) end
+redis.call('DEL', KEYS[1], KEYS[2])
+for i = 3, #ARGV, 3 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+end
+redis.call('SET', KEYS[3], ARGV[2], 'EX', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return tonumber(ARGV[2])
+"""
+
+class RedisCart:
+    def __init__(self, db, redis_client=None):
+        self.mongo_cart = Cart(db)
+        self.redis_client = redis_client or get_redis_client()
+        self._add = self.redis_client.register_script(_ADD_SCRIPT)
+        self._set = self.redis_client.register_script(_SET_SCRIPT)
+        self._load = self.redis_client.register_script(_LOAD_SCRIPT)
+        self._saved = self.redis_client.register_script(_SAVED_SCRIPT)
+
+    def _keys(self, cart_id):
+        return [f"cart:{cart_id}:items", f"cart:{cart_id}:names", f"cart:{cart_id}:count"]
+
+    def create_cart(self, cart_data):
+        return self.update_cart(cart_data["cartId"], {"items": cart_data.get("items", [])})
+
+    def get_cart(self, cart_id):
+        items_key, names_key, count_key = self._keys(cart_id)
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hgetall(items_key)
+        pipe.hgetall(names_key)
+        pipe.exists(count_key)
+        quantities, names, loaded = pipe.execute()
+        if not loaded:
+            return self._load_from_mongo(cart_id)
+        return [
+            {
+                "productId": product_id.decode('utf-8'),
+                "quantity": int(quantity),
+                "name": names.get(product_id, b"").decode('utf-8')
+            }
+            for product_id, quantity in quantities.items()
+        ]
+
+    def get_cart_count(self, cart_id):
+        count = self.redis_client.get(self._keys(cart_id)[2])
+        if count is None:
+            return self.mongo_cart._count_items({"items": self._load_from_mongo(cart_id)})
+        return int(count)
+
+    #Reemplaza los items del carrito y lo guarda en Mongo en el momento (ej. al vaciarlo en el checkout)
+    def update_cart(self, cart_id, update_data):
+        result = self.mongo_cart.update_cart(cart_id, update_data)
+        if "items" in update_data:
+            pipe = self.redis_client.pipeline()
+            pipe.delete(*self._keys(cart_id))
+            pipe.srem(DIRTY_CARTS_KEY, cart_id)
+            pipe.execute()
+            self._load_items(cart_id, update_data["items"])
+        return result
+
+    def delete_cart(self, cart_id):
+        pipe = self.redis_client.pipeline()
+        pipe.delete(*self._keys(cart_id))
+        pipe.srem(DIRTY_CARTS_KEY, cart_id)
+        pipe.execute()
+        return self.mongo_cart.delete_cart(cart_id)
+
+    def add_to_cart(self, cart_id, product_id, quantity, product_name):
+        return self._run(self._add, cart_id, [product_id, quantity, product_name, cart_id])
+
+    def remove_from_cart(self, cart_id, product_id):
+        return self.update_cart_quantity(cart_id, product_id, 0)
+
+    def update_cart_quantity(self, cart_id, product_id, quantity):
+        return self._run(self._set, cart_id, [product_id, quantity, cart_id])
+
+    #Escribe en Mongo el contenido actual del carrito en Redis
+    def flush_cart(self, cart_id):
         items = self.get_cart(cart_id)
+        self.mongo_cart.update_cart(cart_id, {"items": items})
+        self._saved(keys=self._keys(cart_id) + [DIRTY_CARTS_KEY], args=[REDIS_CART_TTL, cart_id])
+        return len(items)
+
+    def _run(self, script, cart_id, args):
+        keys = self._keys(cart_id) + [DIRTY_CARTS_KEY]
+        count = script(keys=keys, args=args)
+        if count == -1:
+            #El carrito no estaba en Redis (nuevo o expirado), se carga de Mongo y se reintenta
+            self._load_from_mongo(cart_id)
+            count = script(keys=keys, args=args)
+        return int(count)
+
+    def _load_from_mongo(self, cart_id):
+        items = self.mongo_cart.get_cart(cart_id)
+        self._load_items(cart_id, items)
+        return items
+
+    def _load_items(self, cart_id, items):
+        args = [REDIS_CART_TTL, self.mongo_cart._count_items({"items": items})]
         for item in items:
-            if item["productId"] == product_id:
-                item["quantity"] = quantity
-                break
-        self.update_cart(cart_id, {"items": items})
+            args += [item["productId"], item["quantity"], item.get("name", "")]
+        self._load(keys=self._keys(cart_id), args=args)
+
+
+#Guarda en Mongo los carritos de Redis que cambiaron desde el ultimo flush
+def flush_dirty_carts(db, batch_size=500, redis_client=None):
+    redis_client = redis_client or get_redis_client()
+    cart_model = RedisCart(db, redis_client)
+    flushed = 0
+    while True:
+        cart_ids = redis_client.spop(DIRTY_CARTS_KEY, batch_size)
+        if not cart_ids:
+            return flushed
+        for cart_id in cart_ids:
+            cart_id = cart_id.decode('utf-8')
+            if not redis_client.exists(cart_model._keys(cart_id)[2]):
+                continue
+            try:
+                cart_model.flush_cart(cart_id)
+            except Exception:
+                #Si falla Mongo se vuelve a marcar para el proximo flush
+                redis_client.sadd(DIRTY_CARTS_KEY, cart_id)
+                raise
+            flushed += 1
+
+
+def get_cart_model(db):
+    if CART_BACKEND == "redis":
+        return RedisCart(db)
+    return Cart(db, get_redis_client())
@@ -0,0 +1,199 @@
+import copy
+import os
+import threading
+import time
+from collections import OrderedDict
+import redis
+from bson import json_util
+from models.product import Product, SEARCH_PAGE_SIZE
+from utils.redis_client import get_redis_client
+
+#Configuración del cache del catalogo, se puede ajustar con variables de entorno
+CATALOG_CACHE_ENABLED = os.environ.get("CATALOG_CACHE_ENABLED", "1") == "1"
+CATALOG_LOCAL_SIZE = int(os.environ.get("CATALOG_LOCAL_SIZE", 1024))
+CATALOG_LOCAL_TTL = float(os.environ.get("CATALOG_LOCAL_TTL", 30))
+CATALOG_REDIS_TTL = int(os.environ.get("CATALOG_REDIS_TTL", 300))
+#Cada cuanto se vuelve a leer la version del catalogo de Redis
+CATALOG_VERSION_CHECK = float(os.environ.get("CATALOG_VERSION_CHECK", 1))
+#Cuanto espera un proceso a que otro termine de cargar la misma clave
+CATALOG_LOAD_WAIT = float(os.environ.get("CATALOG_LOAD_WAIT", 2))
+
+VERSION_KEY = "catalog:version"
+_MISSING = object()
+
+
+#LRU en memoria del proceso, cada entrada vence a los ttl segundos
+class LocalLRU:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.data[key]
+                return _MISSING
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+#Cache de dos niveles (memoria del proceso + Redis) para las lecturas del catalogo.
+#Las claves llevan la version del catalogo, cada escritura la incrementa y asi
+#todas las entradas viejas dejan de usarse sin tener que borrarlas
+class CatalogCache:
+    def __init__(self, redis_client=None):
+        self._redis_client = redis_client
+        self.local = LocalLRU(CATALOG_LOCAL_SIZE, CATALOG_LOCAL_TTL)
+        self._version = None
+        self._version_checked_at = 0
+        #Locks por clave (repartidos en 64) para que un solo thread cargue cada clave
+        self._key_locks = [threading.Lock() for _ in range(64)]
+
+    @property
+    def redis_client(self):
+        return self._redis_client or get_redis_client()
+
+    def version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked_at > CATALOG_VERSION_CHECK:
+            try:
+                self._version = int(self.redis_client.get(VERSION_KEY) or 0)
+            except redis.RedisError:
+                self._version = self._version or 0
+            self._version_checked_at = now
+        return self._version
+
+    #Se llama en cada escritura del catalogo
+    def bump(self):
+        try:
+            self._version = self.redis_client.incr(VERSION_KEY)
+        except redis.RedisError:
+            self._version = None
+        self._version_checked_at = time.monotonic()
+        self.local.clear()
+
+    def get_or_load(self, key, loader):
+        full_key = f"catalog:v{self.version()}:{key}"
+        value = self.local.get(full_key)
+        if value is _MISSING:
+            with self._key_locks[hash(full_key) % len(self._key_locks)]:
+                value = self.local.get(full_key)
+                if value is _MISSING:
+                    value = self._load_shared(full_key, loader)
+                    self.local.set(full_key, value)
+        #Se devuelve una copia para que quien la use no modifique el cache
+        return copy.deepcopy(value)
+
+    #Busca en Redis; si no esta, un solo proceso la carga de Mongo y los demas esperan
+    def _load_shared(self, full_key, loader):
+        try:
+            raw = self.redis_client.get(full_key)
+            if raw is not None:
+                return json_util.loads(raw)
+            lock_key = f"{full_key}:lock"
+            if self.redis_client.set(lock_key, os.getpid(), nx=True, ex=max(1, int(CATALOG_LOAD_WAIT * 2))):
+                try:
+                    value = loader()
+                    self.redis_client.set(full_key, json_util.dumps(value), ex=CATALOG_REDIS_TTL)
+                    return value
+                finally:
+                    self.redis_client.delete(lock_key)
+
+            deadline = time.monotonic() + CATALOG_LOAD_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                raw = self.redis_client.get(full_key)
+                if raw is not None:
+                    return json_util.loads(raw)
+        except redis.RedisError:
+            pass
+        #Redis no responde o el otro proceso tardo demasiado, se carga directo
+        return loader()
+
+
+catalog_cache = CatalogCache()
+
+
+#Product con cache para las lecturas del catalogo. Todas las escrituras
+#incrementan la version, tambien las de stock (el detalle y las tarjetas
+#cacheadas muestran el stock), salvo upsert_products (ver invalidate_cache)
+class CachedProduct(Product):
+    def __init__(self, db, cache=None):
+        super().__init__(db)
+        self.cache = cache or catalog_cache
+
+    def get_product(self, product_id):
+        return self.cache.get_or_load(f"product:{product_id}", lambda: super(CachedProduct, self).get_product(product_id))
+
+    def get_active_products_page(self, after=None, before=None, per_page=None, view="card", raw=False):
+        #Lo que se guarda en el cache ya esta decodificado, raw no aplica
+        return self.cache.get_or_load(
+            f"active:{view}:{after}:{before}:{per_page}",
+            lambda: super(CachedProduct, self).get_active_products_page(after, before, per_page, view)
+        )
+
+    def search_products(self, query, page=1, per_page=SEARCH_PAGE_SIZE, view="card"):
+        return tuple(self.cache.get_or_load(
+            f"search:{view}:{query.lower()}:{page}:{per_page}",
+            lambda: super(CachedProduct, self).search_products(query, page, per_page, view)
+        ))
+
+    def add_product(self, product_data):
+        result = super().add_product(product_data)
+        self.cache.bump()
+        return result
+
+    def update_product(self, product_id, update_data, stock_delta=0):
+        result = super().update_product(product_id, update_data, stock_delta)
+        self.cache.bump()
+        return result
+
+    #upsert_products no incrementa la version: lo usa la importacion, que llama
+    #a invalidate_cache una sola vez al terminar (y no despues de cada lote)
+    def invalidate_cache(self):
+        self.cache.bump()
+
+    def delete_product(self, product_id):
+        result = super().delete_product(product_id)
+        self.cache.bump()
+        return result
+
+    def decrement_stock(self, product_id, quantity):
+        result = super().decrement_stock(product_id, quantity)
+        if result.modified_count:
+            self.cache.bump()
+        return result
+
+    #Si falla no queda nada descontado (se aborta o se devuelve), no hay que invalidar
+    def reserve_stock(self, items):
+        failed = super().reserve_stock(items)
+        if not failed:
+            self.cache.bump()
+        return failed
+
+    def release_stock(self, items, session=None):
+        super().release_stock(items, session)
+        self.cache.bump()
+
+
+def get_product_model(db):
+    if CATALOG_CACHE_ENABLED:
+        return CachedProduct(db)
+    return Product(db)
@@ -1,22 +1,54 @@
+from datetime import datetime
 from bson import ObjectId
+from pymongo import DESCENDING
+from utils.db import raw_collection
+from models.analytics import record_order, record_status_change
+from utils.pagination import keyset_page
+
+#Proyecciones con nombre: "row" para las tablas de ordenes (sin los items) y "detail" para la orden completa
+PROJECTIONS = {
+    "row": {"order_number": 1, "user_id": 1, "name": 1, "address": 1, "status": 1, "total": 1},
+    "detail": None,
+}
 
 class Order:
     def __init__(self, db):
         self.db = db
 
+    #Los resumenes de ventas (models/analytics.py) se actualizan en segundo plano
     def insert_order(self, order_info):
         self.db.orders.insert_one(order_info)
+        record_order.delay(order_info)
 
     def get_order(self, order_id):
         order = self.db.orders.find_one({"order_number": int(order_id)})
         return order
 
-    def get_all_orders(self):
-        return list(self.db.orders.find({}))
+    def get_all_orders(self, view="detail"):
+        return list(self.db.orders.find({}, PROJECTIONS[view]))
 
     def update_order_status(self, order_number, status):
-        self.db.orders.update_one({"order_number": order_number}, {"$set": {"status": status}})
+        previous = self.db.orders.find_one_and_update(
+            {"order_number": order_number}, {"$set": {"status": status}}, projection={"status": 1}
+        )
+        if previous:
+            record_status_change.delay(order_number, previous.get("status"), status, datetime.utcnow())
+
+
+    def get_orders_by_user(self, user_id, view="detail"):
+        return list(self.db.orders.find({"user_id": user_id}, PROJECTIONS[view]))
+
+    #Versiones paginadas, de la orden mas nueva a la mas vieja.
+    #Con raw=True se devuelven RawBSONDocument de solo lectura
+    def get_all_orders_page(self, after=None, before=None, per_page=None, view="row", raw=False):
+        return keyset_page(self._read_collection(raw), {}, "order_number", DESCENDING,
+                           after=after, before=before, per_page=per_page, unique=True,
+                           projection=PROJECTIONS[view])
 
+    def get_orders_by_user_page(self, user_id, after=None, before=None, per_page=None, view="row", raw=False):
+        return keyset_page(self._read_collection(raw), {"user_id": user_id}, "order_number", DESCENDING,
+                           after=after, before=before, per_page=per_page, unique=True,
+                           projection=PROJECTIONS[view])
 
-    def get_orders_by_user(self, user_id):
-        return list(self.db.orders.find({"user_id": user_id}))
+    def _read_collection(self, raw):
+        return raw_collection(self.db.orders) if raw else self.db.orders
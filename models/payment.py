@@ -1,6 +1,106 @@
+from datetime import datetime
+from pymongo import ReturnDocument
+from models.analytics import record_payment, record_status_change
+from models.invoice import Invoice
+from utils.db import supports_transactions
+
+PAID_STATUS = "Pagado"
+
+#Resultados de commit_payment
+PAID = "paid"
+ALREADY_PAID = "already_paid"
+NOT_FOUND = "not_found"
+
 class Payment:
     def __init__(self, db):
         self.db = db
 
     def insert_payment(self, payment_info):
         self.db.payments.insert_one(payment_info)
+        record_payment.delay(payment_info)
+
+    #Registra el pago de una orden: pago, factura y estado "Pagado" van juntos.
+    #Con replica set es una transaccion; sin replica set cada escritura es un
+    #upsert por order_number, asi repetirla (otro request o un reintento despues
+    #de un corte) completa lo que falte sin duplicar nada. Una orden pagada no se
+    #vuelve a pagar. Devuelve (resultado, pago guardado, id de la factura)
+    def commit_payment(self, order_number, user, details):
+        order_number = int(order_number)
+        invoice_number = None
+
+        #El numero de factura se pide a Redis una sola vez, aunque la transaccion se reintente
+        def next_invoice_number():
+            nonlocal invoice_number
+            if invoice_number is None:
+                invoice_number = Invoice(self.db).get_next_invoice_number()
+            return invoice_number
+
+        client = self.db.client
+        if supports_transactions(client):
+            with client.start_session() as session:
+                result = session.with_transaction(
+                    lambda s: self._commit(order_number, user, details, next_invoice_number, s)
+                )
+        else:
+            result = self._commit(order_number, user, details, next_invoice_number)
+
+        status, payment, invoice_id, previous_status = result
+        if status == PAID:
+            record_payment.delay(payment)
+            record_status_change.delay(order_number, previous_status, PAID_STATUS, payment["date"])
+        return status, payment, invoice_id
+
+    def _commit(self, order_number, user, details, next_invoice_number, session=None):
+        order = self.db.orders.find_one(
+            {"order_number": order_number, "user_id": user["user_id"]},
+            {"status": 1, "total": 1, "items": 1},
+            session=session
+        )
+        if not order:
+            return NOT_FOUND, None, None, None
+        if order.get("status") == PAID_STATUS:
+            return ALREADY_PAID, None, None, None
+
+        now = datetime.utcnow()
+        payment_info = {
+            "user_id": user["user_id"],
+            "payment_method": details["payment_method"],
+            "installments": details["installments"],
+            "total": order["total"],
+            "final_total": details["final_total"],
+            "total_fee": details["total_fee"],
+            "items": order["items"],
+            "order_number": order_number,
+            "iva": details["iva"],
+            "date": now
+        }
+        payment = self.db.payments.find_one_and_update(
+            {"order_number": order_number}, {"$setOnInsert": payment_info},
+            upsert=True, return_document=ReturnDocument.AFTER, session=session
+        )
+
+        #El numero de factura se pide solo si la orden todavia no tiene factura,
+        #asi un reintento despues de un corte no gasta numeros
+        invoice = self.db.invoices.find_one({"order_number": order_number}, {"_id": 1}, session=session)
+        if invoice is None:
+            invoice_info = dict(
+                payment_info,
+                invoice_number=next_invoice_number(),
+                name=user.get("name"),
+                address=user.get("address"),
+                iva_condition=details.get("iva_condition")
+            )
+            invoice = self.db.invoices.find_one_and_update(
+                {"order_number": order_number}, {"$setOnInsert": invoice_info},
+                projection={"_id": 1}, upsert=True, return_document=ReturnDocument.AFTER, session=session
+            )
+
+        #Si otro request la marco como pagada mientras tanto, este no cuenta como pago
+        previous = self.db.orders.find_one_and_update(
+            {"order_number": order_number, "status": {"$ne": PAID_STATUS}},
+            {"$set": {"status": PAID_STATUS}},
+            projection={"status": 1}, session=session
+        )
+        if previous is None:
+            return ALREADY_PAID, None, None, None
+        return PAID, payment, str(invoice["_id"]), previous.get("status")
@@ -1,17 +1,90 @@
+import os
+import uuid
+from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne, ASCENDING
+from utils.db import supports_transactions, raw_collection
+from utils.pagination import keyset_page
+
+#Campos que se necesitan para armar ordenes y el checkout
+ORDER_PROJECTION = {"_id": 0, "productId": 1, "name": 1, "price": 1, "stock": 1, "isDeleted": 1}
+
+#Proyecciones con nombre: "card" para las tarjetas del catalogo (solo la primera
+#imagen), "row" para la tabla del admin y "detail" para el documento completo
+#(sin las marcas de reservas en curso, ver _reserve_with_compensation)
+PROJECTIONS = {
+    "card": {"productId": 1, "name": 1, "price": 1, "stock": 1, "isDeleted": 1, "images": {"$slice": 1}},
+    "row": {"productId": 1, "name": 1, "price": 1, "stock": 1},
+    "detail": {"reservations": 0},
+}
+
+#Reservas en curso sin transacciones (una por orden). Mongo las borra a los
+#RESERVATION_TTL segundos (indice TTL sobre created_at, ver utils/indexes.py):
+#las marcas de una reserva que ya no esta quedaron de un proceso que se corto
+RESERVATIONS_COLLECTION = "stock_reservations"
+RESERVATION_TTL = int(os.environ.get("RESERVATION_TTL", 600))
+
+#Filtro de productos que se pueden comprar
+ACTIVE_FILTER = {"isDeleted": False, "stock": {"$gt": 0}}
+SEARCH_PAGE_SIZE = 12
+SEARCH_MAX_PAGE_SIZE = 48
+
+
+#Se usa para abortar la transaccion cuando falta stock de algun producto
+class _InsufficientStock(Exception):
+    pass
 
 class Product:
     def __init__(self, db):
         self.collection = db['products']
+        self.reservations = db[RESERVATIONS_COLLECTION]
 
     def add_product(self, product_data):
         return self.collection.insert_one(product_data)
 
+    #Alta desde la API: completa los campos que el formulario del admin siempre manda
+    def create_product(self, product_data):
+        product = {"productId": str(ObjectId()), "images": [], "isDeleted": False}
+        product.update(product_data)
+        return self.add_product(product)
+
+    #Alta o actualizacion de muchos productos (por productId) en un solo bulk_write.
+    #Los productos nuevos arrancan sin imagenes y activos
+    def upsert_products(self, products):
+        ops = []
+        for product in products:
+            fields = {key: value for key, value in product.items() if key != "productId"}
+            on_insert = {key: value for key, value in (("images", []), ("isDeleted", False)) if key not in fields}
+            update = {"$set": fields}
+            if on_insert:
+                update["$setOnInsert"] = on_insert
+            ops.append(UpdateOne({"productId": product["productId"]}, update, upsert=True))
+        return self.collection.bulk_write(ops, ordered=False)
+
+    #Sin cache no hay nada que invalidar (ver CachedProduct)
+    def invalidate_cache(self):
+        pass
+
     def get_product(self, product_id):
-        return self.collection.find_one({"productId": product_id})
+        return self.collection.find_one({"productId": product_id}, PROJECTIONS["detail"])
+
+    #Trae varios productos en una sola consulta, devuelve un dict {productId: producto}
+    def get_products(self, product_ids, projection=None):
+        product_ids = list(set(product_ids))
+        if not product_ids:
+            return {}
+        if projection is None:
+            projection = ORDER_PROJECTION
+        cursor = self.collection.find({"productId": {"$in": product_ids}}, projection)
+        return {product["productId"]: product for product in cursor}
 
-    def update_product(self, product_id, update_data):
-        return self.collection.update_one({"productId": product_id}, {"$set": update_data})
+    #stock_delta suma (o resta) al stock actual en vez de pisarlo, asi no se
+    #pierden las ventas que pasaron mientras el admin tenia abierto el formulario
+    def update_product(self, product_id, update_data, stock_delta=0):
+        update = {"$set": update_data}
+        if stock_delta:
+            update["$inc"] = {"stock": stock_delta}
+        return self.collection.update_one({"productId": product_id}, update)
 
     def delete_product(self, product_id):
         return self.collection.update_one(
@@ -19,20 +92,167 @@ class Product:
             {"$set": {"isDeleted": True, "stock": 0}}
         )
     
-    def get_all_products(self):
-        return list(self.collection.find())
+    def get_all_products(self, view="detail"):
+        return list(self.collection.find({}, PROJECTIONS[view]))
     
-    def get_active_products(self):
-        return list(self.collection.find({"isDeleted": False, "stock": {"$gt": 0}}))
+    def get_active_products(self, view="detail"):
+        return list(self.collection.find({"isDeleted": False, "stock": {"$gt": 0}}, PROJECTIONS[view]))
     
-    def get_active_products_admin(self):
-        return list(self.collection.find({"isDeleted": False}))
+    def get_active_products_admin(self, view="detail"):
+        return list(self.collection.find({"isDeleted": False}, PROJECTIONS[view]))
+
+    #Versiones paginadas para los listados (ordenadas por _id, sin skip).
+    #Con raw=True se devuelven RawBSONDocument de solo lectura. view puede ser el
+    #nombre de una proyeccion o un dict con los campos (ej. ?fields= de la API)
+    def get_active_products_page(self, after=None, before=None, per_page=None, view="card", raw=False):
+        return keyset_page(self._read_collection(raw), ACTIVE_FILTER, "_id", ASCENDING,
+                           after=after, before=before, per_page=per_page, projection=self._projection(view))
+
+    def get_active_products_admin_page(self, after=None, before=None, per_page=None, view="row", raw=False):
+        return keyset_page(self._read_collection(raw), {"isDeleted": False}, "_id", ASCENDING,
+                           after=after, before=before, per_page=per_page, projection=self._projection(view))
+
+    def get_all_products_page(self, after=None, before=None, per_page=None, view="detail", raw=False):
+        return keyset_page(self._read_collection(raw), {}, "_id", ASCENDING,
+                           after=after, before=before, per_page=per_page, projection=self._projection(view))
+
+    def _projection(self, view):
+        return view if isinstance(view, dict) else PROJECTIONS[view]
+
+    def _read_collection(self, raw):
+        return raw_collection(self.collection) if raw else self.collection
+
+    #Busqueda con el indice de texto (name y description), ordenada por relevancia.
+    #Devuelve (productos, hay_mas_paginas)
+    def search_products(self, query, page=1, per_page=SEARCH_PAGE_SIZE, view="card"):
+        per_page = max(1, min(per_page, SEARCH_MAX_PAGE_SIZE))
+        skip = (max(page, 1) - 1) * per_page
+        text_filter = dict(ACTIVE_FILTER, **{"$text": {"$search": query}})
+        projection = dict(PROJECTIONS[view] or {}, score={"$meta": "textScore"})
+        products = list(
+            self.collection.find(text_filter, projection)
+            .sort([("score", {"$meta": "textScore"})])
+            .skip(skip)
+            .limit(per_page + 1)
+        )
+        return products[:per_page], len(products) > per_page
 
     def get_deleted_products(self):
-        return list(self.collection.find({"isDeleted": True}))
+        return list(self.collection.find({"isDeleted": True}, PROJECTIONS["detail"]))
 
     def decrement_stock(self, product_id, quantity):
         return self.collection.update_one(
             {"productId": product_id, "isDeleted": False, "stock": {"$gt": quantity - 1}},
             {"$inc": {"stock": -quantity}}
-        )
\ No newline at end of file
+        )
+
+    #Descuenta el stock de todos los items de una orden con un solo bulk_write.
+    #Es todo o nada: si algun producto no tiene stock no se descuenta ninguno.
+    #Devuelve la lista de productId que fallaron (vacia si se reservo todo)
+    def reserve_stock(self, items):
+        quantities = self._merge_quantities(items)
+        if not quantities:
+            return []
+        client = self.collection.database.client
+        if supports_transactions(client):
+            return self._reserve_in_transaction(client, quantities)
+        return self._reserve_with_compensation(quantities)
+
+    #Devuelve el stock de items ya reservados (ej. si falla el insert de la orden)
+    def release_stock(self, items, session=None):
+        quantities = self._merge_quantities(items)
+        if quantities:
+            ops = [UpdateOne({"productId": product_id}, {"$inc": {"stock": quantity}})
+                   for product_id, quantity in quantities.items()]
+            self.collection.bulk_write(ops, ordered=False, session=session)
+
+    def _reserve_in_transaction(self, client, quantities):
+        ops = [self._reserve_op(product_id, quantity) for product_id, quantity in quantities.items()]
+
+        def reserve(session):
+            result = self.collection.bulk_write(ops, ordered=False, session=session)
+            if result.matched_count < len(ops):
+                raise _InsufficientStock()
+
+        try:
+            with client.start_session() as session:
+                #with_transaction reintenta solo si hay conflictos de escritura con otra orden
+                session.with_transaction(reserve)
+        except _InsufficientStock:
+            #Si el stock se repuso entre el abort y la lectura no queda ninguno
+            #en falta, pero la orden no se reservo: se devuelven todos
+            return self._insufficient(quantities) or list(quantities)
+        return []
+
+    #Sin replica set: cada update deja en el producto una marca con el id de la
+    #reserva (en el mismo update que descuenta, asi se sabe cuales se descontaron).
+    #Si algun producto falla se buscan los que se descontaron y se les devuelve el
+    #stock. La marca se saca al terminar, en los dos casos. La reserva se registra
+    #antes en stock_reservations: si el proceso se corta, sweep_reservations saca
+    #las marcas cuando la reserva vence
+    def _reserve_with_compensation(self, quantities):
+        reservation_id = str(uuid.uuid4())
+        self.reservations.insert_one({"_id": reservation_id, "products": list(quantities),
+                                      "created_at": datetime.utcnow()})
+        try:
+            return self._reserve_marked(reservation_id, quantities)
+        finally:
+            self.reservations.delete_one({"_id": reservation_id})
+
+    def _reserve_marked(self, reservation_id, quantities):
+        ops = [self._reserve_op(product_id, quantity, reservation_id)
+               for product_id, quantity in quantities.items()]
+        result = self.collection.bulk_write(ops, ordered=False)
+        if result.matched_count == len(ops):
+            self.collection.update_many({"productId": {"$in": list(quantities)}},
+                                        {"$pull": {"reservations": reservation_id}})
+            return []
+
+        reserved = [product["productId"] for product in self.collection.find(
+            {"productId": {"$in": list(quantities)}, "reservations": reservation_id},
+            {"_id": 0, "productId": 1}
+        )]
+        if reserved:
+            self.collection.bulk_write([
+                UpdateOne({"productId": product_id, "reservations": reservation_id},
+                          {"$inc": {"stock": quantities[product_id]}, "$pull": {"reservations": reservation_id}})
+                for product_id in reserved
+            ], ordered=False)
+        return [product_id for product_id in quantities if product_id not in reserved]
+
+    #Saca las marcas de reservas que ya vencieron en stock_reservations (el proceso
+    #se corto entre el descuento y la limpieza). El stock no se toca: no se sabe si
+    #la orden llego a guardarse. Devuelve cuantas reservas se limpiaron
+    def sweep_reservations(self):
+        marked = self.collection.distinct("reservations", {"reservations": {"$type": "string"}})
+        if not marked:
+            return 0
+        live = {reservation["_id"] for reservation in self.reservations.find({"_id": {"$in": marked}}, {"_id": 1})}
+        stale = [reservation_id for reservation_id in marked if reservation_id not in live]
+        if stale:
+            self.collection.update_many({"reservations": {"$in": stale}},
+                                        {"$pull": {"reservations": {"$in": stale}}})
+        return len(stale)
+
+    def _reserve_op(self, product_id, quantity, reservation_id=None):
+        update = {"$inc": {"stock": -quantity}}
+        if reservation_id:
+            update["$push"] = {"reservations": reservation_id}
+        return UpdateOne({"productId": product_id, "isDeleted": False, "stock": {"$gte": quantity}}, update)
+
+    #Despues de abortar, se fija que productos no alcanzaban
+    def _insufficient(self, quantities):
+        products = self.get_products(quantities)
+        return [
+            product_id for product_id, quantity in quantities.items()
+            if product_id not in products
+            or products[product_id].get("isDeleted")
+            or products[product_id]["stock"] < quantity
+        ]
+
+    def _merge_quantities(self, items):
+        quantities = {}
+        for item in items:
+            product_id = str(item["productId"])
+            quantities[product_id] = quantities.get(product_id, 0) + int(item["quantity"])
+        return quantities
@@ -3,10 +3,8 @@ from utils.redis_client import get_redis_client
 import uuid
 import hashlib
 import time
-from utils.classify_users import classify_user  
-
-auth_bp = Blueprint('auth', __name__)
-redis_client = get_redis_client()
+from utils.classify_users import add_connection_time
+from utils.current_user import get_current_user
 
 auth_bp = Blueprint('auth', __name__)
 redis_client = get_redis_client()
@@ -59,8 +57,6 @@ def login():
         stored_password = redis_client.hget(f"user:{username}", "password")
         stored_password = stored_password.decode('utf-8') if stored_password else None
 
-        print(f"Login - Username: {username}, Hashed Password: {hashed_password}, Stored Password: {stored_password}") 
-        
         if not stored_password or stored_password != hashed_password:
             return render_template('login.html', error="Invalid username or password")
 
@@ -68,6 +64,7 @@ def login():
         redis_client.set(f"session:{session_token}", username)
         redis_client.expire(f"session:{session_token}", 3600)  # La sesion expira en una hora
         session['token'] = session_token
+        session['user_id'] = username
 
         login_time = time.time()
         redis_client.hset(f"user:{username}", "login_time", login_time)
@@ -79,46 +76,36 @@ def login():
 @auth_bp.route('/logout', methods=['POST'])
 def logout():
     token = session.get('token')
+    user = get_current_user()
     
-    if not token:
+    if not user:
         return redirect(url_for('auth.login'))
 
-    username = redis_client.get(f"session:{token}").decode('utf-8')
-    login_time = float(redis_client.hget(f"user:{username}", "login_time"))
+    username = user['user_id']
+    login_time = float(user.get('login_time', time.time()))
     logout_time = time.time()
     
     session_duration = logout_time - login_time
     
-    # Actualizar el tiempo total de conexión diario
-    current_date = time.strftime("%Y-%m-%d")
-    key = f"user:{username}:connection_time:{current_date}"
-    total_time = redis_client.get(key)
-
-    if total_time:
-        total_time = float(total_time)
-    else:
-        total_time = 0.0
-    
-    total_time += session_duration
-    redis_client.set(key, total_time)
-
-    classify_user(username)
+    # Actualizar el tiempo total de conexión diario y cerrar la sesion en un solo viaje a Redis.
+    # La clasificacion la hace utils/classify_users.py para todos los usuarios juntos
+    pipe = redis_client.pipeline()
+    add_connection_time(pipe, username, session_duration)
+    pipe.delete(f"session:{token}")
+    pipe.execute()
 
-    redis_client.delete(f"session:{token}")
     session.pop('token', None)
+    session.pop('user_id', None)
 
     return redirect(url_for('auth.login'))
 
 
 @auth_bp.route('/profile')
 def profile():
-    token = session.get('token')
-    if not token or not redis_client.exists(f"session:{token}"):
+    user = get_current_user()
+    if not user:
         return redirect(url_for('auth.login'))
     
-    username = redis_client.get(f"session:{token}").decode('utf-8')
-    user_data = redis_client.hgetall(f"user:{username}")
-    user = {k.decode('utf-8'): v.decode('utf-8') for k, v in user_data.items()}
     return render_template('profile.html', user=user)
 
 @auth_bp.route('/reset_password', methods=['GET', 'POST'])
@@ -1,18 +1,19 @@
 from flask import Blueprint, request, jsonify
 from utils.db import get_db
+from utils.serializer import json_response, requested_fields, select_fields
 from models.order import Order
 
 order_bp = Blueprint('order_bp', __name__)
-db = get_db()
-order_model = Order(db)
 
 @order_bp.route('/order', methods=['POST'])
 def create_order():
+    order_model = Order(get_db())
     order_data = request.json
     order_model.create_order(order_data)
     return jsonify({"msg": "Order created successfully"}), 201
 
 @order_bp.route('/order/<order_id>', methods=['GET'])
 def get_order(order_id):
+    order_model = Order(get_db())
     order = order_model.get_order(order_id)
-    return jsonify(order)
+    return json_response(select_fields(order, requested_fields()))
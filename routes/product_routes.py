@@ -1,34 +1,46 @@
 from flask import Blueprint, request, jsonify
 from utils.db import get_db
-from models.product import Product
+from models.catalog_cache import get_product_model
+from utils.serializer import json_response, stream_json, requested_fields, field_projection, select_fields
 
 product_bp = Blueprint('product_bp', __name__)
-db = get_db()
-product_model = Product(db)
 
 @product_bp.route('/product', methods=['POST'])
 def create_product():
+    product_model = get_product_model(get_db())
     product_data = request.json
     product_model.create_product(product_data)
     return jsonify({"msg": "Product created successfully"}), 201
 
 @product_bp.route('/product/<product_id>', methods=['GET'])
 def get_product(product_id):
+    product_model = get_product_model(get_db())
     product = product_model.get_product(product_id)
-    return jsonify(product)
+    return json_response(select_fields(product, requested_fields()))
 
 @product_bp.route('/product/<product_id>', methods=['PUT'])
 def update_product(product_id):
+    product_model = get_product_model(get_db())
     update_data = request.json
     product_model.update_product(product_id, update_data)
     return jsonify({"msg": "Product updated successfully"})
 
 @product_bp.route('/product/<product_id>', methods=['DELETE'])
 def delete_product(product_id):
+    product_model = get_product_model(get_db())
     product_model.delete_product(product_id)
     return jsonify({"msg": "Product deleted successfully"})
 
 @product_bp.route('/products', methods=['GET'])
 def get_all_products():
-    products = product_model.get_all_products()
-    return jsonify(products)
+    product_model = get_product_model(get_db())
+    #Con ?fields=... solo se leen de Mongo los campos pedidos
+    fields = requested_fields()
+    page = product_model.get_all_products_page(
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        per_page=request.args.get('per_page', type=int),
+        view=field_projection(fields) or "detail",
+        raw=True
+    )
+    return stream_json(page["items"], "products", {"next": page["next"], "prev": page["prev"]}, fields)
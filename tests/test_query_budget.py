@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+#Sin los backends fake (requirements-dev.txt) los tests se saltean en vez de fallar.
+#fakeredis necesita lupa para los scripts Lua del carrito
+pytest.importorskip("mongomock")
+pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("METRICS_ENABLED", "1")
+
+from utils import metrics
+from utils.benchmark import use_fakes, seed
+from utils.query_budget import (CHECKS, QueryBudgetExceeded, assert_request_budget, bench_users,
+                                count_fake_mongo, query_budget, run_check)
+
+#Presupuestos de consultas contra mongomock y fakeredis (no hace falta mongod).
+#Cada chequeo se corre con 1 y 20 items en el carrito: la cantidad de comandos
+#tiene que quedar dentro del presupuesto y no crecer con los items
+SIZES = (1, 20)
+
+
+@pytest.fixture(scope="module")
+def app():
+    metrics.METRICS_ENABLED = True
+    use_fakes()
+    count_fake_mongo()
+    from utils.db import get_db
+    from utils.redis_client import get_redis_client
+    import app as app_module
+
+    seed(get_db(), get_redis_client(), max(SIZES), len(CHECKS) * len(SIZES) + 1, 1)
+    app_module.app.config['TESTING'] = True
+    return app_module.app
+
+
+@pytest.fixture(scope="module")
+def users():
+    return bench_users()
+
+
+@pytest.mark.parametrize("name, prepare, budget", CHECKS, ids=[check[0] for check in CHECKS])
+def test_budget_and_no_growth(app, users, name, prepare, budget):
+    results = run_check(app, name, prepare, budget, users, sizes=SIZES)
+    assert set(results) == set(SIZES)
+
+
+def test_budget_exceeded_lists_commands(app):
+    from utils.db import get_db
+
+    with pytest.raises(QueryBudgetExceeded) as error:
+        with query_budget(mongo=1):
+            get_db().products.find_one({"productId": "bench-0"})
+            get_db().products.find_one({"productId": "bench-1"})
+    assert len([c for c in error.value.commands if c.backend == "mongo"]) == 2
+
+
+#Con el cache caliente la pagina anonima sale de Redis sin tocar Mongo
+def test_cached_page_budget(app):
+    client = app.test_client()
+    client.get('/products')
+    response = assert_request_budget(client, 'GET', '/products', mongo=0, redis=2)
+    assert response.status_code == 200
@@ -0,0 +1,68 @@
+import os
+import redis
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from pymongo import AsyncMongoClient
+from utils import db as sync_db
+from utils import redis_client as sync_redis
+
+#Clientes asyncio para el modo async (async_app.py). Usan la misma configuración
+#que los clientes sincronicos; hay uno por proceso y se crean dentro del event loop
+_client = None
+_client_pid = None
+_redis = None
+_redis_pid = None
+
+
+def get_async_client():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = AsyncMongoClient(
+            sync_db.MONGO_URI,
+            maxPoolSize=sync_db.MONGO_MAX_POOL_SIZE,
+            minPoolSize=sync_db.MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=sync_db.MONGO_MAX_IDLE_TIME_MS,
+            waitQueueTimeoutMS=sync_db.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            serverSelectionTimeoutMS=sync_db.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            connectTimeoutMS=sync_db.MONGO_CONNECT_TIMEOUT_MS,
+            socketTimeoutMS=sync_db.MONGO_SOCKET_TIMEOUT_MS,
+            retryReads=True,
+            retryWrites=True,
+            appName="TiendaMia-async",
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+def get_async_db():
+    return get_async_client()[sync_db.MONGO_DB_NAME]
+
+
+def get_async_redis():
+    global _redis, _redis_pid
+    if _redis is None or _redis_pid != os.getpid():
+        _redis = aioredis.Redis(
+            host=sync_redis.REDIS_HOST,
+            port=sync_redis.REDIS_PORT,
+            db=sync_redis.REDIS_DB,
+            max_connections=sync_redis.REDIS_MAX_CONNECTIONS,
+            socket_timeout=sync_redis.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=sync_redis.REDIS_CONNECT_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=sync_redis.REDIS_HEALTH_CHECK_INTERVAL,
+            retry=Retry(ExponentialBackoff(cap=1, base=0.05), sync_redis.REDIS_RETRIES),
+            retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+        )
+        _redis_pid = os.getpid()
+    return _redis
+
+
+async def close_async_clients():
+    global _client, _redis
+    if _client is not None:
+        await _client.close()
+        _client = None
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
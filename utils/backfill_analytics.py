@@ -0,0 +1,17 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.db import get_db
+from models.analytics import SalesAnalytics
+
+#Recalcula los resumenes de ventas (sales_rollups) a partir de orders y payments.
+#Uso: python utils/backfill_analytics.py
+def main():
+    db = get_db()
+    count = SalesAnalytics(db).backfill(db)
+    print(f"Resumenes recalculados: {count}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.images import UPLOAD_FOLDER, Image, generate_variants
+
+#Genera las variantes (thumb, card, detail) de las imagenes subidas antes de que
+#existieran o de las que fallaron; las que ya existen no se vuelven a generar.
+#Los errores se loguean y se sigue con la proxima imagen.
+#Uso: python utils/backfill_images.py
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if Image is None:
+        print("Falta Pillow, no se pueden generar variantes")
+        sys.exit(1)
+    if not os.path.isdir(UPLOAD_FOLDER):
+        print("No hay imagenes subidas")
+        return
+    created = 0
+    for entry in sorted(os.scandir(UPLOAD_FOLDER), key=lambda e: e.name):
+        if entry.is_file() and not entry.name.endswith('.tmp') and generate_variants(entry.name):
+            created += 1
+    print(f"Imagenes con variantes nuevas: {created}")
+
+if __name__ == '__main__':
+    main()
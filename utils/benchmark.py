@@ -0,0 +1,466 @@
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import metrics
+
+#Benchmark de la aplicacion: levanta app.py contra un mongod y un redis-server
+#locales (en puertos libres y carpetas temporales) o contra mongomock y fakeredis
+#en el mismo proceso, carga un dataset, corre flujos de usuario con el test client
+#de Flask y guarda los resultados en JSON para poder comparar corridas.
+#No usa la red: todo corre en 127.0.0.1 o dentro del proceso
+
+#Flujos que se miden y su peso por defecto en la mezcla
+DEFAULT_MIX = {"browse": 40, "search": 20, "add_to_cart": 20, "order": 10, "pay": 10}
+SEARCH_WORDS = ["mate", "termo", "yerba", "bombilla", "taza", "vaso", "jarra", "botella", "plato", "bowl"]
+COLORS = ["rojo", "azul", "verde", "negro", "blanco", "gris"]
+BENCH_PASSWORD = "benchmark"
+#Flujos que no se pueden correr con --backend fake: mongomock no tiene $text
+FAKE_UNSUPPORTED_FLOWS = ("search",)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(check, timeout, name):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{name} no arranco en {timeout}s")
+        time.sleep(0.1)
+
+
+#Levanta mongod y redis-server en una carpeta temporal. Con replset el mongod
+#es un replica set de un nodo (para medir el camino con transacciones)
+def start_local_servers(workdir, replset=False):
+    import redis
+    from pymongo import MongoClient
+
+    for binary in ("mongod", "redis-server"):
+        if not shutil.which(binary):
+            raise RuntimeError(f"No se encontro {binary} en el PATH (usar --backend fake)")
+
+    mongo_port, redis_port = _free_port(), _free_port()
+    dbpath = os.path.join(workdir, "mongo")
+    os.makedirs(dbpath)
+    mongod_args = ["mongod", "--dbpath", dbpath, "--port", str(mongo_port), "--bind_ip", "127.0.0.1",
+                   "--quiet", "--logpath", os.path.join(workdir, "mongod.log")]
+    if replset:
+        mongod_args += ["--replSet", "bench"]
+    processes = [
+        subprocess.Popen(mongod_args, stdout=subprocess.DEVNULL),
+        subprocess.Popen(["redis-server", "--port", str(redis_port), "--bind", "127.0.0.1", "--save", "",
+                          "--appendonly", "no", "--dir", workdir], stdout=subprocess.DEVNULL),
+    ]
+
+    uri = f"mongodb://127.0.0.1:{mongo_port}/?directConnection=true"
+    client = MongoClient(uri, serverSelectionTimeoutMS=1000)
+    _wait_for(lambda: client.admin.command("ping"), 30, "mongod")
+    if replset:
+        client.admin.command("replSetInitiate", {"_id": "bench", "members": [{"_id": 0, "host": f"127.0.0.1:{mongo_port}"}]})
+        _wait_for(lambda: client.admin.command("hello").get("isWritablePrimary"), 30, "replica set")
+    client.close()
+    _wait_for(lambda: redis.Redis(port=redis_port).ping(), 10, "redis-server")
+
+    #utils.db y utils.redis_client leen la configuracion al importarse
+    os.environ["MONGO_URI"] = uri
+    os.environ["REDIS_HOST"] = "127.0.0.1"
+    os.environ["REDIS_PORT"] = str(redis_port)
+    os.environ["REDIS_DB"] = "0"
+    return processes
+
+
+def stop_local_servers(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+#mongomock y fakeredis en el mismo proceso. mongomock no emite eventos de
+#comandos (los de Mongo no se cuentan) y no soporta la busqueda de texto
+def use_fakes():
+    import mongomock
+    import mongomock.collection
+    import fakeredis
+    import redis
+    import utils.db
+    import utils.redis_client
+    from utils.metrics import InstrumentedRedis
+
+    #pymongo 4.x le pasa sort a las operaciones de bulk_write y mongomock no lo acepta
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+    mongomock.collection.BulkOperationBuilder.add_update = add_update_without_sort
+
+    utils.db._client = mongomock.MongoClient()
+    utils.db._client_pid = os.getpid()
+    #Mismo cliente que usa la app (cuenta los comandos) con la conexion de fakeredis
+    utils.redis_client._client = InstrumentedRedis(connection_pool=redis.ConnectionPool(
+        connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer()))
+
+
+def seed(db, redis_client, products, users, seed_value):
+    from routes.auth_routes import hash_password
+
+    rng = random.Random(seed_value)
+    db.products.insert_many([
+        {
+            "productId": f"bench-{i}",
+            "name": f"{rng.choice(SEARCH_WORDS).title()} {rng.choice(COLORS)} {i}",
+            "description": f"{rng.choice(SEARCH_WORDS)} de {rng.choice(COLORS)} para el benchmark",
+            "price": round(rng.uniform(100, 20000), 2),
+            "stock": 10 ** 9,
+            "images": [f"uploads/bench-{i}.png"],
+            "isDeleted": False,
+        }
+        for i in range(products)
+    ])
+    password = hash_password(BENCH_PASSWORD)
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(users):
+        pipe.hset(f"user:bench{i}", mapping={
+            "username": f"bench{i}", "password": password, "name": f"Bench {i}",
+            "address": "Calle Falsa 123", "id_number": str(30000000 + i), "role": "client",
+        })
+    pipe.execute()
+
+
+def _check(response, flow):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{flow}: {response.request.method} {response.request.path} -> {response.status_code}")
+    return response
+
+
+#Cada flujo recibe (client, rng, ctx, measure): lo que se hace fuera de measure
+#es preparacion y no se cuenta (ej. llenar el carrito antes de crear la orden)
+def flow_browse(client, rng, ctx, measure):
+    with measure():
+        _check(client.get('/'), "browse")
+        _check(client.get('/products'), "browse")
+        _check(client.get(f"/product/bench-{rng.randrange(ctx['products'])}"), "browse")
+
+
+def flow_search(client, rng, ctx, measure):
+    with measure():
+        _check(client.get('/search', query_string={"q": rng.choice(SEARCH_WORDS)}), "search")
+
+
+def _add_item(client, rng, ctx):
+    product = rng.randrange(ctx['products'])
+    return _check(client.post('/add_to_cart', data={
+        "product_id": f"bench-{product}", "name": f"bench-{product}", "quantity": rng.randint(1, 3)
+    }), "add_to_cart")
+
+
+def flow_add_to_cart(client, rng, ctx, measure):
+    with measure():
+        _add_item(client, rng, ctx)
+
+
+def _create_order(client, rng, ctx):
+    for _ in range(ctx['order_items']):
+        _add_item(client, rng, ctx)
+    response = _check(client.post('/create_order'), "order")
+    location = response.headers.get('Location', '')
+    if '/order/' not in location:
+        raise RuntimeError(f"order: no se creo la orden ({location})")
+    return location.rsplit('/', 1)[-1]
+
+
+def flow_order(client, rng, ctx, measure):
+    for _ in range(ctx['order_items']):
+        _add_item(client, rng, ctx)
+    with measure():
+        response = _check(client.post('/create_order'), "order")
+        _check(client.get(f"/checkout/{response.headers.get('Location', '').rsplit('/', 1)[-1]}"), "order")
+
+
+def flow_pay(client, rng, ctx, measure):
+    order_number = _create_order(client, rng, ctx)
+    with measure():
+        _check(client.post(f"/process_payment/{order_number}", data={
+            "payment_method": "credit", "installments": "3", "iva_value": "0",
+            "final_total": "0", "credit_fee_amount": "0", "iva_condition": "Consumidor final",
+        }), "pay")
+
+
+FLOWS = {
+    "browse": flow_browse,
+    "search": flow_search,
+    "add_to_cart": flow_add_to_cart,
+    "order": flow_order,
+    "pay": flow_pay,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    #Nearest rank: el menor valor que deja al menos p% de las muestras por debajo o igual
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+#Corre iterations flujos repartidos entre users threads (cada uno con su sesion).
+#Devuelve las muestras de cada flujo: (latencia en segundos, comandos) o el error
+def run_flows(app, ctx, mix, iterations, users, seed_value, warmup=0):
+    names, weights = zip(*mix.items())
+    samples = {name: [] for name in names}
+    errors = {name: [] for name in names}
+    lock = threading.Lock()
+
+    def user_loop(index, count, record):
+        rng = random.Random(seed_value * 1000 + index)
+        client = app.test_client()
+        _check(client.post('/auth/login', data={"username": f"bench{index % ctx['users']}",
+                                                "password": BENCH_PASSWORD}), "login")
+        for _ in range(count):
+            name = rng.choices(names, weights)[0]
+            measured = {}
+
+            @contextmanager
+            def measure():
+                with metrics.capture() as commands:
+                    started = time.perf_counter()
+                    yield
+                    measured["elapsed"] = time.perf_counter() - started
+                measured["counts"] = {backend: sum(1 for c in commands if c.backend == backend)
+                                      for backend in ("mongo", "redis")}
+
+            try:
+                FLOWS[name](client, rng, ctx, measure)
+            except Exception as e:
+                if record:
+                    with lock:
+                        errors[name].append(str(e))
+                continue
+            if record:
+                with lock:
+                    samples[name].append((measured["elapsed"], measured["counts"]))
+
+    def run(total, record):
+        per_user = [total // users + (1 if i < total % users else 0) for i in range(users)]
+        threads = [threading.Thread(target=user_loop, args=(i, per_user[i], record)) for i in range(users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    if warmup:
+        run(warmup, False)
+    return samples, errors, run(iterations, True)
+
+
+def summarize(samples, errors, wall_time, mongo_counted):
+    flows = {}
+    for name, rows in samples.items():
+        latencies = [elapsed * 1000 for elapsed, _ in rows]
+        counts = [c for _, c in rows]
+        flows[name] = {
+            "count": len(rows),
+            "errors": len(errors[name]),
+            "first_errors": sorted(set(errors[name]))[:5],
+            "throughput_per_s": round(len(rows) / wall_time, 2) if wall_time else None,
+            "latency_ms": {
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "mean": _mean(latencies),
+                "max": max(latencies) if latencies else None,
+            },
+            "mongo_commands": _mean([c["mongo"] for c in counts]) if mongo_counted else None,
+            "redis_commands": _mean([c["redis"] for c in counts]),
+        }
+    completed = sum(flow["count"] for flow in flows.values())
+    return {
+        "wall_time_s": round(wall_time, 3),
+        "completed": completed,
+        "errors": sum(flow["errors"] for flow in flows.values()),
+        "throughput_per_s": round(completed / wall_time, 2) if wall_time else None,
+        "flows": flows,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _format_ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_report(result, previous=None):
+    print(f"{'flujo':<12} {'n':>6} {'err':>4} {'ops/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'mongo':>6} {'redis':>6}")
+    for name, flow in result["flows"].items():
+        latency = flow["latency_ms"]
+        print(f"{name:<12} {flow['count']:>6} {flow['errors']:>4} {flow['throughput_per_s'] or 0:>8.1f} "
+              f"{_format_ms(latency['p50']):>8} {_format_ms(latency['p95']):>8} {_format_ms(latency['p99']):>8} "
+              f"{_format_ms(flow['mongo_commands']):>6} {_format_ms(flow['redis_commands']):>6}")
+        if previous and name in previous["flows"]:
+            before = previous["flows"][name]
+            deltas = []
+            for label, new, old in (("p50", latency["p50"], before["latency_ms"]["p50"]),
+                                    ("p95", latency["p95"], before["latency_ms"]["p95"]),
+                                    ("mongo", flow["mongo_commands"], before["mongo_commands"]),
+                                    ("redis", flow["redis_commands"], before["redis_commands"])):
+                if new is not None and old:
+                    deltas.append(f"{label} {(new - old) / old * 100:+.0f}%")
+            if deltas:
+                print(f"{'':<12} vs anterior: {', '.join(deltas)}")
+        for error in flow["first_errors"]:
+            print(f"{'':<12} error: {error}")
+    print(f"Total: {result['completed']} flujos en {result['wall_time_s']}s ({result['throughput_per_s']} flujos/s), "
+          f"errores: {result['errors']}")
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in FLOWS:
+            raise ValueError(f"Flujo desconocido: {name!r} ({', '.join(FLOWS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+#Uso: python utils/benchmark.py [--backend local|fake] [--replset] [--products 500] [--users 8]
+#         [--iterations 500] [--warmup 50] [--order-items 3] [--mix browse=40,search=20,...]
+#         [--seed 1] [--output resultados.json] [--compare anterior.json]
+#Sin --backend usa local si mongod y redis-server estan instalados y fake si no.
+#Con fake no se corre el flujo search (queda en meta.skipped_flows).
+#Las demas variables de entorno de la app (CART_BACKEND, PAGE_CACHE_ENABLED, ...) se respetan
+def main():
+    args = sys.argv[1:]
+
+    def option(name, default=None, cast=str):
+        return cast(args[args.index(name) + 1]) if name in args else default
+
+    backend = option("--backend") or ("local" if shutil.which("mongod") and shutil.which("redis-server") else "fake")
+    if backend not in ("local", "fake"):
+        print("--backend tiene que ser local o fake", file=sys.stderr)
+        sys.exit(2)
+    try:
+        mix = parse_mix(option("--mix")) if "--mix" in args else dict(DEFAULT_MIX)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    skipped = []
+    if backend == "fake":
+        #Se sacan de la mezcla en vez de contar cada corrida como error
+        skipped = [name for name in mix if name in FAKE_UNSUPPORTED_FLOWS]
+        mix = {name: weight for name, weight in mix.items() if name not in skipped}
+        if skipped:
+            print(f"Backend fake: se omite {', '.join(skipped)} (mongomock no soporta $text)")
+        if not mix:
+            print("No quedan flujos para correr con --backend fake", file=sys.stderr)
+            sys.exit(2)
+    ctx = {
+        "products": option("--products", 500, int),
+        "users": option("--users", 8, int),
+        "order_items": option("--order-items", 3, int),
+    }
+    iterations = option("--iterations", 500, int)
+    warmup = option("--warmup", 50, int)
+    seed_value = option("--seed", 1, int)
+    output = option("--output", f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+
+    #Los comandos se cuentan con metrics.capture, que tiene que estar activo antes
+    #de crear los clientes de la app
+    metrics.METRICS_ENABLED = True
+
+    workdir = tempfile.mkdtemp(prefix="tiendamia-bench-")
+    processes = []
+    try:
+        if backend == "local":
+            processes = start_local_servers(workdir, '--replset' in args)
+        else:
+            use_fakes()
+
+        from utils.db import get_db
+        from utils.redis_client import get_redis_client
+        from utils.indexes import ensure_indexes
+        import app as app_module
+
+        db, redis_client = get_db(), get_redis_client()
+        if backend == "local":
+            ensure_indexes(db)
+        seed(db, redis_client, ctx["products"], ctx["users"], seed_value)
+
+        app_module.app.config['TESTING'] = True
+        samples, errors, wall_time = run_flows(app_module.app, ctx, mix, iterations, ctx["users"],
+                                               seed_value, warmup)
+    finally:
+        stop_local_servers(processes)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "backend": backend,
+            "replset": '--replset' in args,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "products": ctx["products"],
+            "users": ctx["users"],
+            "order_items": ctx["order_items"],
+            "iterations": iterations,
+            "warmup": warmup,
+            "seed": seed_value,
+            "mix": mix,
+            "skipped_flows": skipped,
+            "env": {name: os.environ[name] for name in ("CART_BACKEND", "PAGE_CACHE_ENABLED", "CATALOG_CACHE_ENABLED",
+                                                        "JOBS_SYNC") if name in os.environ},
+        },
+        **summarize(samples, errors, wall_time, backend == "local"),
+    }
+
+    previous = None
+    if "--compare" in args:
+        with open(option("--compare")) as f:
+            previous = json.load(f)
+    print_report(result, previous)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Resultados en {output}")
+
+if __name__ == '__main__':
+    main()
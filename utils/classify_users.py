@@ -1,18 +1,85 @@
-from utils.redis_client import get_redis_client
+import os
+import sys
 import time
 
-def classify_user(username):
-    redis_client = get_redis_client()
-    current_date = time.strftime("%Y-%m-%d")
-    
-    key = f"user:{username}:connection_time:{current_date}"
-    total_time = float(redis_client.get(key))
-    
-    if total_time > 240:
-        classification = "TOP"
-    elif 120  <= total_time <= 240:
-        classification = "MEDIUM"
-    else:
-        classification = "LOW"
-    
-    redis_client.hset(f"user:{username}", "classification", classification)
\ No newline at end of file
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.redis_client import get_redis_client
+from utils.jobs import deferrable
+
+#Los segundos conectados de cada dia van en un sorted set (usuario -> segundos)
+#que vence solo a los CONNECTION_TIME_TTL_DAYS dias
+CONNECTION_TIME_TTL_DAYS = int(os.environ.get("CONNECTION_TIME_TTL_DAYS", 7))
+#Cada cuantos segundos se reclasifica a los usuarios
+CLASSIFY_INTERVAL = int(os.environ.get("CLASSIFY_INTERVAL", 300))
+
+#(clasificacion, minimo, maximo) en segundos conectados en el dia
+CLASSIFICATIONS = [
+    ("TOP", "(240", "+inf"),
+    ("MEDIUM", "120", "240"),
+    ("LOW", "-inf", "(120"),
+]
+
+
+def connection_time_key(date=None):
+    return f"connection_time:{date or time.strftime('%Y-%m-%d')}"
+
+
+#Suma el tiempo de una sesion al dia actual. Se agrega al pipeline del logout,
+#asi no hace falta leer el total antes (ZINCRBY es atomico)
+def add_connection_time(pipe, username, seconds):
+    key = connection_time_key()
+    pipe.zincrby(key, seconds, username)
+    pipe.expire(key, CONNECTION_TIME_TTL_DAYS * 86400)
+
+
+#Clasifica de una vez a todos los usuarios que se conectaron en el dia: un
+#ZRANGEBYSCORE por clasificacion y un pipeline con los HSET
+@deferrable
+def classify_users(date=None, redis_client=None):
+    redis_client = redis_client or get_redis_client()
+    key = connection_time_key(date)
+    pipe = redis_client.pipeline(transaction=False)
+    counts = {}
+    for classification, low, high in CLASSIFICATIONS:
+        usernames = redis_client.zrangebyscore(key, low, high)
+        counts[classification] = len(usernames)
+        for username in usernames:
+            username = username.decode('utf-8') if isinstance(username, bytes) else username
+            pipe.hset(f"user:{username}", "classification", classification)
+    pipe.execute()
+    return counts
+
+
+#Borra las claves user:<nombre>:connection_time:<fecha> del esquema anterior,
+#que no vencian nunca
+def delete_legacy_keys(redis_client=None, batch_size=500):
+    redis_client = redis_client or get_redis_client()
+    deleted = 0
+    batch = []
+    for key in redis_client.scan_iter(match="user:*:connection_time:*", count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            deleted += redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        deleted += redis_client.unlink(*batch)
+    return deleted
+
+
+#Uso: python utils/classify_users.py                  (queda corriendo)
+#     python utils/classify_users.py --once           (una sola vez, para cron)
+#     python utils/classify_users.py --delete-legacy  (borra las claves viejas por usuario y dia)
+def main():
+    if '--delete-legacy' in sys.argv:
+        print(f"Claves borradas: {delete_legacy_keys()}")
+        return
+    while True:
+        counts = classify_users()
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} usuarios clasificados: {counts}")
+        if '--once' in sys.argv:
+            break
+        time.sleep(CLASSIFY_INTERVAL)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+from flask import g, session
+from utils.redis_client import get_redis_client
+
+#Campos del hash del usuario que no se guardan en el contexto de la request
+PRIVATE_USER_FIELDS = ("password",)
+
+
+def _decode_user(user_id, user_data):
+    user = {k.decode('utf-8'): v.decode('utf-8') for k, v in user_data.items()}
+    for field in PRIVATE_USER_FIELDS:
+        user.pop(field, None)
+    user["user_id"] = user_id
+    return user
+
+
+def _clear_session():
+    session.pop('token', None)
+    session.pop('user_id', None)
+
+
+#Resuelve la sesion una sola vez por request y la guarda en flask.g.
+#Si la cookie trae el user_id se lee la sesion y el hash del usuario en un
+#solo pipeline; devuelve None si no hay sesion o si ya expiro en Redis
+def get_current_user():
+    if 'current_user' in g:
+        return g.current_user
+
+    user = None
+    token = session.get('token')
+    if token:
+        redis_client = get_redis_client()
+        user_id = session.get('user_id')
+        if user_id:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.get(f"session:{token}")
+            pipe.hgetall(f"user:{user_id}")
+            session_user, user_data = pipe.execute()
+        else:
+            session_user = redis_client.get(f"session:{token}")
+            user_data = None
+
+        if session_user is None:
+            #La sesion expiro en Redis, se limpia la cookie
+            _clear_session()
+        else:
+            session_user = session_user.decode('utf-8')
+            if session_user != user_id or not user_data:
+                user_data = redis_client.hgetall(f"user:{session_user}")
+                session['user_id'] = session_user
+            if user_data:
+                user = _decode_user(session_user, user_data)
+            else:
+                _clear_session()
+
+    g.current_user = user
+    return user
+
+
+def get_current_user_id():
+    user = get_current_user()
+    return user["user_id"] if user else None
@@ -1,6 +1,161 @@
-from pymongo import MongoClient
+import os
+import threading
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, monitoring
+from utils.metrics import METRICS_ENABLED, command_listener
+
+#Configuración de la conexión, se puede ajustar con variables de entorno
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://127.0.0.1:27017/?directConnection=true")
+MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME", "TiendaMia_db")
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 60000))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 2000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 2000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 10000))
+
+_client = None
+_client_pid = None
+_lock = threading.Lock()
+
+
+#Cuenta las conexiones del pool para poder mostrar estadisticas
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.created = 0
+            self.closed = 0
+            self.checked_out = 0
+            self.checkout_failed = 0
+            self.pool_cleared = 0
+
+    def _add(self, field, amount=1):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add("closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failed")
+
+    def connection_checked_out(self, event):
+        self._add("checked_out")
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "open": self.created - self.closed,
+                "in_use": self.checked_out,
+                "created": self.created,
+                "closed": self.closed,
+                "checkout_failed": self.checkout_failed,
+                "pool_cleared": self.pool_cleared,
+            }
+
+
+pool_stats_listener = PoolStatsListener()
+
+
+#Devuelve el MongoClient del proceso. Se crea uno solo por proceso (y se vuelve
+#a crear despues de un fork) asi todas las requests comparten el mismo pool
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _client_pid != pid:
+            #El cliente heredado del proceso padre no se cierra, sus sockets son del padre
+            pool_stats_listener.reset()
+            _client = MongoClient(
+                MONGO_URI,
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                retryReads=True,  #Reintenta una vez si hay failover del primario
+                retryWrites=True,
+                appName="TiendaMia",
+                event_listeners=[pool_stats_listener, command_listener] if METRICS_ENABLED else [pool_stats_listener],
+            )
+            _client_pid = pid
+    return _client
+
 
 def get_db():
-    client = MongoClient("mongodb://127.0.0.1:27017/?directConnection=true&serverSelectionTimeoutMS=2000&appName=mongosh+2.2.3")
-    db = client['TiendaMia_db']
-    return db
+    return get_client()[MONGO_DB_NAME]
+
+
+def close_client():
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def get_pool_stats():
+    stats = pool_stats_listener.stats()
+    stats.update({
+        "pid": os.getpid(),
+        "max_pool_size": MONGO_MAX_POOL_SIZE,
+        "min_pool_size": MONGO_MIN_POOL_SIZE,
+        "connected": _client is not None and _client_pid == os.getpid(),
+    })
+    return stats
+
+
+_transactions_supported = {}
+
+#Las transacciones multi-documento solo funcionan en replica set o cluster (mongos)
+def supports_transactions(client=None):
+    client = client or get_client()
+    key = id(client)
+    if key not in _transactions_supported:
+        try:
+            hello = client.admin.command("hello")
+            _transactions_supported[key] = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception:
+            return False
+    return _transactions_supported[key]
+
+
+#Coleccion que devuelve RawBSONDocument: los campos se decodifican recien cuando
+#se leen y el documento es de solo lectura (para listados que solo se muestran)
+def raw_collection(collection):
+    return collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
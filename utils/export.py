@@ -0,0 +1,175 @@
+import csv
+import io
+import os
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson import ObjectId
+from utils.serializer import dumps
+
+#Documentos que pide el cursor a Mongo por vez y filas por cada parte de la respuesta
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 500))
+
+FORMATS = ("csv", "ndjson")
+
+#Que se exporta de cada coleccion. status solo existe en las ordenes
+EXPORTS = {
+    "orders": {
+        "fields": ["order_number", "user_id", "name", "address", "status", "total", "date", "items"],
+        "status": True,
+    },
+    "payments": {
+        "fields": ["order_number", "user_id", "payment_method", "installments", "total", "final_total",
+                   "total_fee", "iva", "date"],
+        "status": False,
+    },
+    "invoices": {
+        "fields": ["invoice_number", "order_number", "user_id", "name", "address", "payment_method", "installments",
+                   "total", "final_total", "total_fee", "iva", "iva_condition", "date"],
+        "status": False,
+    },
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def _parse_date(value, name):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise ExportError(f"{name} invalido: {value!r} (AAAA-MM-DD)")
+
+
+#Filtro de Mongo para el rango de fechas [date_from, date_to] (dias completos) y
+#el estado. Los documentos viejos no tienen date, para esos se usa la fecha del _id
+def build_query(kind, date_from=None, date_to=None, status=None):
+    if kind not in EXPORTS:
+        raise ExportError(f"No se puede exportar {kind!r}")
+    query = {}
+    if status:
+        if not EXPORTS[kind]["status"]:
+            raise ExportError(f"{kind} no tiene estado")
+        query["status"] = status
+
+    date_range = {}
+    if date_from:
+        date_range["$gte"] = _parse_date(date_from, "from")
+    if date_to:
+        date_range["$lt"] = _parse_date(date_to, "to") + timedelta(days=1)
+    if date_range:
+        id_range = {op: ObjectId.from_datetime(value) for op, value in date_range.items()}
+        query["$or"] = [
+            {"date": date_range},
+            {"date": {"$exists": False}, "_id": id_range},
+        ]
+    return query
+
+
+def open_cursor(db, kind, query):
+    projection = {field: 1 for field in EXPORTS[kind]["fields"]}
+    return db[kind].find(query, projection, batch_size=EXPORT_BATCH_SIZE)
+
+
+#Saca el _id y completa la fecha de los documentos viejos con la del _id
+def _documents(cursor):
+    for document in cursor:
+        _id = document.pop("_id", None)
+        if document.get("date") is None and isinstance(_id, ObjectId):
+            document["date"] = _id.generation_time.replace(tzinfo=None)
+        yield document
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return dumps(value).decode('utf-8')
+    return value
+
+
+#Filas de CSV de a EXPORT_CHUNK_ROWS, reusando el mismo buffer
+def iter_csv(documents, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    rows = 0
+    for document in documents:
+        writer.writerow([_csv_value(document.get(field)) for field in fields])
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(documents):
+    chunk = []
+    for document in documents:
+        chunk.append(dumps(document))
+        if len(chunk) >= EXPORT_CHUNK_ROWS:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+#Comprime a medida que se generan las partes (formato gzip)
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+#Partes del archivo exportado, listas para mandar o escribir
+def export_chunks(db, kind, fmt="csv", date_from=None, date_to=None, status=None, compress=False):
+    if fmt not in FORMATS:
+        raise ExportError(f"Formato desconocido: {fmt!r}")
+    documents = _documents(open_cursor(db, kind, build_query(kind, date_from, date_to, status)))
+    chunks = iter_csv(documents, EXPORTS[kind]["fields"]) if fmt == "csv" else iter_ndjson(documents)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_filename(kind, fmt, compress=False):
+    return f"{kind}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{fmt}{'.gz' if compress else ''}"
+
+
+#Uso: python utils/export.py orders|payments|invoices [--format csv|ndjson] [--from AAAA-MM-DD]
+#         [--to AAAA-MM-DD] [--status Pagado] [--gzip] [--output archivo]  (sin --output va a stdout)
+def main():
+    from utils.db import get_db
+
+    args = sys.argv[1:]
+    if not args or args[0] not in EXPORTS:
+        print(f"Uso: python utils/export.py {'|'.join(EXPORTS)} [--format csv|ndjson] [--from AAAA-MM-DD] "
+              f"[--to AAAA-MM-DD] [--status <estado>] [--gzip] [--output <archivo>]", file=sys.stderr)
+        sys.exit(2)
+
+    def option(name, default=None):
+        return args[args.index(name) + 1] if name in args else default
+
+    try:
+        chunks = export_chunks(get_db(), args[0], option("--format", "csv"), option("--from"), option("--to"),
+                               option("--status"), '--gzip' in args)
+        output = option("--output")
+        with (open(output, 'wb') if output else sys.stdout.buffer) as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except ExportError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
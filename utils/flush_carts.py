@@ -0,0 +1,25 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.db import get_db
+from models.cart import flush_dirty_carts
+
+#Cada cuantos segundos se guardan en Mongo los carritos de Redis que cambiaron
+FLUSH_INTERVAL = int(os.environ.get("CART_FLUSH_INTERVAL", 60))
+
+#Uso: python utils/flush_carts.py          (queda corriendo)
+#     python utils/flush_carts.py --once   (un solo flush, para cron)
+def main():
+    db = get_db()
+    while True:
+        flushed = flush_dirty_carts(db)
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} carritos guardados: {flushed}")
+        if '--once' in sys.argv:
+            break
+        time.sleep(FLUSH_INTERVAL)
+
+if __name__ == '__main__':
+    main()
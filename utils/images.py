@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, features
+except ImportError:  #Sin Pillow se guarda solo el original
+    Image = None
+
+BASE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPLOAD_FOLDER = os.path.join(BASE_FOLDER, 'static', 'uploads')
+VARIANTS_FOLDER = os.path.join(UPLOAD_FOLDER, 'variants')
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+
+#Tamaño maximo (ancho, alto) de cada variante
+VARIANTS = {
+    "thumb": (150, 150),
+    "card": (400, 400),
+    "detail": (1000, 1000),
+}
+VARIANT_QUALITY = 82
+HASHED_NAME = re.compile(r"^[0-9a-f]{32}\.\w+$")
+
+#Las variantes se generan en hilos sin contexto de la app (y desde la linea de
+#comandos), por eso se usa un logger del modulo y no current_app.logger
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+#Imagenes con variantes encoladas, para no encolar la misma dos veces
+_pending = set()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="images")
+            _executor_pid = os.getpid()
+    return _executor
+
+
+def variant_format():
+    if Image is not None and features.check('webp'):
+        return "webp"
+    return "jpg"
+
+
+def variant_filename(filename, variant):
+    return f"{os.path.splitext(filename)[0]}_{variant}.{variant_format()}"
+
+
+#Guarda la imagen subida con el hash de su contenido como nombre (si ya existe
+#no se vuelve a escribir) y encola la generacion de variantes. Devuelve la ruta
+#que se guarda en el producto, relativa a static/
+def save_upload(file, extension):
+    data = file.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    filename = f"{digest}.{extension.lower()}"
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    if not os.path.exists(path):
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    schedule_variants(filename)
+    return f'uploads/{filename}'
+
+
+#Encola la generacion de variantes de una imagen ya guardada (si no estaba encolada)
+def schedule_variants(filename):
+    if Image is None:
+        return
+    with _lock:
+        if filename in _pending:
+            return
+        _pending.add(filename)
+    future = _get_executor().submit(generate_variants, filename)
+    future.add_done_callback(lambda _: _pending.discard(filename))
+
+
+def generate_variants(filename):
+    source = os.path.join(UPLOAD_FOLDER, filename)
+    os.makedirs(VARIANTS_FOLDER, exist_ok=True)
+    fmt = variant_format()
+    created = False
+    try:
+        with Image.open(source) as image:
+            image.load()
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            if fmt == "jpg" and image.mode == "RGBA":
+                image = image.convert("RGB")
+            for variant, size in VARIANTS.items():
+                target = os.path.join(VARIANTS_FOLDER, variant_filename(filename, variant))
+                if os.path.exists(target):
+                    continue
+                resized = image.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+                tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+                resized.save(tmp_path, "WEBP" if fmt == "webp" else "JPEG", quality=VARIANT_QUALITY, optimize=True)
+                os.replace(tmp_path, target)
+                created = True
+    except (OSError, ValueError) as e:
+        logger.warning("No se pudieron generar las variantes de %s: %s", filename, e)
+        return False
+    return created
+
+
+#Carpeta y nombre del archivo a servir: la variante si ya se genero o, si no
+#(todavia se esta procesando o es una imagen vieja), el original. A las imagenes
+#viejas se les encolan las variantes la primera vez que se piden. El booleano
+#indica si se puede cachear para siempre (la variante ya existe y su nombre es
+#el hash del contenido)
+def resolve_variant(filename, variant):
+    filename = os.path.basename(filename)
+    if variant in VARIANTS:
+        name = variant_filename(filename, variant)
+        if os.path.exists(os.path.join(VARIANTS_FOLDER, name)):
+            return VARIANTS_FOLDER, name, bool(HASHED_NAME.match(filename))
+        if os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
+            schedule_variants(filename)
+    return UPLOAD_FOLDER, filename, False
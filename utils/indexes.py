@@ -0,0 +1,149 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+from utils.db import get_db
+from models.audit_log import ensure_audit_collection
+from models.analytics import ANALYTICS_EVENT_RETENTION_DAYS
+from models.product import RESERVATION_TTL
+
+#Indices que necesita la aplicacion, por coleccion: (claves, opciones)
+INDEXES = {
+    "products": [
+        ([("productId", ASCENDING)], {"unique": True}),
+        ([("isDeleted", ASCENDING), ("_id", ASCENDING)], {}),
+        ([("name", TEXT), ("description", TEXT)],
+         {"name": "products_text", "weights": {"name": 10, "description": 1}, "default_language": "spanish"}),
+        #Marcas de reservas sin transacciones (Product.sweep_reservations)
+        ([("reservations", ASCENDING)], {"sparse": True}),
+    ],
+    #Reservas de stock en curso sin transacciones, Mongo borra las vencidas
+    "stock_reservations": [
+        ([("created_at", ASCENDING)], {"expireAfterSeconds": RESERVATION_TTL}),
+    ],
+    "orders": [
+        ([("order_number", ASCENDING)], {"unique": True}),
+        ([("user_id", ASCENDING), ("order_number", DESCENDING)], {}),
+        ([("date", ASCENDING)], {}),
+        ([("status", ASCENDING), ("date", ASCENDING)], {}),
+    ],
+    "carts": [
+        ([("cartId", ASCENDING)], {"unique": True}),
+    ],
+    "audit_logs": [
+        ([("timestamp", DESCENDING), ("_id", DESCENDING)], {}),
+        ([("product_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {}),
+        ([("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {}),
+        ([("action", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {}),
+    ],
+    "invoices": [
+        ([("invoice_number", ASCENDING)], {"unique": True}),
+        #Una factura y un pago por orden, Payment.commit_payment hace upsert por order_number
+        ([("order_number", ASCENDING)], {"unique": True}),
+        ([("date", ASCENDING)], {}),
+    ],
+    "payments": [
+        ([("order_number", ASCENDING)], {"unique": True}),
+        ([("date", ASCENDING)], {}),
+    ],
+    "sales_rollups": [
+        ([("kind", ASCENDING), ("day", DESCENDING)], {}),
+    ],
+    #Eventos ya sumados a sales_rollups, Mongo los borra pasada la retencion
+    "sales_rollup_events": [
+        ([("created_at", ASCENDING)], {"expireAfterSeconds": ANALYTICS_EVENT_RETENTION_DAYS * 86400}),
+    ],
+}
+
+#Formas de las consultas que hacen models/* y app.py: (nombre, coleccion, filtro, orden)
+QUERY_SHAPES = [
+    ("Product.get_product", "products", {"productId": "x"}, None),
+    ("Product.get_products", "products", {"productId": {"$in": ["x", "y"]}}, None),
+    ("Product.get_active_products_page", "products", {"isDeleted": False, "stock": {"$gt": 0}}, [("_id", ASCENDING)]),
+    ("Product.get_active_products_admin_page", "products", {"isDeleted": False}, [("_id", ASCENDING)]),
+    ("Product.search_products", "products", {"$text": {"$search": "x"}, "isDeleted": False, "stock": {"$gt": 0}}, None),
+    ("Product.get_deleted_products", "products", {"isDeleted": True}, None),
+    ("Product.get_all_products_page", "products", {}, [("_id", ASCENDING)]),
+    ("Product.reserve_stock", "products", {"productId": "x", "isDeleted": False, "stock": {"$gte": 1}}, None),
+    ("Product.sweep_reservations", "products", {"reservations": {"$type": "string"}}, None),
+    ("Order.get_order", "orders", {"order_number": 1}, None),
+    ("Order.get_orders_by_user_page", "orders", {"user_id": "x"}, [("order_number", DESCENDING)]),
+    ("Order.get_all_orders_page", "orders", {}, [("order_number", DESCENDING)]),
+    ("Cart.get_cart", "carts", {"cartId": "x"}, None),
+    ("AuditLog.get_logs_page", "audit_logs", {}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("AuditLog.get_logs_page(product_id)", "audit_logs", {"product_id": "x"}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("AuditLog.get_logs_page(user_id)", "audit_logs", {"user_id": "x"}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("AuditLog.get_logs_page(action)", "audit_logs", {"action": "x"}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("Invoice.get_invoice_by_orderId", "invoices", {"order_number": 1}, None),
+    ("SalesAnalytics.get_daily", "sales_rollups", {"kind": "day"}, [("day", DESCENDING)]),
+    ("SalesAnalytics.get_top_products", "sales_rollups", {"kind": "product"}, None),
+    ("SalesAnalytics.get_summary", "sales_rollups", {"kind": {"$in": ["status", "method", "installments"]}}, None),
+]
+
+
+def _index_name(keys):
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+#Crea los indices que faltan. create_index no hace nada si el indice ya existe.
+#Antes se crea el indice TTL de audit_logs, ver models/audit_log.py
+def ensure_indexes(db):
+    results = [("audit_logs", "retention", ensure_audit_collection(db))]
+    for collection_name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                name = db[collection_name].create_index(keys, **options)
+                results.append((collection_name, name, "ok"))
+            except OperationFailure as e:
+                #Ej. un indice unico con datos duplicados, se informa y se sigue con los demas
+                results.append((collection_name, _index_name(keys), f"error: {e}"))
+    return results
+
+
+def _stages(plan):
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_stages(value))
+    return stages
+
+
+#Corre explain() sobre cada forma de consulta y marca las que hacen COLLSCAN o SORT en memoria
+def explain_audit(db):
+    report = []
+    for name, collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = _stages(plan)
+        problems = [stage for stage in ("COLLSCAN", "SORT") if stage in stages]
+        report.append({"query": name, "collection": collection_name, "stages": stages, "problems": problems})
+    return report
+
+
+#Uso: python utils/indexes.py            (crea los indices)
+#     python utils/indexes.py --explain  (crea los indices y audita las consultas)
+def main():
+    db = get_db()
+    for collection_name, name, status in ensure_indexes(db):
+        print(f"{collection_name}.{name}: {status}")
+
+    if '--explain' in sys.argv:
+        failed = False
+        for row in explain_audit(db):
+            status = ", ".join(row["problems"]) if row["problems"] else "ok"
+            print(f"{row['query']} ({row['collection']}): {status}  [{' > '.join(row['stages'])}]")
+            failed = failed or bool(row["problems"])
+        sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
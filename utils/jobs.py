@@ -0,0 +1,254 @@
+import functools
+import importlib
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+import redis
+from bson import json_util
+from utils.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+#Configuración de la cola de trabajos, se puede ajustar con variables de entorno
+#JOBS_SYNC=1 ejecuta los trabajos en el mismo request (tests, desarrollo)
+JOBS_SYNC = os.environ.get("JOBS_SYNC", "0") == "1"
+JOBS_MAX_ATTEMPTS = int(os.environ.get("JOBS_MAX_ATTEMPTS", 5))
+JOBS_BACKOFF_BASE = float(os.environ.get("JOBS_BACKOFF_BASE", 2))
+JOBS_BACKOFF_MAX = float(os.environ.get("JOBS_BACKOFF_MAX", 300))
+#Cuantos trabajos fallidos se guardan en la cola de muertos
+JOBS_DEAD_MAX = int(os.environ.get("JOBS_DEAD_MAX", 10000))
+
+#Cada cuanto el worker avisa que sigue vivo y a los cuantos segundos sin aviso
+#se considera muerto (sus trabajos en proceso vuelven a la cola)
+JOBS_HEARTBEAT_INTERVAL = float(os.environ.get("JOBS_HEARTBEAT_INTERVAL", 10))
+JOBS_WORKER_TTL = int(os.environ.get("JOBS_WORKER_TTL", 60))
+
+QUEUE_KEY = "jobs:queue"
+DELAYED_KEY = "jobs:delayed"
+DEAD_KEY = "jobs:dead"
+#Trabajos que esta ejecutando cada worker (jobs:processing:<worker>), el aviso
+#de vida de cada uno (jobs:worker:<worker>) y los workers registrados
+PROCESSING_KEY = "jobs:processing:{}"
+HEARTBEAT_KEY = "jobs:worker:{}"
+WORKERS_KEY = "jobs:workers"
+
+#Modulos donde estan las funciones marcadas con @deferrable, el worker los importa
+JOB_MODULES = ["utils.tasks", "utils.classify_users", "models.analytics"]
+
+_registry = {}
+
+#Pasa a la cola los reintentos que ya se pueden ejecutar. Lo hace un solo
+#worker por trabajo aunque haya varios procesos corriendo
+_PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('LPUSH', KEYS[2], job)
+end
+return #due
+"""
+
+
+#Devuelve a la cola los trabajos en proceso de un worker y lo da de baja. Se
+#usa para los workers muertos (sin aviso de vida) y al apagar uno. Van al final
+#que lee BLMOVE, asi se ejecutan antes que los nuevos
+_REQUEUE_SCRIPT = """
+local count = 0
+while redis.call('RPOPLPUSH', KEYS[1], KEYS[2]) do
+    count = count + 1
+end
+redis.call('SREM', KEYS[3], ARGV[1])
+return count
+"""
+
+
+def set_sync(enabled):
+    global JOBS_SYNC
+    JOBS_SYNC = enabled
+
+
+#Marca una funcion como diferible: f(...) la sigue ejecutando en el momento y
+#f.delay(...) la encola para que la corra un worker. Los argumentos tienen que
+#poder pasarse a JSON (json_util, asi que datetime y ObjectId sirven)
+def deferrable(fn):
+    name = f"{fn.__module__}.{fn.__qualname__}"
+    _registry[name] = fn
+
+    @functools.wraps(fn)
+    def delay(*args, **kwargs):
+        return enqueue(name, *args, **kwargs)
+
+    fn.delay = delay
+    fn.job_name = name
+    return fn
+
+
+def enqueue(name, *args, **kwargs):
+    payload = json_util.dumps({
+        "id": uuid.uuid4().hex,
+        "name": name,
+        "args": list(args),
+        "kwargs": kwargs,
+        "attempts": 0,
+    })
+    if JOBS_SYNC:
+        return _run(json_util.loads(payload))
+    try:
+        get_redis_client().lpush(QUEUE_KEY, payload)
+    except redis.RedisError as e:
+        #Sin Redis el trabajo no se pierde, se hace en el request como antes
+        logger.warning("No se pudo encolar %s, se ejecuta en el momento: %s", name, e)
+        return _run(json_util.loads(payload))
+    return None
+
+
+def _run(job):
+    return _registry[job["name"]](*job["args"], **job["kwargs"])
+
+
+def _backoff(attempts):
+    delay = min(JOBS_BACKOFF_MAX, JOBS_BACKOFF_BASE ** attempts)
+    return delay * random.uniform(0.5, 1)
+
+
+#Ejecuta un trabajo sacado de la cola. Si falla se vuelve a intentar mas tarde
+#(cada vez esperando mas) y despues de JOBS_MAX_ATTEMPTS va a la cola de muertos.
+#Con processing_key el trabajo se saca de la lista de en proceso del worker en
+#la misma transaccion que lo reencola
+def process(payload, redis_client=None, processing_key=None):
+    redis_client = redis_client or get_redis_client()
+    job = json_util.loads(payload)
+    pipe = redis_client.pipeline()
+    if processing_key:
+        pipe.lrem(processing_key, 1, payload)
+    try:
+        if job["name"] not in _registry:
+            raise LookupError(f"trabajo desconocido: {job['name']}")
+        _run(job)
+        return True
+    except Exception as e:
+        job["attempts"] += 1
+        job["error"] = repr(e)
+        if job["attempts"] >= JOBS_MAX_ATTEMPTS or isinstance(e, LookupError):
+            job["failed_at"] = time.time()
+            pipe.lpush(DEAD_KEY, json_util.dumps(job))
+            pipe.ltrim(DEAD_KEY, 0, JOBS_DEAD_MAX - 1)
+            logger.exception("Trabajo %s (%s) descartado despues de %d intentos",
+                             job["name"], job["id"], job["attempts"])
+        else:
+            pipe.zadd(DELAYED_KEY, {json_util.dumps(job): time.time() + _backoff(job["attempts"])})
+            logger.warning("Trabajo %s (%s) fallo (intento %d), se reintenta: %r",
+                           job["name"], job["id"], job["attempts"], e)
+        return False
+    finally:
+        if len(pipe):
+            pipe.execute()
+
+
+def promote_delayed(redis_client=None, limit=100):
+    redis_client = redis_client or get_redis_client()
+    script = redis_client.register_script(_PROMOTE_SCRIPT)
+    return script(keys=[DELAYED_KEY, QUEUE_KEY], args=[time.time(), limit])
+
+
+#Vuelve a encolar los trabajos de la cola de muertos (ej. despues de arreglar el error)
+def retry_dead(redis_client=None):
+    redis_client = redis_client or get_redis_client()
+    count = 0
+    while True:
+        payload = redis_client.rpop(DEAD_KEY)
+        if payload is None:
+            return count
+        job = json_util.loads(payload)
+        job["attempts"] = 0
+        redis_client.lpush(QUEUE_KEY, json_util.dumps(job))
+        count += 1
+
+
+#Reencola lo que estaban ejecutando los workers que dejaron de avisar que estan
+#vivos (se cortaron a mitad de un trabajo). Lo corre cada worker en su loop
+def requeue_stale(redis_client=None):
+    redis_client = redis_client or get_redis_client()
+    workers = [worker.decode('utf-8') for worker in redis_client.smembers(WORKERS_KEY)]
+    if not workers:
+        return 0
+    pipe = redis_client.pipeline(transaction=False)
+    for worker in workers:
+        pipe.exists(HEARTBEAT_KEY.format(worker))
+    alive = pipe.execute()
+    script = redis_client.register_script(_REQUEUE_SCRIPT)
+    requeued = 0
+    for worker, is_alive in zip(workers, alive):
+        if not is_alive:
+            requeued += script(keys=[PROCESSING_KEY.format(worker), QUEUE_KEY, WORKERS_KEY], args=[worker])
+    if requeued:
+        logger.warning("Trabajos de workers caidos reencolados: %d", requeued)
+    return requeued
+
+
+def queue_stats(redis_client=None):
+    redis_client = redis_client or get_redis_client()
+    workers = [worker.decode('utf-8') for worker in redis_client.smembers(WORKERS_KEY)]
+    pipe = redis_client.pipeline()
+    pipe.llen(QUEUE_KEY)
+    pipe.zcard(DELAYED_KEY)
+    pipe.llen(DEAD_KEY)
+    for worker in workers:
+        pipe.llen(PROCESSING_KEY.format(worker))
+    queued, delayed, dead, *processing = pipe.execute()
+    return {"queued": queued, "delayed": delayed, "dead": dead, "processing": sum(processing),
+            "workers": len(workers)}
+
+
+def load_job_modules():
+    for module in JOB_MODULES:
+        importlib.import_module(module)
+
+
+#Aviso de vida del worker, en un hilo aparte para que un trabajo largo no lo
+#haga parecer muerto
+def _heartbeat(redis_client, worker_id, stop):
+    key = HEARTBEAT_KEY.format(worker_id)
+    while not stop.is_set():
+        try:
+            redis_client.set(key, 1, ex=JOBS_WORKER_TTL)
+        except redis.RedisError as e:
+            logger.warning("No se pudo actualizar el aviso de vida de %s: %s", worker_id, e)
+        stop.wait(JOBS_HEARTBEAT_INTERVAL)
+
+
+#Loop del worker. Se pueden correr varios procesos a la vez: BLMOVE le da cada
+#trabajo a uno solo y lo deja en su lista de en proceso hasta que termina, asi
+#si el worker se corta el trabajo no se pierde (otro worker lo reencola con
+#requeue_stale). Con burst=True termina cuando la cola queda vacia
+def work(burst=False, poll_timeout=1):
+    load_job_modules()
+    redis_client = get_redis_client()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    processing_key = PROCESSING_KEY.format(worker_id)
+    redis_client.set(HEARTBEAT_KEY.format(worker_id), 1, ex=JOBS_WORKER_TTL)
+    redis_client.sadd(WORKERS_KEY, worker_id)
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(redis_client, worker_id, stop), daemon=True).start()
+    logger.info("Worker %s esperando trabajos", worker_id)
+    processed = 0
+    try:
+        while True:
+            promote_delayed(redis_client)
+            requeue_stale(redis_client)
+            payload = redis_client.blmove(QUEUE_KEY, processing_key, poll_timeout, "RIGHT", "LEFT")
+            if payload is None:
+                if burst:
+                    return processed
+                continue
+            process(payload, redis_client, processing_key)
+            processed += 1
+    finally:
+        #Al apagarse (o con Ctrl+C a mitad de un trabajo) lo que quedo en proceso vuelve a la cola
+        stop.set()
+        redis_client.delete(HEARTBEAT_KEY.format(worker_id))
+        redis_client.register_script(_REQUEUE_SCRIPT)(keys=[processing_key, QUEUE_KEY, WORKERS_KEY], args=[worker_id])
@@ -0,0 +1,338 @@
+import bisect
+import hmac
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import redis
+from redis.client import Pipeline
+from pymongo import monitoring
+
+#Metricas de la aplicacion en formato Prometheus (GET /metrics). Cuenta los
+#comandos de Mongo (CommandListener) y de Redis (InstrumentedRedis) por endpoint
+#y por coleccion o prefijo de clave, la duracion de las requests y el estado de
+#los pools. Cada worker tiene sus propios valores: Prometheus los junta por instancia
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+#/metrics pide "Authorization: Bearer <METRICS_TOKEN>" (configurar el mismo token
+#en el scrape de Prometheus). Sin METRICS_TOKEN el endpoint no se registra: las
+#metricas muestran endpoints, colecciones y tiempos y no tienen que quedar publicas
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+#Las requests que tardan mas que esto se loguean con el detalle de sus comandos
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+#Endpoint de lo que no pasa por una request (worker, hilos de fondo)
+BACKGROUND = "background"
+
+#Un comando de Mongo o Redis: target es la coleccion o el prefijo de la clave
+Command = namedtuple("Command", ["backend", "command", "target", "seconds", "failed"])
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        #Por cada combinacion de labels: [cantidad por bucket..., +Inf], suma
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(label_values) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self.values[label_values] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for label_values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+request_duration = Histogram("tiendamia_http_request_duration_seconds", "Duracion de las requests",
+                             ("endpoint", "method", "status"))
+request_commands = Histogram("tiendamia_http_request_db_commands", "Comandos de Mongo o Redis por request",
+                             ("endpoint", "backend"), COUNT_BUCKETS)
+mongo_duration = Histogram("tiendamia_mongo_command_duration_seconds", "Duracion de los comandos de Mongo",
+                           ("endpoint", "command", "collection"), COMMAND_BUCKETS)
+mongo_errors = Counter("tiendamia_mongo_command_errors_total", "Comandos de Mongo con error",
+                       ("endpoint", "command", "collection"))
+redis_commands = Counter("tiendamia_redis_commands_total", "Comandos de Redis (incluye los de pipelines)",
+                         ("endpoint", "command", "prefix"))
+redis_duration = Histogram("tiendamia_redis_roundtrip_duration_seconds",
+                           "Duracion de cada viaje a Redis (un comando o un pipeline)",
+                           ("endpoint", "command"), COMMAND_BUCKETS)
+redis_errors = Counter("tiendamia_redis_errors_total", "Viajes a Redis con error", ("endpoint", "command"))
+
+METRICS = [request_duration, request_commands, mongo_duration, mongo_errors, redis_commands, redis_duration,
+           redis_errors]
+
+
+#Endpoint de la request actual y comandos que se estan capturando en este thread
+_local = threading.local()
+
+
+def current_endpoint():
+    return getattr(_local, "endpoint", None) or BACKGROUND
+
+
+def start_capture():
+    commands = []
+    if not hasattr(_local, "captures"):
+        _local.captures = []
+    _local.captures.append(commands)
+    return commands
+
+
+#Se saca por identidad: dos capturas vacias son iguales
+def stop_capture(commands):
+    _local.captures[:] = [c for c in _local.captures if c is not commands]
+
+
+#Captura los comandos de Mongo y Redis que se hacen en este thread mientras
+#dura el bloque (se pueden anidar). Lo usan el log de requests lentas, el
+#benchmark y los tests de presupuesto de consultas
+@contextmanager
+def capture():
+    commands = start_capture()
+    try:
+        yield commands
+    finally:
+        stop_capture(commands)
+
+
+def record_command(command):
+    for commands in getattr(_local, "captures", ()):
+        commands.append(command)
+
+
+#Comandos de Mongo. pymongo llama a started y succeeded/failed en el mismo thread
+class CommandMetricsListener(monitoring.CommandListener):
+    def __init__(self):
+        self.local = threading.local()
+
+    def _pending(self):
+        if not hasattr(self.local, "pending"):
+            self.local.pending = {}
+        return self.local.pending
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = "-"
+        self._pending()[(event.request_id, event.connection_id)] = (collection, current_endpoint())
+
+    def _finish(self, event, failed):
+        collection, endpoint = self._pending().pop((event.request_id, event.connection_id), ("-", current_endpoint()))
+        seconds = event.duration_micros / 1e6
+        mongo_duration.observe(seconds, endpoint, event.command_name, collection)
+        if failed:
+            mongo_errors.inc(endpoint, event.command_name, collection)
+        record_command(Command("mongo", event.command_name, collection, seconds, failed))
+
+    def succeeded(self, event):
+        self._finish(event, False)
+
+    def failed(self, event):
+        self._finish(event, True)
+
+
+command_listener = CommandMetricsListener()
+
+
+def _command_name(args):
+    return str(args[0]).upper() if args else "-"
+
+
+#Prefijo de la clave del comando (ej. "cart" para cart:bob:items). En EVAL y
+#EVALSHA la primera clave va despues del numero de claves
+def _key_prefix(args):
+    name = _command_name(args)
+    if name in ("EVAL", "EVALSHA"):
+        key = args[3] if len(args) > 3 and int(args[2]) > 0 else None
+    else:
+        key = args[1] if len(args) > 1 else None
+    if isinstance(key, bytes):
+        key = key.decode('utf-8', 'replace')
+    if not isinstance(key, str):
+        return "-"
+    return key.split(':', 1)[0]
+
+
+def _record_redis(args_list, command, seconds, failed):
+    endpoint = current_endpoint()
+    for args in args_list:
+        redis_commands.inc(endpoint, _command_name(args), _key_prefix(args))
+        record_command(Command("redis", _command_name(args), _key_prefix(args), seconds / len(args_list), failed))
+    redis_duration.observe(seconds, endpoint, command)
+    if failed:
+        redis_errors.inc(endpoint, command)
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        stack = [args for args, _ in self.command_stack]
+        if not stack:
+            return super().execute(raise_on_error)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(raise_on_error)
+            failed = False
+            return result
+        finally:
+            _record_redis(stack, "PIPELINE", time.perf_counter() - started, failed)
+
+
+#Cliente de Redis que cuenta cada comando. Los pipelines cuentan un viaje con
+#todos sus comandos
+class InstrumentedRedis(redis.Redis):
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute_command(*args, **options)
+            failed = False
+            return result
+        finally:
+            _record_redis([args], _command_name(args), time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def _pool_gauges():
+    from utils.db import get_pool_stats
+    from utils.redis_client import get_redis_pool_stats
+
+    lines = ["# HELP tiendamia_mongo_pool_connections Conexiones del pool de Mongo",
+             "# TYPE tiendamia_mongo_pool_connections gauge"]
+    mongo = get_pool_stats()
+    for state in ("open", "in_use"):
+        lines.append(f'tiendamia_mongo_pool_connections{{state="{state}"}} {mongo[state]}')
+    lines += ["# HELP tiendamia_mongo_pool_max_size Maximo de conexiones del pool de Mongo",
+              "# TYPE tiendamia_mongo_pool_max_size gauge",
+              f"tiendamia_mongo_pool_max_size {mongo['max_pool_size']}",
+              "# HELP tiendamia_mongo_pool_checkout_failed_total Esperas por conexion que vencieron",
+              "# TYPE tiendamia_mongo_pool_checkout_failed_total counter",
+              f"tiendamia_mongo_pool_checkout_failed_total {mongo['checkout_failed']}",
+              "# HELP tiendamia_redis_pool_connections Conexiones del pool de Redis",
+              "# TYPE tiendamia_redis_pool_connections gauge"]
+    redis_stats = get_redis_pool_stats()
+    for state in ("created", "available", "in_use"):
+        lines.append(f'tiendamia_redis_pool_connections{{state="{state}"}} {redis_stats[state]}')
+    lines += ["# HELP tiendamia_redis_pool_max_connections Maximo de conexiones del pool de Redis",
+              "# TYPE tiendamia_redis_pool_max_connections gauge",
+              f"tiendamia_redis_pool_max_connections {redis_stats['max_connections']}"]
+    return lines
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += _pool_gauges()
+    return "\n".join(lines) + "\n"
+
+
+#Resumen de los comandos de una request: "mongo find products x9 (12.3ms), ..."
+def summarize_commands(commands, limit=10):
+    grouped = {}
+    for command in commands:
+        key = (command.backend, command.command, command.target)
+        count, seconds = grouped.get(key, (0, 0))
+        grouped[key] = (count + 1, seconds + command.seconds)
+    top = sorted(grouped.items(), key=lambda item: (-item[1][0], -item[1][1]))[:limit]
+    return ", ".join(f"{backend} {command} {target} x{count} ({seconds * 1000:.1f}ms)"
+                     for (backend, command, target), (count, seconds) in top)
+
+
+#Registra los hooks de la app: duracion de cada request, comandos por request,
+#log de las lentas y el endpoint /metrics (solo con METRICS_TOKEN)
+def init_app(app):
+    from flask import g, request, Response, abort
+
+    @app.before_request
+    def start_request_metrics():
+        _local.endpoint = request.endpoint or "unmatched"
+        g.metrics_started = time.perf_counter()
+        g.metrics_commands = start_capture()
+
+    @app.after_request
+    def set_request_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        if 'metrics_commands' not in g:
+            return
+        commands = g.pop('metrics_commands')
+        stop_capture(commands)
+        endpoint = current_endpoint()
+        _local.endpoint = None
+        seconds = time.perf_counter() - g.metrics_started
+        request_duration.observe(seconds, endpoint, request.method, g.get('metrics_status', 500))
+        for backend in ("mongo", "redis"):
+            request_commands.observe(sum(1 for c in commands if c.backend == backend), endpoint, backend)
+        if seconds * 1000 >= SLOW_REQUEST_MS:
+            app.logger.warning(f"Request lenta: {request.method} {request.path} ({endpoint}) {seconds * 1000:.0f}ms, "
+                               f"{len(commands)} comandos: {summarize_commands(commands)}")
+
+    if not METRICS_TOKEN:
+        app.logger.info("METRICS_TOKEN no esta configurado, /metrics desactivado")
+        return
+
+    @app.route('/metrics')
+    def metrics():
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {METRICS_TOKEN}".encode('utf-8')):
+            abort(401)
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
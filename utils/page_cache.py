@@ -0,0 +1,83 @@
+import hashlib
+import os
+from flask import request, make_response
+from markupsafe import Markup
+from models.catalog_cache import catalog_cache
+from utils.current_user import get_current_user
+
+PAGE_CACHE_ENABLED = os.environ.get("PAGE_CACHE_ENABLED", "1") == "1"
+TEMPLATES_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+
+#Hash de los templates: si cambian en un deploy, las paginas viejas que quedan en Redis no se usan
+def _templates_hash():
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(TEMPLATES_FOLDER)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(name.encode('utf-8'))
+                digest.update(f.read())
+    return digest.hexdigest()[:10]
+
+TEMPLATES_HASH = _templates_hash()
+
+
+#Parametros que cambian lo que muestran las paginas cacheadas, con su tipo. Los
+#demas se ignoran: con la URL completa cualquier ?x=... creaba una entrada nueva
+PAGE_PARAMS = (("after", str), ("before", str), ("per_page", int), ("q", str), ("page", int))
+
+
+#Clave de la pagina: la ruta y los parametros conocidos, ya convertidos (per_page=abc
+#es lo mismo que no mandarlo) y siempre en el mismo orden
+def page_key(path=None, args=None):
+    path = request.path if path is None else path
+    args = request.args if args is None else args
+    values = []
+    for name, cast in PAGE_PARAMS:
+        value = args.get(name, type=cast)
+        if isinstance(value, str):
+            value = value.strip()
+        if value not in (None, ""):
+            values.append(f"{name}={value}")
+    return f"{path}?{'&'.join(values)}"
+
+
+def _etag(html):
+    return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+
+#Fragmento de HTML que no depende del usuario (grilla de productos, detalle).
+#Se guarda con la version del catalogo, asi se invalida con cada cambio
+def cached_fragment(key, render):
+    if not PAGE_CACHE_ENABLED:
+        return Markup(render())
+    return Markup(catalog_cache.get_or_load(f"fragment:{TEMPLATES_HASH}:{key}", render))
+
+
+#Pagina completa. Para usuarios anonimos la salida es la misma para todos y se
+#guarda entera; con sesion se renderiza (usando fragmentos) y se manda privada.
+#En los dos casos se manda un ETag y se responde 304 si el navegador ya la tiene
+def cached_page(render):
+    if get_current_user():
+        html = render()
+        response = make_response(html)
+        response.set_etag(_etag(html))
+        response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        if PAGE_CACHE_ENABLED:
+            page = catalog_cache.get_or_load(
+                f"page:{TEMPLATES_HASH}:{page_key()}",
+                lambda: _render_with_etag(render)
+            )
+        else:
+            page = _render_with_etag(render)
+        response = make_response(page["html"])
+        response.set_etag(page["etag"])
+        response.headers['Cache-Control'] = 'public, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def _render_with_etag(render):
+    html = render()
+    return {"html": html, "etag": _etag(html)}
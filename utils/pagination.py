@@ -0,0 +1,104 @@
+import base64
+import binascii
+from bson import json_util
+from pymongo import ASCENDING
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+#Los tokens son los valores de la clave de orden del ultimo (o primer) documento
+def encode_token(values):
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    if not token:
+        return None
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, binascii.Error, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def page_size(per_page, default=DEFAULT_PAGE_SIZE):
+    if not per_page:
+        return default
+    return max(1, min(int(per_page), MAX_PAGE_SIZE))
+
+
+#Filtro para seguir despues del token. Si se ordena por un campo que se puede
+#repetir (ej. timestamp) se desempata con _id
+def _seek_filter(fields, values, direction):
+    op = "$gt" if direction == ASCENDING else "$lt"
+    if len(fields) == 1:
+        return {fields[0]: {op: values[0]}}
+    return {"$or": [
+        {fields[0]: {op: values[0]}},
+        {fields[0]: values[0], fields[1]: {op: values[1]}},
+    ]}
+
+
+#Paginacion por clave (sin skip): trae per_page documentos despues de "after" o
+#antes de "before" y devuelve {"items", "next", "prev"} con los tokens para
+#las paginas vecinas (None si no hay). unique=True si sort_field no se repite
+def keyset_page(collection, query, sort_field, direction=ASCENDING, after=None, before=None,
+                per_page=None, projection=None, unique=False):
+    plan = _plan_page(query, sort_field, direction, after, before, per_page, projection, unique)
+    cursor = collection.find(plan["query"], plan["projection"]).sort(plan["sort"])
+    return _finish_page(list(cursor.limit(plan["per_page"] + 1)), plan)
+
+
+#Igual que keyset_page para colecciones de AsyncMongoClient
+async def async_keyset_page(collection, query, sort_field, direction=ASCENDING, after=None, before=None,
+                            per_page=None, projection=None, unique=False):
+    plan = _plan_page(query, sort_field, direction, after, before, per_page, projection, unique)
+    cursor = collection.find(plan["query"], plan["projection"]).sort(plan["sort"])
+    return _finish_page(await cursor.limit(plan["per_page"] + 1).to_list(), plan)
+
+
+def _plan_page(query, sort_field, direction, after, before, per_page, projection, unique):
+    per_page = page_size(per_page)
+    fields = [sort_field] if sort_field == "_id" or unique else [sort_field, "_id"]
+    if projection is not None:
+        projection = dict(projection, **{field: 1 for field in fields})
+
+    backwards = before is not None and after is None
+    token = decode_token(before if backwards else after)
+    if token is not None and len(token) != len(fields):
+        token = None
+    scan_direction = -direction if backwards else direction
+
+    page_query = query
+    if token is not None:
+        page_query = {"$and": [query, _seek_filter(fields, token, scan_direction)]} if query else _seek_filter(fields, token, scan_direction)
+    return {
+        "query": page_query,
+        "projection": projection,
+        "sort": [(field, scan_direction) for field in fields],
+        "per_page": per_page,
+        "fields": fields,
+        "backwards": backwards,
+        "token": token,
+    }
+
+
+def _finish_page(items, plan):
+    per_page, fields, backwards = plan["per_page"], plan["fields"], plan["backwards"]
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    next_token = prev_token = None
+    if items:
+        first = encode_token([items[0][field] for field in fields])
+        last = encode_token([items[-1][field] for field in fields])
+        if backwards:
+            next_token = last
+            prev_token = first if has_more else None
+        else:
+            next_token = last if has_more else None
+            prev_token = first if plan["token"] is not None else None
+    return {"items": items, "next": next_token, "prev": prev_token}
@@ -0,0 +1,240 @@
+import csv
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo.errors import BulkWriteError
+
+#Filas por bulk_write (y por entrada de auditoria)
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+#Cuantos errores por fila se devuelven en el resumen (se cuentan todos)
+IMPORT_MAX_ERRORS = int(os.environ.get("IMPORT_MAX_ERRORS", 1000))
+
+FORMATS = ("csv", "ndjson")
+TRUE_VALUES = {"1", "true", "si", "sí", "yes"}
+
+
+class RowError(ValueError):
+    pass
+
+
+#El archivo no se puede seguir leyendo (no es UTF-8, CSV roto): corta el import
+class FileError(RowError):
+    pass
+
+
+def detect_format(filename, default="csv"):
+    extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ""
+    if extension in ("ndjson", "jsonl"):
+        return "ndjson"
+    if extension == "csv":
+        return "csv"
+    return default
+
+
+#Decodifica el archivo de a una linea: si hay bytes que no son UTF-8 el error
+#se informa en esa linea y las anteriores se importan
+def _decode_lines(stream):
+    for number, line in enumerate(stream, start=1):
+        yield line.decode('utf-8-sig' if number == 1 else 'utf-8')
+
+
+#Recorre el archivo de a una fila, sin cargarlo entero. Devuelve (nro de linea, fila).
+#Si el archivo no se puede seguir leyendo devuelve un FileError y termina
+def iter_rows(stream, fmt):
+    if fmt == "csv":
+        reader = csv.DictReader(_decode_lines(stream))
+        try:
+            for row in reader:
+                yield reader.line_num, row
+        except UnicodeDecodeError:
+            yield reader.line_num + 1, FileError("la linea no esta en UTF-8")
+        except csv.Error as e:
+            yield reader.line_num, FileError(f"CSV invalido: {e}")
+    else:
+        line_number = 0
+        try:
+            for line_number, line in enumerate(_decode_lines(stream), start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    yield line_number, RowError(f"JSON invalido: {e}")
+        except UnicodeDecodeError:
+            yield line_number + 1, FileError("la linea no esta en UTF-8")
+
+
+#Los numeros tienen que ser finitos (sin nan ni inf) y, si cast es int, enteros:
+#"2.9" o 2.9 como stock es un error y no se redondea. true/false no son numeros
+def _number(row, field, cast, required=True):
+    value = row.get(field)
+    if value is None or value == "":
+        if required:
+            raise RowError(f"falta {field}")
+        return None
+    if isinstance(value, bool):
+        raise RowError(f"{field} invalido: {value!r}")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise RowError(f"{field} invalido: {value!r}")
+    if not math.isfinite(number):
+        raise RowError(f"{field} invalido: {value!r}")
+    if cast is int:
+        if not number.is_integer():
+            raise RowError(f"{field} tiene que ser entero: {value!r}")
+        number = int(value) if isinstance(value, int) else int(number)
+    if number < 0:
+        raise RowError(f"{field} no puede ser negativo")
+    return number
+
+
+#Valida una fila y la convierte al documento de producto. En CSV las imagenes
+#van separadas por |
+def validate_row(row):
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError("la fila no es un objeto")
+    product_id = str(row.get("productId") or "").strip()
+    if not product_id:
+        raise RowError("falta productId")
+    name = str(row.get("name") or "").strip()
+    if not name:
+        raise RowError("falta name")
+
+    product = {
+        "productId": product_id,
+        "name": name,
+        "price": _number(row, "price", float),
+        "stock": _number(row, "stock", int),
+    }
+    if row.get("description") not in (None, ""):
+        product["description"] = str(row["description"])
+    images = row.get("images")
+    if images:
+        product["images"] = images.split("|") if isinstance(images, str) else [str(image) for image in images]
+    if row.get("isDeleted") not in (None, ""):
+        deleted = row["isDeleted"]
+        product["isDeleted"] = deleted if isinstance(deleted, bool) else str(deleted).strip().lower() in TRUE_VALUES
+    return product
+
+
+#Importa un archivo de productos (CSV o NDJSON) haciendo upsert por productId de
+#a IMPORT_BATCH_SIZE filas. La memoria no crece con el tamaño del archivo: solo
+#se guarda el lote actual y hasta IMPORT_MAX_ERRORS errores. audit recibe el
+#detalle de cada lote (una entrada de auditoria por lote). El cache del catalogo
+#se invalida al final, no despues de cada lote. Devuelve el resumen
+#parcial despues de cada lote y al final el resumen con "done": True. Si el
+#archivo no se puede seguir leyendo se guardan las filas anteriores y el error
+#queda en "file_error"
+def iter_import(stream, fmt, product_model, audit=None, batch_size=IMPORT_BATCH_SIZE):
+    summary = {"rows": 0, "valid": 0, "upserted": 0, "modified": 0, "batches": 0,
+               "error_count": 0, "errors": [], "file_error": None, "done": False}
+
+    def add_error(line, message):
+        summary["error_count"] += 1
+        if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+            summary["errors"].append({"line": line, "error": message})
+
+    def flush(batch):
+        lines = [line for line, _ in batch]
+        try:
+            result = product_model.upsert_products([product for _, product in batch])
+            upserted, modified = result.upserted_count, result.modified_count
+        except BulkWriteError as e:
+            details = e.details
+            upserted, modified = details.get("nUpserted", 0), details.get("nModified", 0)
+            for error in details.get("writeErrors", []):
+                add_error(lines[error["index"]], error.get("errmsg", "error de escritura"))
+        summary["batches"] += 1
+        summary["upserted"] += upserted
+        summary["modified"] += modified
+        if audit:
+            audit(f"Import batch {summary['batches']}: {len(batch)} rows "
+                  f"(lines {lines[0]}-{lines[-1]}), {upserted} created, {modified} updated")
+
+    batch = []
+    try:
+        for line, row in iter_rows(stream, fmt):
+            if isinstance(row, FileError):
+                summary["file_error"] = {"line": line, "error": str(row)}
+                add_error(line, str(row))
+                break
+            summary["rows"] += 1
+            try:
+                batch.append((line, validate_row(row)))
+            except RowError as e:
+                add_error(line, str(e))
+                continue
+            summary["valid"] += 1
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+                yield summary
+        if batch:
+            flush(batch)
+    finally:
+        #El cache del catalogo se invalida una sola vez, aunque el import se corte
+        #a la mitad (los lotes anteriores ya se escribieron)
+        product_model.invalidate_cache()
+    summary["done"] = True
+    yield summary
+
+
+#Igual que iter_import pero devuelve solo el resumen final; on_progress se llama despues de cada lote
+def import_products(stream, fmt, product_model, audit=None, on_progress=None, batch_size=IMPORT_BATCH_SIZE):
+    for summary in iter_import(stream, fmt, product_model, audit, batch_size):
+        if on_progress and not summary["done"]:
+            on_progress(summary)
+    return summary
+
+
+#Uso: python utils/product_import.py productos.csv [--format csv|ndjson] [--user admin]
+def main():
+    from utils.db import get_db
+    from utils.tasks import audit_writer
+    from models.catalog_cache import get_product_model
+
+    args = sys.argv[1:]
+    if not args:
+        print("Uso: python utils/product_import.py <archivo> [--format csv|ndjson] [--user <usuario>]")
+        sys.exit(2)
+    path = args[0]
+    fmt = args[args.index("--format") + 1] if "--format" in args else detect_format(path)
+    user_id = args[args.index("--user") + 1] if "--user" in args else "import"
+    if fmt not in FORMATS:
+        print(f"Formato desconocido: {fmt} (csv o ndjson)")
+        sys.exit(2)
+
+    started = time.monotonic()
+
+    def audit(details):
+        audit_writer.log("import", None, user_id, details)
+
+    def progress(summary):
+        elapsed = time.monotonic() - started
+        print(f"lote {summary['batches']}: {summary['rows']} filas, {summary['error_count']} errores, "
+              f"{summary['rows'] / max(elapsed, 0.001):.0f} filas/s", flush=True)
+
+    with open(path, 'rb') as f:
+        summary = import_products(f, fmt, get_product_model(get_db()), audit, progress)
+    audit_writer.flush()
+
+    for error in summary["errors"]:
+        print(f"linea {error['line']}: {error['error']}", file=sys.stderr)
+    if summary["file_error"]:
+        print(f"Import cortado en la linea {summary['file_error']['line']}: {summary['file_error']['error']}",
+              file=sys.stderr)
+    print(f"Filas: {summary['rows']}, creados: {summary['upserted']}, actualizados: {summary['modified']}, "
+          f"errores: {summary['error_count']}")
+    sys.exit(1 if summary["error_count"] else 0)
+
+if __name__ == '__main__':
+    main()
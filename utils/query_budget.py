@@ -0,0 +1,326 @@
+import functools
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import metrics
+
+#Presupuestos de consultas: cuantos comandos de Mongo y Redis puede hacer una
+#request. Se usa desde tests con el test client de Flask:
+#
+#   with query_budget(mongo=3):
+#       client.get('/checkout/12')
+#
+#   assert_no_growth(lambda n: request_commands(client, 'GET', checkout_con_items(n))[1])
+#
+#Si se pasa del presupuesto falla con la lista de comandos. Los comandos se
+#capturan con metrics.capture, que necesita METRICS_ENABLED=1 (el valor por
+#defecto) antes de crear los clientes. Si no estan instrumentados los chequeos
+#fallan con InstrumentationMissing en vez de pasar con cero comandos. mongomock
+#no emite eventos: con count_fake_mongo() cada operacion de una coleccion se
+#cuenta como el comando que mandaria pymongo. Los tests (tests/) usan eso
+
+#Tamaños con los que se prueba que la cantidad de comandos no crece
+GROWTH_SIZES = (1, 5)
+
+#Metodos de la coleccion de mongomock y el comando que mandaria pymongo
+FAKE_MONGO_COMMANDS = {
+    "find": "find", "find_one": "find", "aggregate": "aggregate", "count_documents": "aggregate",
+    "distinct": "distinct", "insert_one": "insert", "insert_many": "insert",
+    "update_one": "update", "update_many": "update", "replace_one": "update",
+    "delete_one": "delete", "delete_many": "delete",
+    "find_one_and_update": "findAndModify", "find_one_and_replace": "findAndModify",
+    "find_one_and_delete": "findAndModify", "bulk_write": "bulkWrite",
+}
+_fake_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    def __init__(self, message, commands):
+        super().__init__(message)
+        self.commands = commands
+
+
+#Los clientes no cuentan comandos: un presupuesto pasaria siempre
+class InstrumentationMissing(RuntimeError):
+    pass
+
+
+#Falla si los comandos de los backends pedidos no se van a ver en metrics.capture
+def require_instrumentation(backends=("mongo", "redis")):
+    from utils.db import get_db
+    from utils.redis_client import get_redis_client
+
+    problems = []
+    if not metrics.METRICS_ENABLED:
+        problems.append("METRICS_ENABLED=0")
+    if "redis" in backends and not isinstance(get_redis_client(), metrics.InstrumentedRedis):
+        problems.append("el cliente de Redis no es InstrumentedRedis")
+    if "mongo" in backends:
+        client = get_db().client
+        if type(client).__module__.startswith("mongomock"):
+            if not _fake_mongo_counted():
+                problems.append("falta count_fake_mongo() para contar los comandos de mongomock")
+        elif metrics.command_listener not in getattr(getattr(client, "options", None), "event_listeners", ()):
+            problems.append("el cliente de Mongo no tiene metrics.command_listener")
+    if problems:
+        raise InstrumentationMissing("No se pueden contar los comandos: " + ", ".join(problems))
+
+
+def _fake_mongo_counted():
+    import mongomock.collection
+    return getattr(mongomock.collection.Collection.find, "counted", False)
+
+
+#Comandos de bulk_write: pymongo manda uno por cada tipo de operacion (insert,
+#update, delete); si es ordenado, uno por cada tramo seguido del mismo tipo
+def _bulk_commands(requests, ordered):
+    kinds = [{"InsertOne": "insert", "DeleteOne": "delete", "DeleteMany": "delete"}.get(type(op).__name__, "update")
+             for op in requests]
+    if not ordered:
+        return sorted(set(kinds))
+    return [kind for i, kind in enumerate(kinds) if i == 0 or kinds[i - 1] != kind]
+
+
+def _counted(method, command):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        #find_one llama a find, etc.: solo se cuenta la llamada de afuera
+        if getattr(_fake_local, "depth", 0):
+            return method(self, *args, **kwargs)
+        _fake_local.depth = 1
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = method(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _fake_local.depth = 0
+            seconds = time.perf_counter() - start
+            if command == "bulkWrite":
+                requests = args[0] if args else kwargs.get("requests", [])
+                names = _bulk_commands(requests, kwargs.get("ordered", True))
+            else:
+                names = [command]
+            for name in names:
+                metrics.record_command(metrics.Command("mongo", name, self.name, seconds, failed))
+    wrapper.counted = True
+    return wrapper
+
+
+#Cuenta las operaciones de mongomock como comandos de Mongo (en metrics.capture).
+#Es una aproximacion: no hay getMore y cada find cuenta como un comando
+def count_fake_mongo():
+    import mongomock.collection
+
+    if _fake_mongo_counted():
+        return
+    for name, command in FAKE_MONGO_COMMANDS.items():
+        setattr(mongomock.collection.Collection, name, _counted(getattr(mongomock.collection.Collection, name), command))
+
+
+def _backends(mongo, redis):
+    return tuple(backend for backend, limit in (("mongo", mongo), ("redis", redis)) if limit is not None)
+
+
+def _count(commands, backend):
+    return sum(1 for command in commands if command.backend == backend)
+
+
+def format_commands(commands, backend=None):
+    return "\n".join(f"  {i}. {c.backend} {c.command} {c.target} ({c.seconds * 1000:.2f}ms){' ERROR' if c.failed else ''}"
+                     for i, c in enumerate((c for c in commands if backend in (None, c.backend)), start=1))
+
+
+def check_budget(commands, mongo=None, redis=None, label="request"):
+    problems = []
+    for backend, limit in (("mongo", mongo), ("redis", redis)):
+        used = _count(commands, backend)
+        if limit is not None and used > limit:
+            problems.append(f"{backend}: {used} comandos, presupuesto {limit}\n{format_commands(commands, backend)}")
+    if problems:
+        raise QueryBudgetExceeded(f"{label} se paso del presupuesto de consultas\n" + "\n".join(problems), commands)
+
+
+#Falla al salir del bloque si se hicieron mas comandos que los permitidos
+@contextmanager
+def query_budget(mongo=None, redis=None, label="bloque"):
+    require_instrumentation(_backends(mongo, redis))
+    with metrics.capture() as commands:
+        yield commands
+    check_budget(commands, mongo, redis, label)
+
+
+#Hace la request con el test client y devuelve (respuesta, comandos). backends
+#son los que tienen que estar instrumentados
+def request_commands(client, method, path, backends=("mongo", "redis"), **kwargs):
+    require_instrumentation(backends)
+    with metrics.capture() as commands:
+        response = client.open(path, method=method, **kwargs)
+    return response, commands
+
+
+def assert_request_budget(client, method, path, mongo=None, redis=None, **kwargs):
+    response, commands = request_commands(client, method, path, _backends(mongo, redis), **kwargs)
+    check_budget(commands, mongo, redis, f"{method} {path}")
+    return response
+
+
+#run(n) hace lo mismo con n items y devuelve los comandos. Falla si con mas
+#items hay mas comandos (una consulta por item)
+def assert_no_growth(run, sizes=GROWTH_SIZES, backends=("mongo", "redis"), label="request"):
+    results = {size: run(size) for size in sizes}
+    smallest, largest = results[sizes[0]], results[sizes[-1]]
+    for backend in backends:
+        if _count(largest, backend) > _count(smallest, backend):
+            counts = ", ".join(f"{size} items: {_count(commands, backend)}" for size, commands in results.items())
+            raise QueryBudgetExceeded(
+                f"{label}: los comandos de {backend} crecen con la cantidad de items ({counts})\n"
+                f"Con {sizes[-1]} items:\n{format_commands(largest, backend)}", largest)
+    return results
+
+
+def _login(client, user):
+    from utils.benchmark import BENCH_PASSWORD
+
+    response = client.post('/auth/login', data={"username": user, "password": BENCH_PASSWORD})
+    if response.status_code >= 400 or 'session' not in response.headers.get('Set-Cookie', ''):
+        raise RuntimeError(f"No se pudo entrar como {user}")
+
+
+def _fill_cart(client, size):
+    for i in range(size):
+        client.post('/add_to_cart', data={"product_id": f"bench-{i}", "name": f"bench-{i}", "quantity": 1})
+
+
+def _create_order(client, size):
+    _fill_cart(client, size)
+    location = client.post('/create_order').headers.get('Location', '')
+    if '/order/' not in location:
+        raise RuntimeError(f"No se pudo crear la orden ({location})")
+    return location.rsplit('/', 1)[-1]
+
+
+#Chequeos que corre main(): (nombre, preparacion, request, presupuesto). La
+#preparacion recibe el cliente ya logueado, el usuario y la cantidad de items
+def _checkout(client, user, size):
+    return 'GET', f"/checkout/{_create_order(client, size)}"
+
+
+def _create_order_request(client, user, size):
+    _fill_cart(client, size)
+    return 'POST', '/create_order'
+
+
+def _products_with_cart(client, user, size):
+    _fill_cart(client, size)
+    #Se calienta el cache del catalogo, asi solo se mide lo que depende del usuario.
+    #Al volver a entrar la cantidad del carrito se vuelve a leer (context processor):
+    #la guardan las operaciones del carrito en Redis, no tiene que ir a Mongo
+    client.get('/products')
+    _login(client, user)
+    return 'GET', '/products'
+
+
+CHECKS = [
+    ("checkout", _checkout, {"mongo": 3, "redis": 3}),
+    ("create_order", _create_order_request, {"mongo": 8, "redis": 8}),
+    ("context_processors", _products_with_cart, {"mongo": 0, "redis": 8}),
+]
+
+
+#Corre un chequeo de CHECKS con cada tamaño de sizes, cada vez con un usuario
+#nuevo de users (ya cargado en Redis). Falla con QueryBudgetExceeded si se pasa
+#del presupuesto o si los comandos crecen con los items. Devuelve los comandos por tamaño
+def run_check(app, name, prepare, budget, users, sizes=GROWTH_SIZES, backends=("mongo", "redis")):
+    budget = {backend: limit for backend, limit in budget.items() if backend in backends}
+
+    def run(size):
+        client = app.test_client()
+        user = next(users)
+        _login(client, user)
+        method, path = prepare(client, user, size)
+        response, commands = request_commands(client, method, path, backends)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path} -> {response.status_code}")
+        check_budget(commands, label=f"{name} ({size} items)", **budget)
+        return commands
+
+    return assert_no_growth(run, sizes, backends, label=name)
+
+
+def bench_users():
+    i = 0
+    while True:
+        yield f"bench{i}"
+        i += 1
+
+
+def run_checks(app, backends=("mongo", "redis")):
+    failures = []
+    users = bench_users()
+    for name, prepare, budget in CHECKS:
+        try:
+            results = run_check(app, name, prepare, budget, users, backends=backends)
+            used = ", ".join(f"{backend} {_count(results[GROWTH_SIZES[-1]], backend)}" for backend in backends)
+            print(f"ok    {name}: {used}")
+        except (QueryBudgetExceeded, RuntimeError) as e:
+            failures.append(name)
+            print(f"FALLA {name}: {e}")
+    return failures
+
+
+#Uso: python utils/query_budget.py [--backend local|fake]
+#Corre los chequeos de CHECKS contra un mongod y redis-server locales (por
+#defecto; sin los binarios falla) o contra mongomock y fakeredis, contando las
+#operaciones de mongomock con count_fake_mongo. En CI corren los mismos
+#chequeos como tests (tests/test_query_budget.py, con el backend fake).
+#Sale con 1 si alguno se pasa del presupuesto y con 2 si no se puede medir
+def main():
+    from utils.benchmark import start_local_servers, stop_local_servers, use_fakes, seed
+
+    args = sys.argv[1:]
+    backend = args[args.index("--backend") + 1] if "--backend" in args else "local"
+    if backend not in ("local", "fake"):
+        print("--backend tiene que ser local o fake", file=sys.stderr)
+        sys.exit(2)
+    metrics.METRICS_ENABLED = True
+
+    workdir = tempfile.mkdtemp(prefix="tiendamia-budget-")
+    processes = []
+    try:
+        if backend == "local":
+            processes = start_local_servers(workdir)
+        else:
+            use_fakes()
+            count_fake_mongo()
+
+        from utils.db import get_db
+        from utils.redis_client import get_redis_client
+        from utils.indexes import ensure_indexes
+        import app as app_module
+
+        db = get_db()
+        if backend == "local":
+            ensure_indexes(db)
+        seed(db, get_redis_client(), 20, len(CHECKS) * len(GROWTH_SIZES), 1)
+        app_module.app.config['TESTING'] = True
+        require_instrumentation()
+        failures = run_checks(app_module.app)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(2)
+    finally:
+        stop_local_servers(processes)
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
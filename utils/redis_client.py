@@ -1,7 +1,78 @@
+import os
+import threading
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from utils.metrics import METRICS_ENABLED, InstrumentedRedis
 
+#Configuración de la conexión, se puede ajustar con variables de entorno
+REDIS_HOST = os.environ.get("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_DB = int(os.environ.get("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get("REDIS_CONNECT_TIMEOUT", 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("REDIS_HEALTH_CHECK_INTERVAL", 30))
+REDIS_RETRIES = int(os.environ.get("REDIS_RETRIES", 3))
+
+_client = None
+_lock = threading.Lock()
+
+
+#Devuelve el cliente Redis compartido. Todas las llamadas usan el mismo pool de
+#conexiones; el pool detecta el fork (compara el pid) y abre conexiones nuevas
+#en cada worker, asi que se puede guardar el cliente a nivel de modulo
 def get_redis_client():
-    client = redis.Redis(host='127.0.0.1', port=6379, db=0)
-    return client
+    global _client
+    if _client is not None:
+        return _client
+    with _lock:
+        if _client is None:
+            pool = redis.ConnectionPool(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                db=REDIS_DB,
+                max_connections=REDIS_MAX_CONNECTIONS,
+                socket_timeout=REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+                socket_keepalive=True,
+                health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                #Si se cae la conexion (ej. failover) se reconecta con backoff
+                retry=Retry(ExponentialBackoff(cap=1, base=0.05), REDIS_RETRIES),
+                retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+            )
+            #Con metricas se usa el cliente que cuenta los comandos (utils/metrics.py)
+            _client = (InstrumentedRedis if METRICS_ENABLED else redis.Redis)(connection_pool=pool)
+    return _client
+
+
+def close_redis_client():
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.connection_pool.disconnect()
+        _client = None
 
 
+#Los contadores son atributos internos de redis.ConnectionPool (no hay API
+#publica): se leen con getattr y si una version de redis-py no los tiene quedan
+#en 0 en vez de romper /metrics
+def get_redis_pool_stats():
+    stats = {
+        "pid": os.getpid(),
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        "connected": _client is not None,
+        "created": 0,
+        "available": 0,
+        "in_use": 0,
+    }
+    if stats["connected"]:
+        pool = _client.connection_pool
+        #Despues de un fork el pool se reinicia recien al usarlo, asi no se cuentan las del padre
+        checkpid = getattr(pool, "_checkpid", None)
+        if checkpid is not None:
+            checkpid()
+        stats["created"] = getattr(pool, "_created_connections", 0)
+        stats["available"] = len(getattr(pool, "_available_connections", ()))
+        stats["in_use"] = len(getattr(pool, "_in_use_connections", ()))
+    return stats
@@ -0,0 +1,121 @@
+import base64
+import datetime
+import json
+import os
+import re
+import uuid
+from decimal import Decimal
+from bson import ObjectId, Decimal128, Binary, Regex, Timestamp
+from bson.raw_bson import RawBSONDocument
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:  #Sin orjson se usa el json de la libreria estandar
+    orjson = None
+
+#Cuantos elementos se codifican juntos al mandar una lista en partes
+JSON_STREAM_CHUNK = int(os.environ.get("JSON_STREAM_CHUNK", 200))
+MAX_FIELDS = 50
+#Nombre de campo con partes separadas por punto, ninguna vacia (a..b o a. no)
+FIELD_NAME = re.compile(r"^[A-Za-z_]\w*(\.\w+)*$")
+
+
+#Tipos de BSON que el encoder no conoce. Se llama tambien para los valores
+#anidados (orjson y json lo hacen solos)
+def _default(value):
+    if isinstance(value, RawBSONDocument):
+        return dict(value)
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, Binary):
+        if value.subtype in (3, 4):
+            return str(value.as_uuid(value.subtype))
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, Timestamp):
+        return {"t": value.time, "i": value.inc}
+    if isinstance(value, Regex):
+        return value.pattern
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+#Campos pedidos con ?fields=name,price,images (None si no se pidio nada).
+#Se ignoran los nombres que no son campos validos (ej. operadores con $)
+def requested_fields(param='fields'):
+    return parse_fields(request.args.get(param))
+
+
+#Los campos repetidos o dentro de otro campo pedido (images.0 con images) se
+#sacan: Mongo rechaza una proyeccion con rutas que chocan
+def parse_fields(raw):
+    if not raw:
+        return None
+    fields = list(dict.fromkeys(field.strip() for field in raw.split(',') if FIELD_NAME.match(field.strip())))
+    requested = set(fields)
+    fields = [field for field in fields
+              if not any(field[:i] in requested for i in range(len(field)) if field[i] == '.')]
+    return fields[:MAX_FIELDS] or None
+
+
+#Proyeccion de Mongo para los campos pedidos, asi no se leen los que no se mandan
+def field_projection(fields):
+    if not fields:
+        return None
+    projection = {field: 1 for field in fields}
+    if "_id" not in projection:
+        projection["_id"] = 0
+    return projection
+
+
+#Se queda solo con los campos pedidos (de primer nivel) de un documento
+def select_fields(document, fields):
+    if not fields or document is None:
+        return document
+    top_level = {field.split('.', 1)[0] for field in fields}
+    return {key: value for key, value in document.items() if key in top_level}
+
+
+def json_response(value, status=200):
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+#Manda una lista como JSON en partes de JSON_STREAM_CHUNK elementos, sin armar
+#todo el texto en memoria. Con key la lista va dentro de un objeto con extra:
+#{"<key>": [...], **extra}
+def stream_json(items, key=None, extra=None, fields=None):
+    def generate():
+        yield b'{' + dumps(key) + b':[' if key else b'['
+        chunk = []
+        first = True
+        for item in items:
+            chunk.append(dumps(select_fields(item, fields)))
+            if len(chunk) >= JSON_STREAM_CHUNK:
+                yield (b'' if first else b',') + b','.join(chunk)
+                first = False
+                chunk = []
+        if chunk:
+            yield (b'' if first else b',') + b','.join(chunk)
+        if key:
+            tail = b''.join(b',' + dumps(name) + b':' + dumps(value) for name, value in (extra or {}).items())
+            yield b']' + tail + b'}'
+        else:
+            yield b']'
+    return Response(generate(), mimetype='application/json')
@@ -0,0 +1,27 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.db import get_db
+from models.product import Product, RESERVATION_TTL
+
+#Cada cuantos segundos se buscan marcas de reservas vencidas
+SWEEP_INTERVAL = int(os.environ.get("RESERVATION_SWEEP_INTERVAL", RESERVATION_TTL))
+
+#Saca de los productos las marcas de reservas de stock que quedaron de procesos
+#cortados (solo pasa sin replica set, ver Product._reserve_with_compensation)
+#Uso: python utils/sweep_reservations.py          (queda corriendo)
+#     python utils/sweep_reservations.py --once   (una sola pasada, para cron)
+def main():
+    product_model = Product(get_db())
+    while True:
+        swept = product_model.sweep_reservations()
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} reservas vencidas limpiadas: {swept}")
+        if '--once' in sys.argv:
+            break
+        time.sleep(SWEEP_INTERVAL)
+
+if __name__ == '__main__':
+    main()
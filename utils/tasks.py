@@ -0,0 +1,17 @@
+from utils.db import get_db
+from utils.jobs import deferrable
+from models.audit_log import AuditLog, AuditWriter
+
+#Trabajos que no cambian la respuesta al usuario y se hacen en segundo plano.
+#Se llaman con .delay(...) desde los requests
+
+
+#Un lote de logs de auditoria, se guarda con un solo insert_many
+@deferrable
+def insert_audit_logs(entries):
+    AuditLog(get_db()).insert_logs(entries)
+
+
+#Los requests agregan los logs aca y se encolan de a lotes
+audit_writer = AuditWriter(insert_audit_logs.delay)
+
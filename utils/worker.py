@@ -0,0 +1,24 @@
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.jobs import work, retry_dead, queue_stats
+
+#Uso: python utils/worker.py                (queda corriendo, se pueden levantar varios)
+#     python utils/worker.py --burst        (procesa lo que hay en la cola y termina)
+#     python utils/worker.py --retry-dead   (vuelve a encolar los trabajos fallidos)
+#     python utils/worker.py --stats        (cantidad de trabajos en cada cola)
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if '--retry-dead' in sys.argv:
+        print(f"Trabajos reencolados: {retry_dead()}")
+    elif '--stats' in sys.argv:
+        print(queue_stats())
+    else:
+        processed = work(burst='--burst' in sys.argv)
+        print(f"Trabajos procesados: {processed}")
+
+if __name__ == '__main__':
+    main()